@@ -0,0 +1,236 @@
+"""
+Deterministic synthetic sales events for benchmarks.
+
+Produces documents shaped like the source collection (event_time, order_id,
+product_id, category_id, dotted category_code, brand, price, user_id) with
+the skew of real e-commerce traffic:
+
+- user activity and product popularity follow Zipf-like power laws, so a
+  small share of users and products covers most events
+- orders hold one or more items (geometric, mean ~1.7) bought by the same
+  user within a few seconds
+- every product has a fixed category, brand and base price; some events
+  miss their category_code or brand, as in the real export
+
+Documents are generated lazily from a seed, so the same (scale, seed) always
+yields the same documents and even the 100M scale needs no memory. _ids are
+built from the event time, so _id order is event order.
+
+    python -m benchmarks.generator --scale 1m --reset
+    python -m benchmarks.generator --scale 10m --bson /tmp/events_10m.bson
+"""
+import argparse
+import logging
+import random
+from datetime import datetime, timedelta
+
+import bson
+from bson.objectid import ObjectId
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+SCALES = {"1m": 1_000_000, "10m": 10_000_000, "100m": 100_000_000}
+
+START_TIME = datetime(2020, 1, 1)
+ORDER_ID_BASE = 2294359932054536986
+PRODUCT_ID_BASE = 1515966223509089906
+CATEGORY_ID_BASE = 2268105426648170900
+USER_ID_BASE = 1515915625441993984
+
+NUM_PRODUCTS = 200_000
+NUM_BRANDS = 3_000
+EVENTS_PER_USER = 20
+MEAN_SECONDS_BETWEEN_ORDERS = 2.0
+ITEMS_CONTINUE_PROBABILITY = 0.4
+MISSING_CATEGORY_CODE_RATE = 0.1
+MISSING_BRAND_RATE = 0.15
+
+# Power-law exponents (must not be 1.0); larger means more skewed.
+USER_SKEW = 0.9
+PRODUCT_SKEW = 1.05
+BRAND_SKEW = 1.2
+
+CATEGORY_CODES = tuple(
+    f"{main}.{sub}" + (f".{leaf}" if leaf else "")
+    for main, subs in (
+        ("electronics", (("smartphone", None), ("audio", "headphone"), ("video", "tv"),
+                         ("clocks", None), ("tablet", None))),
+        ("appliances", (("kitchen", "kettle"), ("kitchen", "refrigerators"), ("environment", "vacuum"),
+                        ("personal", "scales"), ("iron", None))),
+        ("computers", (("notebook", None), ("desktop", None), ("components", "videocards"),
+                       ("peripherals", "printer"))),
+        ("apparel", (("shoes", None), ("shoes", "sandals"), ("costume", None))),
+        ("furniture", (("living_room", "sofa"), ("bedroom", "bed"), ("kitchen", "table"))),
+        ("construction", (("tools", "drill"), ("tools", "saw"), ("components", "faucet"))),
+        ("kids", (("toys", None), ("carriage", None))),
+        ("auto", (("accessories", "player"), ("accessories", "videoregister"))),
+        ("sport", (("bicycle", None), ("trainer", None))),
+        ("accessories", (("bag", None), ("umbrella", None))),
+    )
+    for sub, leaf in subs
+)
+CATEGORIES_PER_CODE = 4
+
+
+def _mix(x):
+    # splitmix64 finalizer: a fixed, well-spread hash of a product index.
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+def _power_law_index(u, n, exponent):
+    """
+    Maps a uniform 'u' to an index in [0, n) following a power law with the
+    given exponent (larger is more skewed to low indexes), by inverse transform
+    sampling of a continuous Zipf distribution. O(1), no table.
+    """
+    a = 1.0 - exponent
+    x = ((n ** a - 1.0) * u + 1.0) ** (1.0 / a)
+    return min(int(x) - 1, n - 1)
+
+
+def product_attributes(product_index):
+    """
+    Fixed (category_id, category_code, brand, base price) of a product.
+    """
+    h = _mix(product_index)
+    code_index = h % len(CATEGORY_CODES)
+    category_id = CATEGORY_ID_BASE + code_index * CATEGORIES_PER_CODE + (h >> 8) % CATEGORIES_PER_CODE
+    brand_index = _power_law_index(((h >> 16) % 1_000_003) / 1_000_003, NUM_BRANDS, BRAND_SKEW)
+    # Log-uniform base price between ~1 and ~2500.
+    price = round(2.718281828 ** (((h >> 40) % 10_000) / 10_000 * 7.8), 2)
+    return category_id, CATEGORY_CODES[code_index], f"brand{brand_index:04d}", price
+
+
+def generate_documents(num_events, seed=42, start=START_TIME):
+    """
+    Yields 'num_events' documents in _id (= event time) order.
+    """
+    rng = random.Random(seed)
+    num_users = max(1, num_events // EVENTS_PER_USER)
+    attributes = {}
+    event_time = start
+    order_index = 0
+    emitted = 0
+    while emitted < num_events:
+        event_time += timedelta(seconds=round(rng.expovariate(1.0 / MEAN_SECONDS_BETWEEN_ORDERS)))
+        user_id = USER_ID_BASE + _power_law_index(rng.random(), num_users, USER_SKEW)
+        order_id = ORDER_ID_BASE + order_index
+        order_index += 1
+        item_time = event_time
+
+        while True:
+            product_index = _power_law_index(rng.random(), NUM_PRODUCTS, PRODUCT_SKEW)
+            attrs = attributes.get(product_index)
+            if attrs is None:
+                attrs = attributes.setdefault(product_index, product_attributes(product_index))
+            category_id, category_code, brand, base_price = attrs
+
+            doc = {
+                "_id": ObjectId(_object_id_bytes(item_time, emitted)),
+                "event_time": item_time,
+                "order_id": order_id,
+                "product_id": PRODUCT_ID_BASE + product_index,
+                "category_id": category_id,
+                "price": round(base_price * rng.uniform(0.9, 1.1), 2),
+                "user_id": user_id,
+            }
+            if rng.random() >= MISSING_CATEGORY_CODE_RATE:
+                doc["category_code"] = category_code
+            if rng.random() >= MISSING_BRAND_RATE:
+                doc["brand"] = brand
+            yield doc
+
+            emitted += 1
+            if emitted >= num_events or rng.random() >= ITEMS_CONTINUE_PROBABILITY:
+                break
+            item_time += timedelta(seconds=rng.randint(1, 5))
+        # The next order starts after this one's last item, keeping _ids sorted.
+        event_time = item_time
+
+
+def _object_id_bytes(event_time, sequence):
+    # 4-byte timestamp + 8-byte sequence: unique, and sorted like the events.
+    seconds = int((event_time - datetime(1970, 1, 1)).total_seconds())
+    return seconds.to_bytes(4, "big") + sequence.to_bytes(8, "big")
+
+
+def batched(docs, batch_size):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_into_collection(collection, num_events, seed=42, batch_size=10000):
+    """
+    Inserts the generated documents into 'collection' (a pymongo or mongomock
+    collection). Returns the number of documents inserted.
+    """
+    inserted = 0
+    for batch in batched(generate_documents(num_events, seed), batch_size):
+        collection.insert_many(batch, ordered=False)
+        inserted += len(batch)
+        if inserted % (batch_size * 100) == 0:
+            logging.info(f"Inserted {inserted} / {num_events} documents.")
+    return inserted
+
+
+def write_bson(path, num_events, seed=42):
+    """
+    Writes the documents as concatenated BSON, the format mongorestore reads.
+    """
+    with open(path, "wb") as f:
+        for doc in generate_documents(num_events, seed):
+            f.write(bson.encode(doc))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate deterministic synthetic sales events.")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--scale", choices=sorted(SCALES), default="1m")
+    size.add_argument("--events", type=int, help="Exact number of events instead of a preset scale.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--bson", metavar="PATH",
+        help="Write a BSON dump to PATH instead of inserting into MongoDB."
+    )
+    parser.add_argument(
+        "--reset", action="store_true",
+        help="Drop the configured Mongo collection before inserting. Point config/credentials at a scratch "
+             "database first."
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    num_events = args.events or SCALES[args.scale]
+    if args.bson:
+        write_bson(args.bson, num_events, args.seed)
+        logging.info(f"Wrote {num_events} documents to {args.bson}.")
+        return
+
+    from config.connections import close_all, get_mongo_collection
+    try:
+        collection = get_mongo_collection()
+        if args.reset:
+            collection.drop()
+        inserted = load_into_collection(collection, num_events, args.seed, args.batch_size)
+        logging.info(f"Inserted {inserted} documents into {collection.full_name}.")
+    finally:
+        close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+End-to-end benchmark harness for the pipeline stages.
+
+Runs the staging, OLTP and OLAP stages one after another against a local
+PostgreSQL and either a local MongoDB or an in-process mongomock stand-in,
+fed by benchmarks.generator. Every stage runs in a fresh process so its peak
+RSS is its own; throughput and round trips come from scripts.common.metrics.
+
+One JSON line per stage is appended to benchmarks/results/<scale>.jsonl,
+tagged with the git commit, so runs of the same scale and options can be
+compared over time (--compare prints the change against the previous run).
+
+--reset empties the pipeline tables and the Mongo collection first: point
+config/credentials at scratch databases. mongomock (pip install mongomock)
+keeps the documents in the staging process, so that stage's peak RSS
+includes them, and it only supports '--extract full'.
+
+    PYTHONPATH=. python -m benchmarks.harness --scale 1m --reset --mongomock --compare
+    PYTHONPATH=. python -m benchmarks.harness --stages oltp olap --engine sql --label sql-engine
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from benchmarks.generator import SCALES, load_into_collection
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+STAGES = ("staging", "oltp", "olap")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Every table the pipeline writes, children before parents.
+PIPELINE_TABLES = (
+    "sales_olap.reconciliation_buckets",
+    "sales_olap.agg_sales_hourly",
+    "sales_olap.agg_daily_users",
+    "sales_olap.agg_user_days",
+    "sales_olap.fact_sales",
+    "sales_olap.dim_users",
+    "sales_olap.dim_products",
+    "sales_olap.dim_date",
+    "sales_oltp.order_items",
+    "sales_oltp.orders",
+    "sales_oltp.products",
+    "sales_oltp.categories",
+    "sales_oltp.users",
+    "sales_oltp.sales_staging",
+    "sales_oltp.sales_staging_archive",
+    "sales_oltp.etl_metadata",
+)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def reset_postgres():
+    from config.connections import pg_connection
+    with pg_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"TRUNCATE {', '.join(PIPELINE_TABLES)} RESTART IDENTITY CASCADE")
+        conn.commit()
+    logging.info("Truncated the pipeline tables.")
+
+
+def _mongomock_collection():
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("--mongomock needs the mongomock package (pip install mongomock).")
+    return mongomock.MongoClient()["benchmark"]["sales"]
+
+
+def run_stage(stage, options):
+    """
+    Runs one stage in the current (worker) process and returns its seconds,
+    peak RSS and metrics snapshot.
+    """
+    from config.connections import close_all, get_mongo_collection, pg_connection
+    from scripts.common import metrics
+    from scripts.olap_load import oltp_to_olap
+    from scripts.oltp_load import staging_oltp
+    from scripts.staging_load import mongo_to_staging
+
+    metrics.reset()
+    result = {}
+    try:
+        with pg_connection() as conn:
+            if stage == "staging":
+                if options["mongomock"]:
+                    collection = _mongomock_collection()
+                    generate_start = time.perf_counter()
+                    load_into_collection(collection, options["events"], options["seed"])
+                    result["generate_seconds"] = round(time.perf_counter() - generate_start, 3)
+                else:
+                    collection = get_mongo_collection()
+                start = time.perf_counter()
+                with metrics.stage(stage):
+                    mongo_to_staging.load_to_staging(
+                        conn, collection, batch_size=options["batch_size"],
+                        loader=options["loader"], extract=options["extract"]
+                    )
+            elif stage == "oltp":
+                process_batch = staging_oltp.ENGINES[options["engine"]]
+                start = time.perf_counter()
+                with metrics.stage(stage):
+                    while process_batch(conn, batch_size=options["batch_size"], itersize=options["itersize"]):
+                        pass
+            else:
+                start = time.perf_counter()
+                with metrics.stage(stage):
+                    oltp_to_olap.load_dim_users_bulk(conn, options["chunk_size"])
+                    oltp_to_olap.load_dim_products_bulk(conn, options["chunk_size"])
+                    oltp_to_olap.load_fact_sales_incremental_bulk_with_caching(
+                        conn, chunk_size=options["chunk_size"], columnar=options["columnar"]
+                    )
+            result["seconds"] = round(time.perf_counter() - start, 3)
+    finally:
+        close_all()
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["metrics"] = metrics.snapshot()
+    return result
+
+
+def build_record(stage, options, result, run_id, label):
+    from scripts.common import metrics
+
+    stage_metrics = metrics.StageMetrics(stage)
+    for name, data in result["metrics"].items():
+        if name != "other":
+            stage_metrics.merge(data)
+    commit, dirty = git_revision()
+    seconds = result["seconds"]
+    rows = stage_metrics.rows
+    return {
+        "run_id": run_id,
+        "label": label,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "git_dirty": dirty,
+        "stage": stage,
+        "events": options["events"],
+        "seed": options["seed"],
+        "options": {k: v for k, v in options.items() if k not in ("events", "seed")},
+        "seconds": seconds,
+        "generate_seconds": result.get("generate_seconds"),
+        "rows": rows,
+        "rows_per_second": round(rows / seconds, 1) if seconds else None,
+        "peak_rss_mb": result["peak_rss_mb"],
+        "round_trips": stage_metrics.round_trips,
+        "round_trips_per_1k_rows": round(stage_metrics.round_trips * 1000 / rows, 2) if rows else None,
+        "bytes_sent": stage_metrics.bytes,
+        "phase_seconds": {name: round(h.sum, 3) for name, h in stage_metrics.phases.items()},
+        "caches": {name: round(c.hit_rate(), 4) for name, c in stage_metrics.caches.items()},
+    }
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_record(history, record):
+    """
+    The latest earlier record of the same stage, size and options.
+    """
+    for old in reversed(history):
+        if (old["run_id"] != record["run_id"] and old["stage"] == record["stage"]
+                and old["events"] == record["events"] and old["options"] == record["options"]):
+            return old
+    return None
+
+
+def print_comparison(history, records):
+    for record in records:
+        old = previous_record(history, record)
+        if old is None:
+            logging.info(f"{record['stage']:>8}: no earlier run with the same options to compare with.")
+            continue
+        changes = []
+        for key in ("rows_per_second", "peak_rss_mb", "round_trips"):
+            before, after = old.get(key), record.get(key)
+            if before and after is not None:
+                changes.append(f"{key} {before} -> {after} ({(after - before) / before:+.1%})")
+        logging.info(
+            f"{record['stage']:>8} vs {(old['git_commit'] or '?')[:10]} ({old['timestamp']}): "
+            + ", ".join(changes)
+        )
+
+
+def run(args):
+    events = args.events or SCALES[args.scale]
+    options = {
+        "events": events,
+        "seed": args.seed,
+        "mongomock": args.mongomock,
+        "batch_size": args.batch_size,
+        "chunk_size": args.chunk_size,
+        "itersize": args.itersize,
+        "loader": args.loader,
+        "extract": args.extract,
+        "engine": args.engine,
+        "columnar": args.columnar,
+    }
+    if args.mongomock and args.extract != "full":
+        raise SystemExit("mongomock does not support raw batch extraction; use --extract full.")
+
+    if args.reset:
+        reset_postgres()
+        if not args.mongomock:
+            from config.connections import close_all, get_mongo_collection
+            try:
+                collection = get_mongo_collection()
+                collection.drop()
+                load_into_collection(collection, events, args.seed)
+            finally:
+                close_all()
+    elif args.mongomock and "staging" in args.stages:
+        raise SystemExit("--mongomock starts from an empty collection; combine it with --reset.")
+
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    records = []
+    context = multiprocessing.get_context("spawn")
+    for stage in STAGES:
+        if stage not in args.stages:
+            continue
+        logging.info(f"Running stage {stage} on {events} events...")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_stage, stage, options).result()
+        record = build_record(stage, options, result, run_id, args.label)
+        logging.info(
+            f"{stage:>8}: {record['rows']} rows in {record['seconds']:.1f}s "
+            f"({record['rows_per_second']} rows/s), peak RSS {record['peak_rss_mb']} MB, "
+            f"{record['round_trips']} round trips"
+        )
+        records.append(record)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    size_name = args.scale if args.events is None else str(events)
+    path = os.path.join(args.results_dir, f"{size_name}.jsonl")
+    history = load_results(path)
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    logging.info(f"Appended {len(records)} results to {path}.")
+    if args.compare:
+        print_comparison(history, records)
+    return records
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages end to end.")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--scale", choices=sorted(SCALES), default="1m")
+    size.add_argument("--events", type=int, help="Exact number of events instead of a preset scale.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--mongomock", action="store_true", help="Use an in-process mongomock collection.")
+    parser.add_argument(
+        "--reset", action="store_true",
+        help="Truncate the pipeline tables and regenerate the Mongo documents first."
+    )
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--itersize", type=int, default=None)
+    parser.add_argument("--loader", choices=("values", "copy"), default="values")
+    parser.add_argument("--extract", choices=("full", "projected"), default="full")
+    parser.add_argument("--engine", choices=("python", "sql", "columnar"), default="python")
+    parser.add_argument("--columnar", action="store_true")
+    parser.add_argument("--label", help="Free-form tag stored with the results, e.g. a branch name.")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument(
+        "--compare", action="store_true",
+        help="Compare each stage with the previous run of the same size and options."
+    )
+    return parser.parse_args()
+
+
+def main():
+    run(parse_args())
+
+
+if __name__ == "__main__":
+    main()
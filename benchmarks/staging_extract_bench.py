@@ -0,0 +1,248 @@
+"""
+Micro-benchmark for the staging extraction decode path.
+
+Runs the loader's own iter_documents() and transform_batch() in the 'full'
+extract mode (whole documents decoded by the cursor) and the 'projected' one
+(raw BSON batches of the staging fields only) on synthetic wide documents.
+The server batches are encoded up front and replayed, so only the client
+side is measured.
+
+'columns' times decode_columns(), a pure-Python decoder that walks the
+projected raw batches field by field straight into staging columns, without
+building a dict per document. It is the candidate the projected mode was
+measured against: bson's C decode_all() plus transform_batch() stays faster,
+since the per-field dict lookups are a small share of the decode.
+
+    PYTHONPATH=. python -m benchmarks.staging_extract_bench --docs 10000 --extra-fields 60
+"""
+import argparse
+import logging
+import random
+import struct
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+import bson
+from bson.objectid import ObjectId
+
+from scripts.staging_load.mongo_to_staging import STAGING_PROJECTION, iter_documents, transform_batch
+
+STAGING_FIELDS = ("_id",) + tuple(STAGING_PROJECTION)
+# transform_batch's defaults for missing fields, in STAGING_FIELDS order.
+STAGING_DEFAULTS = (None, "1970-01-01 00:00:00", -1, -1, -1, "unknown", "unknown", 0.0, -1)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def make_documents(num_docs, extra_fields, seed=42):
+    """
+    Builds documents with the staging fields plus 'extra_fields' unrelated
+    attributes, roughly the shape of a wide production sales document.
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 4, 1)
+    docs = []
+    for i in range(num_docs):
+        doc = {
+            "_id": ObjectId(),
+            "event_time": start + timedelta(seconds=i * 7),
+            "order_id": 2294359932054536986 + i // 3,
+            "product_id": 1515966223509089906 + rng.randrange(50000),
+            "category_id": 2268105426648170900 + rng.randrange(500),
+            "category_code": rng.choice(["electronics.smartphone", "appliances.kitchen.kettle", "unknown"]),
+            "brand": rng.choice(["samsung", "apple", "xiaomi", "unknown"]),
+            "price": round(rng.uniform(1, 2000), 2),
+            "user_id": 1515915625441993984 + rng.randrange(200000),
+        }
+        for f in range(extra_fields):
+            doc[f"attr_{f}"] = {"value": rng.random(), "label": f"label-{rng.randrange(1000)}"}
+        docs.append(doc)
+    return docs
+
+
+class _ReplayCursor:
+    """
+    Stands in for the pymongo cursor iter_documents() drives: it hands out
+    pre-encoded server batches, decoded like pymongo decodes a find() reply
+    unless 'raw', as find_raw_batches() returns them.
+    """
+
+    def __init__(self, raw_batches, raw):
+        self._raw_batches = raw_batches
+        self._raw = raw
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        for raw_batch in self._raw_batches:
+            if self._raw:
+                yield raw_batch
+            else:
+                yield from bson.decode_all(raw_batch)
+
+
+class _ReplayCollection:
+    """
+    Serves the same documents to find() in full and to find_raw_batches()
+    projected to STAGING_PROJECTION, as Mongo would send them.
+    """
+
+    def __init__(self, docs, batch_size):
+        batches = [docs[i:i + batch_size] for i in range(0, len(docs), batch_size)]
+        self.full_batches = [b"".join(bson.encode(doc) for doc in batch) for batch in batches]
+        self.projected_batches = [
+            b"".join(
+                bson.encode({"_id": doc["_id"], **{f: doc[f] for f in STAGING_PROJECTION}})
+                for doc in batch
+            )
+            for batch in batches
+        ]
+
+    def find(self, query_filter, **kwargs):
+        return _ReplayCursor(self.full_batches, raw=False)
+
+    def find_raw_batches(self, query_filter, projection, **kwargs):
+        return _ReplayCursor(self.projected_batches, raw=True)
+
+
+_INT32 = struct.Struct("<i").unpack_from
+_INT64 = struct.Struct("<q").unpack_from
+_DOUBLE = struct.Struct("<d").unpack_from
+_EPOCH = datetime(1970, 1, 1)
+
+
+def decode_columns(raw_batch):
+    """
+    Decodes a raw batch of projected documents into the staging columns
+    (STAGING_FIELDS order) and returns the same rows as transform_batch().
+    Handles the BSON types the staging fields use.
+    """
+    positions = {name.encode(): i for i, name in enumerate(STAGING_FIELDS)}
+    columns = [[] for _ in STAGING_FIELDS]
+    find = raw_batch.find
+    pos, end = 0, len(raw_batch)
+    while pos < end:
+        doc_end = pos + _INT32(raw_batch, pos)[0]
+        values = list(STAGING_DEFAULTS)
+        p = pos + 4
+        while p < doc_end - 1:
+            kind = raw_batch[p]
+            name_end = find(b"\0", p + 1)
+            name = raw_batch[p + 1:name_end]
+            p = name_end + 1
+            if kind == 0x12:    # int64
+                value = _INT64(raw_batch, p)[0]
+                p += 8
+            elif kind == 0x10:  # int32
+                value = _INT32(raw_batch, p)[0]
+                p += 4
+            elif kind == 0x01:  # double
+                value = _DOUBLE(raw_batch, p)[0]
+                p += 8
+            elif kind == 0x02:  # string
+                length = _INT32(raw_batch, p)[0]
+                value = raw_batch[p + 4:p + 3 + length].decode()
+                p += 4 + length
+            elif kind == 0x07:  # ObjectId
+                value = raw_batch[p:p + 12].hex()
+                p += 12
+            elif kind == 0x09:  # UTC datetime
+                value = _EPOCH + timedelta(milliseconds=_INT64(raw_batch, p)[0])
+                p += 8
+            elif kind == 0x0A:  # null
+                value = None
+            else:
+                raise ValueError(f"Unsupported BSON type {kind:#x} in field {name!r}")
+            i = positions.get(name)
+            if i is not None:
+                values[i] = value
+        for column, value in zip(columns, values):
+            column.append(value)
+        pos = doc_end
+    columns[7] = [float(price) for price in columns[7]]
+    return list(zip(*columns))
+
+
+def time_columns(collection, repeat):
+    """
+    Best time of 'repeat' runs of decode_columns() over the projected batches.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for raw_batch in collection.projected_batches:
+            decode_columns(raw_batch)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_extract(collection, extract, batch_size, repeat):
+    """
+    Best time of 'repeat' runs of the loader's own extract and transform:
+    iter_documents() in 'extract' mode, then transform_batch() per batch.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        documents = iter_documents(collection, {}, extract=extract, batch_size=batch_size)
+        while True:
+            batch = list(islice(documents, batch_size))
+            if not batch:
+                break
+            transform_batch(batch)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(num_docs, extra_fields, repeat, batch_size=10000):
+    collection = _ReplayCollection(make_documents(num_docs, extra_fields), batch_size)
+    projected_bytes = sum(map(len, collection.projected_batches))
+    first_batch = collection.projected_batches[0]
+    if decode_columns(first_batch) != transform_batch(bson.decode_all(first_batch)):
+        raise AssertionError("decode_columns() and transform_batch() build different rows.")
+
+    results = {
+        "full": (sum(map(len, collection.full_batches)), time_extract(collection, "full", batch_size, repeat)),
+        "projected": (projected_bytes, time_extract(collection, "projected", batch_size, repeat)),
+        "columns": (projected_bytes, time_columns(collection, repeat)),
+    }
+    for mode, (num_bytes, seconds) in results.items():
+        logging.info(
+            f"{mode:>9}: {num_bytes / num_docs:8.1f} bytes/doc, "
+            f"{num_docs / seconds:12.0f} docs/s ({seconds * 1000:.1f} ms per run)"
+        )
+    full_bytes, full_seconds = results["full"]
+    projected_bytes, projected_seconds = results["projected"]
+    logging.info(
+        f"projected vs full: {full_bytes / projected_bytes:.1f}x fewer bytes, "
+        f"{full_seconds / projected_seconds:.1f}x faster extract"
+    )
+    logging.info(f"columns vs projected: {projected_seconds / results['columns'][1]:.2f}x the speed")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=10000)
+    parser.add_argument("--extra-fields", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+    run(args.docs, args.extra_fields, args.repeat, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
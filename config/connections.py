@@ -0,0 +1,152 @@
+"""
+Shared, lazily created database connections for all pipeline stages.
+
+Nothing connects at import time. The PostgreSQL pool and the MongoDB client
+are created on first use and are per process: a worker process started by
+one of the loaders builds its own instead of reusing sockets inherited from
+its parent.
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from psycopg2.extensions import cursor as _cursor
+from psycopg2.pool import ThreadedConnectionPool
+from pymongo import MongoClient
+
+logger = logging.getLogger(__name__)
+
+PG_POOL_MIN_SIZE = 1
+PG_POOL_MAX_SIZE = int(os.environ.get("ETL_PG_POOL_SIZE", "8"))
+PG_ITERSIZE = int(os.environ.get("ETL_PG_ITERSIZE", "10000"))
+
+_lock = threading.Lock()
+_pg_pool = None
+_mongo_client = None
+_owner_pid = None
+_cursor_factory = _cursor
+
+
+def _reset_if_forked():
+    global _pg_pool, _mongo_client, _owner_pid
+    if _owner_pid != os.getpid():
+        _pg_pool = None
+        _mongo_client = None
+        _owner_pid = os.getpid()
+
+
+def set_cursor_factory(factory):
+    """
+    Sets the cursor class of the pool's connections. The loaders install
+    scripts.common.cursors.InstrumentedCursor; it must be set before the
+    pool is first used.
+    """
+    global _cursor_factory
+    with _lock:
+        _cursor_factory = factory
+
+
+def get_pg_pool():
+    """
+    Returns the process-wide psycopg2 connection pool, creating it on first use.
+    """
+    global _pg_pool
+    with _lock:
+        _reset_if_forked()
+        if _pg_pool is None:
+            from config.credentials import POSTGRES_CONFIG
+            _pg_pool = ThreadedConnectionPool(
+                PG_POOL_MIN_SIZE, PG_POOL_MAX_SIZE, cursor_factory=_cursor_factory, **POSTGRES_CONFIG
+            )
+            logger.info(f"Opened PostgreSQL connection pool (max {PG_POOL_MAX_SIZE} connections).")
+        return _pg_pool
+
+
+@contextmanager
+def pg_connection():
+    """
+    Borrows a connection from the pool for the duration of the block. An
+    exception escaping the block rolls back the open transaction before the
+    connection goes back to the pool; if that cleanup fails too (e.g. the
+    connection is broken), the connection is closed instead of being reused
+    and the original exception is raised.
+    """
+    pool = get_pg_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+            # WITH HOLD cursors outlive the rollback; drop them so the next
+            # borrower can reuse their names.
+            with conn.cursor() as cur:
+                cur.execute("CLOSE ALL")
+            conn.commit()
+        except Exception as cleanup_error:
+            broken = True
+            logger.warning(f"Discarding a pooled connection that failed to roll back: {cleanup_error}")
+        raise
+    finally:
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def server_cursor(conn, name, itersize=None, withhold=False):
+    """
+    Returns a named (server-side) cursor on 'conn'. Iterating it fetches
+    'itersize' rows per round trip, so client memory stays bounded however
+    large the result is. A cursor that must survive commits needs 'withhold';
+    PostgreSQL then materializes the remaining rows on the server at the
+    first commit. Use it as a context manager so it is closed before the
+    connection goes back to the pool.
+    """
+    cur = conn.cursor(name=name, withhold=withhold)
+    cur.itersize = itersize or PG_ITERSIZE
+    return cur
+
+
+def stream_rows(conn, name, query, params=None, itersize=None, withhold=False):
+    """
+    Runs 'query' on a server-side cursor and yields its rows one at a time.
+    The cursor is closed once the generator is exhausted or discarded.
+    """
+    with server_cursor(conn, name, itersize, withhold) as cur:
+        cur.execute(query, params)
+        yield from cur
+
+
+def get_mongo_client():
+    """
+    Returns the process-wide MongoClient, creating it on first use.
+    """
+    global _mongo_client
+    with _lock:
+        _reset_if_forked()
+        if _mongo_client is None:
+            from config.credentials import MONGO_CONFIG
+            _mongo_client = MongoClient(MONGO_CONFIG["uri"])
+        return _mongo_client
+
+
+def get_mongo_collection():
+    from config.credentials import MONGO_CONFIG
+    client = get_mongo_client()
+    return client[MONGO_CONFIG["database"]][MONGO_CONFIG["collection"]]
+
+
+def close_all():
+    """
+    Closes the pool and the Mongo client if they were opened by this process.
+    """
+    global _pg_pool, _mongo_client
+    with _lock:
+        if _owner_pid == os.getpid():
+            if _pg_pool is not None:
+                _pg_pool.closeall()
+            if _mongo_client is not None:
+                _mongo_client.close()
+        _pg_pool = None
+        _mongo_client = None
+    logger.info("Closed all database connections.")
@@ -0,0 +1,162 @@
+"""
+Local columnar archive of extracted staging batches.
+
+Every batch loaded into sales_staging can also be written to an Arrow IPC
+file named '<first _id>_<last _id>.arrow' (ObjectId hex, so names sort in
+_id order). The columns are the staging row after the loader's defaults, so
+a replay reproduces the same sales_staging rows without touching Mongo.
+
+Files are uncompressed so they can be memory-mapped: reading a range maps
+the files and slices the columns without copying them into Python objects.
+
+    write_batch("/data/archive", docs)
+    for table in read_range("/data/archive", lower_id, upper_id):
+        write_csv(table, buf)   # COPY ... FROM STDIN WITH (FORMAT csv)
+"""
+import logging
+import os
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = ".arrow"
+EPOCH = datetime(1970, 1, 1)
+
+SCHEMA = pa.schema([
+    ("mongo_id", pa.string()),
+    ("event_time", pa.timestamp("us")),
+    ("order_id", pa.int64()),
+    ("product_id", pa.int64()),
+    ("category_id", pa.int64()),
+    ("category_code", pa.string()),
+    ("brand", pa.string()),
+    ("price", pa.float64()),
+    ("user_id", pa.int64()),
+])
+
+
+# Non-ISO event_time strings seen in exports, tried after fromisoformat.
+EVENT_TIME_FORMATS = ("%Y-%m-%d %H:%M:%S %Z", "%Y/%m/%d %H:%M:%S", "%d.%m.%Y %H:%M:%S")
+
+
+def _event_time(value):
+    """
+    Returns the archived event_time of a document value: None stays null
+    (staging stores NULL too), and a string no known format parses becomes
+    null with a warning instead of failing the batch.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    # Exports sometimes carry "2019-10-01 00:00:00 UTC" strings.
+    text = str(value).strip()
+    try:
+        return datetime.fromisoformat(text.replace(" UTC", ""))
+    except ValueError:
+        pass
+    for fmt in EVENT_TIME_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    logger.warning(f"Archiving unparseable event_time {text!r} as null.")
+    return None
+
+
+def batch_table(batch):
+    """
+    Builds the archive table of a list of Mongo documents, applying the
+    same defaults as the staging loaders.
+    """
+    return pa.table([
+        pa.array([str(doc["_id"]) for doc in batch], pa.string()),
+        pa.array([_event_time(doc.get("event_time", EPOCH)) for doc in batch], pa.timestamp("us")),
+        pa.array([doc.get("order_id", -1) for doc in batch], pa.int64()),
+        pa.array([doc.get("product_id", -1) for doc in batch], pa.int64()),
+        pa.array([doc.get("category_id", -1) for doc in batch], pa.int64()),
+        pa.array([doc.get("category_code", "unknown") for doc in batch], pa.string()),
+        pa.array([doc.get("brand", "unknown") for doc in batch], pa.string()),
+        pa.array([float(doc.get("price", 0.0)) for doc in batch], pa.float64()),
+        pa.array([doc.get("user_id", -1) for doc in batch], pa.int64()),
+    ], schema=SCHEMA)
+
+
+def write_table(directory, table):
+    """
+    Writes 'table' (rows in _id order) as one archive file and returns its
+    path. The file only appears under its final name once complete.
+    """
+    first_id = table.column("mongo_id")[0].as_py()
+    last_id = table.column("mongo_id")[-1].as_py()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{first_id}_{last_id}{SUFFIX}")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_batch(directory, batch):
+    return write_table(directory, batch_table(batch))
+
+
+def list_files(directory, lower_id=None, upper_id=None):
+    """
+    Returns [(first_id, last_id, path)] of the archive files overlapping
+    the _id range (lower_id, upper_id], in _id order. Ids are hex strings or
+    ObjectIds; None leaves that side open.
+    """
+    lower = str(lower_id) if lower_id else None
+    upper = str(upper_id) if upper_id else None
+    files = []
+    if not os.path.isdir(directory):
+        return files
+    for name in os.listdir(directory):
+        if not name.endswith(SUFFIX):
+            continue
+        first_id, last_id = name[:-len(SUFFIX)].split("_")
+        if (lower is None or last_id > lower) and (upper is None or first_id <= upper):
+            files.append((first_id, last_id, os.path.join(directory, name)))
+    return sorted(files)
+
+
+def read_file(path):
+    """
+    Memory-maps an archive file; the returned table's buffers point into
+    the mapping.
+    """
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_range(directory, lower_id=None, upper_id=None):
+    """
+    Yields one table per archive file, trimmed to the _id range
+    (lower_id, upper_id]. Batches archived twice (a retried load) are
+    yielded twice; the staging loaders skip duplicate mongo_ids.
+    """
+    lower = str(lower_id) if lower_id else None
+    upper = str(upper_id) if upper_id else None
+    for first_id, last_id, path in list_files(directory, lower, upper):
+        table = read_file(path)
+        mongo_ids = table.column("mongo_id")
+        if lower is not None and first_id <= lower:
+            table = table.filter(pc.greater(mongo_ids, lower))
+            mongo_ids = table.column("mongo_id")
+        if upper is not None and last_id > upper:
+            table = table.filter(pc.less_equal(mongo_ids, upper))
+        if table.num_rows:
+            yield table
+
+
+def write_csv(table, buf):
+    """
+    Writes 'table' to the binary file 'buf' as headerless CSV, in the column
+    order of the staging loaders.
+    """
+    pyarrow.csv.write_csv(table, buf, pyarrow.csv.WriteOptions(include_header=False))
@@ -0,0 +1,322 @@
+"""
+Backfill mode: defer foreign keys and secondary indexes during bulk loads.
+
+A historical load into order_items or fact_sales pays for every foreign key
+check and every secondary index on every row. Backfill mode removes them for
+the duration of the load and puts them back in bulk afterwards:
+
+    begin(conn, tables)    record the tables' foreign keys and non-unique
+                           secondary indexes in sales_oltp.backfill_objects,
+                           then drop them (and optionally SET UNLOGGED)
+    ... load ...
+    finish(conn, tables)   SET LOGGED, rebuild the indexes in parallel, re-add
+                           the foreign keys NOT VALID and VALIDATE them
+
+Primary keys and unique indexes stay: they back the loaders' ON CONFLICT
+clauses (e.g. dim_date_date_val_hour_key, sales_staging_mongo_id_key), and
+dropping them would let retried batches insert duplicates.
+
+Every object is restored in its own transaction together with its state row,
+so an interrupted finish() is resumed by running it again; it only touches
+what is still recorded as dropped (or, for a foreign key, added but not yet
+validated).
+
+SET UNLOGGED is only applied to tables that are empty when the backfill
+starts, and only for tables fed from sales_staging (order_items). A crash
+truncates unlogged tables while the staging rows they were loaded from stay
+consumed, so begin() records the first staging id the backfill consumes, and
+begin()/finish() check whether the server restarted since: if so, every
+staging row from that id on is put back as unprocessed (unmarked, or moved
+back from sales_staging_archive) and the next load normalizes it again. The
+OLTP upserts are idempotent, so rows that survived in the logged tables are
+not duplicated. Partitioned tables (fact_sales) cannot be switched as a whole
+and stay logged.
+
+    PYTHONPATH=. python scripts/oltp_load/staging_oltp.py --backfill --unlogged --workers 4
+    PYTHONPATH=. python scripts/oltp_load/staging_oltp.py --backfill-finish
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from config.connections import PG_POOL_MAX_SIZE, pg_connection
+
+logger = logging.getLogger(__name__)
+
+STATE_TABLE = "sales_oltp.backfill_objects"
+
+# Memory for each index build and foreign key validation.
+MAINTENANCE_WORK_MEM = os.environ.get("ETL_MAINTENANCE_WORK_MEM", "1GB")
+
+SECONDARY_INDEXES_QUERY = """
+    SELECT c.relname, pg_get_indexdef(i.indexrelid)
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = %s::regclass
+      AND NOT i.indisunique
+      AND NOT i.indisprimary
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid)
+"""
+
+FOREIGN_KEYS_QUERY = """
+    SELECT conname, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE conrelid = %s::regclass AND contype = 'f'
+"""
+
+RECORD_OBJECT = f"""
+    INSERT INTO {STATE_TABLE} (table_name, object_name, kind, definition, status)
+    VALUES (%s, %s, %s, %s, 'dropped')
+    ON CONFLICT (table_name, object_name)
+    DO UPDATE SET kind = EXCLUDED.kind, definition = EXCLUDED.definition,
+                  status = 'dropped', recorded_at = now()
+"""
+
+SET_STATUS = f"""
+    UPDATE {STATE_TABLE} SET status = %s
+    WHERE table_name = %s AND object_name = %s
+"""
+
+SET_WORK_MEM = "SELECT set_config('maintenance_work_mem', %s, true)"
+
+# First staging id an UNLOGGED backfill consumes: everything below the lowest
+# unprocessed row was consumed before the backfill started.
+FIRST_STAGED_ID = """
+    SELECT COALESCE(
+        (SELECT MIN(id) FROM sales_oltp.sales_staging WHERE processed = false),
+        GREATEST(
+            (SELECT MAX(id) FROM sales_oltp.sales_staging),
+            (SELECT MAX(id) FROM sales_oltp.sales_staging_archive)
+        ) + 1,
+        1
+    )
+"""
+
+# UNLOGGED tables truncated by a crash: their 'logged' rows were recorded
+# before the server last started.
+CRASHED_UNLOGGED = f"""
+    SELECT table_name, object_name, definition
+    FROM {STATE_TABLE}
+    WHERE kind = 'logged' AND status <> 'restored' AND definition IS NOT NULL
+      AND table_name = ANY(%s)
+      AND recorded_at < pg_postmaster_start_time()
+"""
+
+RESTAGE_QUERIES = (
+    """
+    UPDATE sales_oltp.sales_staging
+       SET processed = false
+     WHERE id >= %(first_id)s AND processed
+    """,
+    """
+    WITH restaged AS (
+        DELETE FROM sales_oltp.sales_staging_archive
+         WHERE id >= %(first_id)s
+        RETURNING id, mongo_id, event_time, order_id, product_id, category_id,
+                  category_code, brand, price, user_id
+    )
+    INSERT INTO sales_oltp.sales_staging (
+        id, mongo_id, event_time, order_id, product_id, category_id,
+        category_code, brand, price, user_id, processed
+    )
+    SELECT *, false FROM restaged
+    """,
+)
+
+TOUCH_OBJECT = f"""
+    UPDATE {STATE_TABLE} SET recorded_at = now()
+    WHERE table_name = %s AND object_name = %s
+"""
+
+PENDING_OBJECTS = f"""
+    SELECT table_name, object_name, kind, definition, status
+    FROM {STATE_TABLE}
+    WHERE status <> 'restored' AND table_name = ANY(%s)
+    ORDER BY table_name, object_name
+"""
+
+
+def _schema(table):
+    return table.split(".", 1)[0]
+
+
+def _relkind(cur, table):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", (table,))
+    return cur.fetchone()[0]
+
+
+def _is_empty(cur, table):
+    cur.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})")
+    return cur.fetchone()[0]
+
+
+# ---------------------------------------------------------------------------
+# Entering backfill mode
+# ---------------------------------------------------------------------------
+
+def begin(conn, tables, unlogged=False):
+    """
+    Records and drops the foreign keys and non-unique secondary indexes of
+    'tables' in one transaction; with 'unlogged', also switches the empty,
+    unpartitioned ones to UNLOGGED. Objects dropped by an earlier, unfinished
+    backfill are no longer in the catalog and keep their recorded state.
+    """
+    recover(conn, tables)
+    cur = conn.cursor()
+    try:
+        dropped = 0
+        for table in tables:
+            cur.execute(FOREIGN_KEYS_QUERY, (table,))
+            for name, definition in cur.fetchall():
+                cur.execute(RECORD_OBJECT, (table, name, "foreign_key", definition))
+                cur.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+                dropped += 1
+
+            cur.execute(SECONDARY_INDEXES_QUERY, (table,))
+            for name, definition in cur.fetchall():
+                cur.execute(RECORD_OBJECT, (table, name, "index", definition))
+                cur.execute(f'DROP INDEX {_schema(table)}."{name}"')
+                dropped += 1
+
+            if unlogged:
+                if _relkind(cur, table) == "p":
+                    logger.info(f"{table} is partitioned; it stays logged.")
+                elif not _is_empty(cur, table):
+                    logger.warning(f"{table} already holds rows; it stays logged.")
+                else:
+                    cur.execute(FIRST_STAGED_ID)
+                    cur.execute(RECORD_OBJECT, (table, table, "logged", str(cur.fetchone()[0])))
+                    cur.execute(f"ALTER TABLE {table} SET UNLOGGED")
+                    logger.info(f"{table} is UNLOGGED until the backfill finishes.")
+        conn.commit()
+        logger.info(f"Backfill mode on for {', '.join(tables)}: dropped {dropped} foreign keys and indexes.")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+# ---------------------------------------------------------------------------
+# Crash recovery
+# ---------------------------------------------------------------------------
+
+def recover(conn, tables):
+    """
+    Puts back the staging rows loaded into any of 'tables' that a crash
+    truncated while UNLOGGED, in one transaction. Returns the number of
+    staging rows made unprocessed again.
+    """
+    cur = conn.cursor()
+    try:
+        total = 0
+        cur.execute(CRASHED_UNLOGGED, (list(tables),))
+        for table, name, first_id in cur.fetchall():
+            restaged = 0
+            for query in RESTAGE_QUERIES:
+                cur.execute(query, {"first_id": int(first_id)})
+                restaged += cur.rowcount
+            # This restart is handled; only a later one is a new crash.
+            cur.execute(TOUCH_OBJECT, (table, name))
+            logger.warning(
+                f"The server restarted while {table} was UNLOGGED; re-staged {restaged} staging rows "
+                f"from id {first_id} on. Normalize them again to reload it."
+            )
+            total += restaged
+        conn.commit()
+        return total
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+# ---------------------------------------------------------------------------
+# Leaving backfill mode
+# ---------------------------------------------------------------------------
+
+def _restore(table, name, kind, definition, status):
+    """
+    Restores one recorded object on its own pooled connection; the object
+    and its state row change in the same transaction.
+    """
+    with pg_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(SET_WORK_MEM, (MAINTENANCE_WORK_MEM,))
+            if kind == "index":
+                # Indexes of partitioned tables are reported as "ON ONLY",
+                # which would create an empty, invalid parent index.
+                cur.execute(definition.replace(" ON ONLY ", " ON ", 1))
+                cur.execute(SET_STATUS, ("restored", table, name))
+            elif kind == "logged":
+                cur.execute(f"ALTER TABLE {table} SET LOGGED")
+                cur.execute(SET_STATUS, ("restored", table, name))
+            elif _relkind(cur, table) == "p":
+                # Partitioned tables do not take NOT VALID foreign keys; the
+                # constraint is checked while it is added.
+                cur.execute(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}')
+                cur.execute(SET_STATUS, ("restored", table, name))
+            else:
+                if status == "dropped":
+                    # Adding NOT VALID only takes a brief lock; VALIDATE then
+                    # scans the table without blocking writes.
+                    cur.execute(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition} NOT VALID')
+                    cur.execute(SET_STATUS, ("added", table, name))
+                    conn.commit()
+                    cur.execute(SET_WORK_MEM, (MAINTENANCE_WORK_MEM,))
+                cur.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT "{name}"')
+                cur.execute(SET_STATUS, ("restored", table, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    logger.info(f"Restored {kind} {name} on {table}.")
+
+
+def _restore_all(objects, workers):
+    if not objects:
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(objects))) as pool:
+        for future in [pool.submit(_restore, *obj) for obj in objects]:
+            future.result()
+
+
+def pending(conn, tables):
+    """
+    Returns the recorded objects of 'tables' not restored yet, as
+    (table_name, object_name, kind, definition, status) tuples.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(PENDING_OBJECTS, (list(tables),))
+        rows = cur.fetchall()
+        conn.commit()
+        return rows
+    finally:
+        cur.close()
+
+
+def finish(conn, tables, workers=4):
+    """
+    Restores everything begin() dropped from 'tables': tables back to LOGGED
+    first, then the indexes with 'workers' concurrent builds, then the
+    foreign keys, validated concurrently. Safe to rerun after an interruption.
+    Staging rows lost by a crash of an UNLOGGED table are re-staged first.
+    """
+    recover(conn, tables)
+    objects = pending(conn, tables)
+    if not objects:
+        logger.info("No backfill objects left to restore.")
+        return
+    # The caller keeps one pooled connection open; leave it room.
+    workers = max(1, min(workers, PG_POOL_MAX_SIZE - 1))
+    logger.info(f"Restoring {len(objects)} backfill objects with {workers} workers...")
+    # SET LOGGED rewrites the table and its indexes, so it goes before the
+    # index builds; foreign keys are validated last, against the final tables.
+    for kind in ("logged", "index", "foreign_key"):
+        _restore_all([obj for obj in objects if obj[2] == kind], workers)
+    logger.info("Backfill mode off: all foreign keys and indexes restored.")
@@ -0,0 +1,161 @@
+"""
+Adaptive batch sizing shared by the loaders.
+
+An AdaptiveBatchSizer starts at the configured batch size and adjusts it
+after every batch from what the batch cost:
+
+- memory: above the memory budget it never grows, and it halves while the
+  process RSS keeps rising
+- latency: a batch slower than 1.5x the target latency shrinks the size in
+  proportion (at most by half)
+- throughput: a batch faster than half the target grows the size by 1.5x; if
+  the grown size turns out slower in rows/s than the previous one, the sizer
+  steps back and does not try to grow again for a while
+
+Sizes stay within [minimum, maximum]. Every change is logged with its reason.
+Loaders read 'size' before fetching a batch and call record() once the batch
+is committed:
+
+    sizer = AdaptiveBatchSizer("oltp", initial=10000)
+    while True:
+        rows = process(batch_size=sizer.size)
+        if not rows:
+            break
+        sizer.record(rows)
+
+A loader that fetches ahead (the pipelined staging loader) reads 'size' on
+its fetch thread while its load thread calls record(), and already queued
+batches were fetched at an older size. It passes each batch's fetch size to
+record(), so batches fetched before the last resize are only timed and the
+next decision waits for a batch of the current size.
+"""
+import logging
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+MIN_BATCH_SIZE = int(os.environ.get("ETL_BATCH_MIN", 1000))
+MAX_BATCH_SIZE = int(os.environ.get("ETL_BATCH_MAX", 200000))
+TARGET_SECONDS = float(os.environ.get("ETL_BATCH_TARGET_SECONDS", 2.0))
+MEMORY_BUDGET_MB = float(os.environ["ETL_MEMORY_BUDGET_MB"]) if os.environ.get("ETL_MEMORY_BUDGET_MB") else None
+
+GROWTH = 1.5
+# Batches after a failed growth attempt before growing is tried again.
+GROWTH_COOLDOWN = 10
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process in MB, or its peak where the current
+    value is not available, or None.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class AdaptiveBatchSizer:
+    """
+    Batch size controller for one loader. record() is only called from one
+    thread; other threads may read 'size', which is replaced, never mutated.
+    """
+
+    def __init__(self, name, initial=10000, minimum=None, maximum=None,
+                 target_seconds=None, memory_budget_mb=None):
+        self.name = name
+        self.minimum = minimum or MIN_BATCH_SIZE
+        self.maximum = max(maximum or MAX_BATCH_SIZE, self.minimum)
+        self.target_seconds = target_seconds or TARGET_SECONDS
+        self.memory_budget_mb = memory_budget_mb or MEMORY_BUDGET_MB
+        self.size = self._clamp(initial)
+        self.previous = None     # (size, rows/s) before the last growth
+        self.cooldown = 0
+        self.last_rss = None
+        self.batch_start = time.perf_counter()
+
+    def _clamp(self, size):
+        return int(max(self.minimum, min(self.maximum, size)))
+
+    def _resize(self, size, reason):
+        size = self._clamp(size)
+        if size != self.size:
+            logger.info(f"Batch size for {self.name}: {self.size} -> {size} ({reason}).")
+            self.size = size
+
+    def restart_clock(self):
+        """
+        Starts timing the next batch now, e.g. after an idle wait.
+        """
+        self.batch_start = time.perf_counter()
+
+    def record(self, rows, seconds=None, size=None):
+        """
+        Feeds back one finished batch of 'rows' rows. 'seconds' defaults to
+        the time since the previous record() (or restart_clock()). 'size' is
+        the batch size the batch was fetched at, when it may predate the last
+        resize; such a batch does not change the size. Returns the size to use
+        for the next batch.
+        """
+        now = time.perf_counter()
+        if seconds is None:
+            seconds = now - self.batch_start
+        self.batch_start = now
+        if rows <= 0 or seconds <= 0 or (size is not None and size != self.size):
+            return self.size
+
+        rows_per_second = rows / seconds
+        rss = current_rss_mb()
+        rss_rising = rss is not None and self.last_rss is not None and rss > self.last_rss
+        self.last_rss = rss
+        over_budget = self.memory_budget_mb is not None and rss is not None and rss > self.memory_budget_mb
+        # A short final batch says little about the configured size.
+        full_batch = rows >= self.size * 0.9
+        self.cooldown = max(0, self.cooldown - 1)
+
+        if over_budget:
+            self.previous = None
+            if rss_rising:
+                self._resize(self.size // 2, f"RSS {rss:.0f} MB over the {self.memory_budget_mb:.0f} MB budget")
+        elif seconds > self.target_seconds * 1.5:
+            self.previous = None
+            factor = max(0.5, self.target_seconds / seconds)
+            self._resize(self.size * factor, f"{seconds:.2f}s per batch, target {self.target_seconds:.2f}s")
+        elif self.previous is not None and full_batch:
+            previous_size, previous_rate = self.previous
+            self.previous = None
+            if rows_per_second < previous_rate * 0.95:
+                self.cooldown = GROWTH_COOLDOWN
+                self._resize(
+                    previous_size,
+                    f"{rows_per_second:.0f} rows/s after growing, {previous_rate:.0f} rows/s before"
+                )
+        elif full_batch and seconds < self.target_seconds * 0.5 and not self.cooldown:
+            if self.size < self.maximum:
+                self.previous = (self.size, rows_per_second)
+                self._resize(
+                    self.size * GROWTH,
+                    f"{seconds:.2f}s per batch at {rows_per_second:.0f} rows/s, target {self.target_seconds:.2f}s"
+                )
+        return self.size
+
+
+def make_sizer(name, batch_size, adaptive):
+    """
+    An AdaptiveBatchSizer starting at 'batch_size' when 'adaptive' is set,
+    otherwise None (fixed batch sizes).
+    """
+    return AdaptiveBatchSizer(name, initial=batch_size) if adaptive else None
@@ -0,0 +1,101 @@
+"""
+Checkpoints of every pipeline stage, stored in sales_oltp.etl_metadata.
+
+A checkpoint is one etl_metadata row: 'name' is its table_name and 'value'
+its last_processed_id (a Mongo _id hex string, or an order_id / staging id
+as text). None of these functions commit. A loader saves its checkpoint with
+the same cursor that wrote the batch, so one commit makes both durable: a
+restart resumes exactly after the last committed batch, and a crash before
+the commit loses both the batch and the checkpoint.
+
+    rows = write(cur, batch)
+    checkpoint.save(cur, "sales_staging", batch[-1]["_id"])
+    conn.commit()
+
+Marker rows (partition plans, completed shards, stale rollup months) use the
+same table with a name prefix and, usually, no value.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+TABLE = "sales_oltp.etl_metadata"
+
+
+def load(cur, name):
+    """
+    Returns the stored value of checkpoint 'name', or None.
+    """
+    cur.execute(f"SELECT last_processed_id FROM {TABLE} WHERE table_name = %s", (name,))
+    result = cur.fetchone()
+    return result[0] if result and result[0] else None
+
+
+def load_resume_token(cur, name):
+    """
+    Returns the change stream resume token (extended JSON) stored with
+    checkpoint 'name', or None.
+    """
+    cur.execute(f"SELECT resume_token FROM {TABLE} WHERE table_name = %s", (name,))
+    result = cur.fetchone()
+    return result[0] if result and result[0] else None
+
+
+def save(cur, name, value, resume_token=None, monotonic=False):
+    """
+    Sets checkpoint 'name' to 'value' (stored as text). With 'monotonic' the
+    stored value never moves back; only use it for fixed-width values such
+    as ObjectId hex strings, which compare as text in their natural order.
+    'resume_token' is stored alongside when given.
+    """
+    new_value = "GREATEST(etl_metadata.last_processed_id, EXCLUDED.last_processed_id)" if monotonic \
+        else "EXCLUDED.last_processed_id"
+    if resume_token is None:
+        # Only --tail stores tokens; the other loaders never name the column.
+        cur.execute(f"""
+            INSERT INTO {TABLE} (table_name, last_processed_id)
+            VALUES (%s, %s)
+            ON CONFLICT (table_name)
+            DO UPDATE SET last_processed_id = {new_value}
+        """, (name, None if value is None else str(value)))
+        return
+    cur.execute(f"""
+        INSERT INTO {TABLE} (table_name, last_processed_id, resume_token)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (table_name)
+        DO UPDATE SET last_processed_id = {new_value},
+                      resume_token = EXCLUDED.resume_token
+    """, (name, None if value is None else str(value), resume_token))
+
+
+def mark(cur, name, value=None):
+    """
+    Creates marker row 'name' unless it already exists.
+    """
+    cur.execute(f"""
+        INSERT INTO {TABLE} (table_name, last_processed_id)
+        VALUES (%s, %s)
+        ON CONFLICT (table_name) DO NOTHING
+    """, (name, None if value is None else str(value)))
+
+
+def names(cur, prefix):
+    """
+    Returns the sorted names of the rows starting with 'prefix'.
+    """
+    # Backslash is LIKE's escape character, so it is escaped first.
+    pattern = prefix.replace("\\", "\\\\").replace("%", r"\%").replace("_", r"\_") + "%"
+    cur.execute(f"""
+        SELECT table_name
+        FROM {TABLE}
+        WHERE table_name LIKE %s
+        ORDER BY table_name
+    """, (pattern,))
+    return [name for (name,) in cur.fetchall()]
+
+
+def delete(cur, names):
+    """
+    Removes the rows named in 'names'.
+    """
+    cur.execute(f"DELETE FROM {TABLE} WHERE table_name = ANY(%s)", (list(names),))
@@ -0,0 +1,136 @@
+"""
+Columnar in-memory batches shared by the transform stages.
+
+A ColumnBatch keeps one NumPy array per column instead of a tuple per row,
+so a batch of N rows costs a handful of contiguous arrays rather than N
+Python tuples, and dedup / key mapping run as vectorized sorts and lookups.
+"""
+from itertools import islice
+
+import numpy as np
+
+# Schemas are sequences of (column name, dtype, default). When a default is
+# given, falsy values are replaced by it, matching the "value or default"
+# handling the row-based code applies.
+
+
+class ColumnBatch:
+    """
+    A batch of rows stored column-wise as equally long NumPy arrays.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, rows, schema, block_size=65536):
+        """
+        Builds a batch from an iterable of row tuples laid out as 'schema'.
+        Rows are consumed 'block_size' at a time, so a generator (such as a
+        server-side cursor) is never held in memory as a list of tuples.
+        """
+        rows = iter(rows)
+        blocks = {name: [] for name, _, _ in schema}
+        while True:
+            block = list(islice(rows, block_size))
+            if not block:
+                break
+            for (name, dtype, default), values in zip(schema, zip(*block)):
+                if default is not None:
+                    values = [v or default for v in values]
+                blocks[name].append(np.array(values, dtype=dtype))
+
+        columns = {}
+        for name, dtype, _ in schema:
+            parts = blocks[name]
+            if len(parts) == 1:
+                columns[name] = parts[0]
+            elif parts:
+                columns[name] = np.concatenate(parts)
+            else:
+                columns[name] = np.array([], dtype=dtype)
+        return cls(columns)
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), ()))
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def take(self, indices):
+        return ColumnBatch({name: col[indices] for name, col in self.columns.items()})
+
+    def filter(self, mask):
+        return self.take(np.flatnonzero(mask))
+
+    def rows(self, *names):
+        """
+        Returns the selected columns as a list of tuples of Python scalars,
+        ready for execute_values.
+        """
+        return list(zip(*(self.columns[name].tolist() for name in names)))
+
+    def unique_by(self, key, prefer=None):
+        """
+        Keeps one row per value of 'key': the first row in batch order, or the
+        first row where 'prefer' is True when such a row exists.
+        """
+        positions = np.arange(len(self))
+        sort_keys = [positions]
+        if prefer is not None:
+            sort_keys.append(~np.asarray(prefer, dtype=bool))
+        sort_keys.append(self.columns[key])
+        order = np.lexsort(sort_keys)
+        return self.take(order[_group_starts(self.columns[key][order])])
+
+    def latest_by(self, key, order_by):
+        """
+        Keeps one row per value of 'key': the row with the greatest 'order_by'
+        value, the earliest such row on ties ("latest wins").
+        """
+        positions = np.arange(len(self))
+        descending = -_sortable(self.columns[order_by])
+        order = np.lexsort((positions, descending, self.columns[key]))
+        return self.take(order[_group_starts(self.columns[key][order])])
+
+    def distinct(self, *names):
+        """
+        Keeps the first row of every distinct combination of 'names'.
+        """
+        order = np.lexsort([np.arange(len(self))] + [self.columns[n] for n in reversed(names)])
+        starts = np.zeros(len(order), dtype=bool)
+        if len(order):
+            starts[0] = True
+            for name in names:
+                col = self.columns[name][order]
+                starts[1:] |= col[1:] != col[:-1]
+        return self.take(np.sort(order[starts]))
+
+
+def _group_starts(sorted_keys):
+    starts = np.ones(len(sorted_keys), dtype=bool)
+    starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return starts
+
+
+def _sortable(column):
+    # datetime64 columns cannot be negated directly; their int64 view sorts
+    # the same way.
+    if np.issubdtype(column.dtype, np.datetime64):
+        return column.view("int64")
+    return column
+
+
+def map_keys(keys, lookup, missing=0):
+    """
+    Maps an array of natural keys to surrogate keys through 'lookup' (any
+    object with a dict-style get). Each distinct key is looked up once and the
+    result is broadcast back with the unique inverse index; keys without a
+    mapping get 'missing'.
+    """
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    mapped = np.fromiter(
+        (lookup.get(k, missing) for k in unique_keys.tolist()),
+        dtype=np.int64, count=len(unique_keys)
+    )
+    return mapped[inverse]
@@ -0,0 +1,79 @@
+"""
+Instrumented psycopg2 cursor for the pipeline's pooled connections.
+
+config.connections only knows how to open connections; the loaders call
+install() when they are imported, so every pooled connection opened
+afterwards in that process (and in worker processes, which import the
+loaders again) counts its round trips into scripts.common.metrics and feeds
+scripts.common.plans.
+"""
+import time
+
+from psycopg2.extensions import cursor as _cursor
+
+from config import connections
+from scripts.common import metrics, plans
+
+
+class InstrumentedCursor(_cursor):
+    """
+    Cursor that counts every statement and server-side FETCH as a round trip
+    of the current metrics stage, together with the bytes sent.
+    """
+
+    def execute(self, query, vars=None):
+        profile = plans.capture(self, query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.current_stage().add_round_trip(len(self.query or b""))
+            if profile is not None:
+                plans.observe(profile, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = file.tell() if file.seekable() else 0
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            sent = file.tell() - start if file.seekable() else 0
+            metrics.current_stage().add_round_trip(len(sql) + sent)
+
+    def fetchone(self):
+        self._count_fetch()
+        return super().fetchone()
+
+    def fetchmany(self, size=None):
+        self._count_fetch()
+        return super().fetchmany(self.arraysize if size is None else size)
+
+    def fetchall(self):
+        self._count_fetch()
+        return super().fetchall()
+
+    def __iter__(self):
+        if self.name is None:
+            return super().__iter__()
+        return self._iter_named()
+
+    def _iter_named(self):
+        # psycopg2 iterates named cursors in C; page through fetchmany instead
+        # so each FETCH of 'itersize' rows is counted.
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def _count_fetch(self):
+        # Only named cursors go back to the server to fetch; a client-side
+        # cursor already holds the whole result after execute().
+        if self.name is not None:
+            metrics.current_stage().add_round_trip()
+
+
+def install():
+    """
+    Makes InstrumentedCursor the cursor class of pooled connections.
+    """
+    connections.set_cursor_factory(InstrumentedCursor)
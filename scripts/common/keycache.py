@@ -0,0 +1,219 @@
+"""
+Bounded natural key -> surrogate key cache for the fact loader.
+
+Recently used mappings live in two in-memory segments: lookups hit the
+'recent' segment first, then the 'older' one (promoting the entry back to
+'recent'). When 'recent' fills up, 'older' is dropped wholesale and 'recent'
+takes its place, which approximates LRU at O(1) cost and caps memory at
+'capacity' entries.
+
+A cache can also be backed by a snapshot file of sorted int64 keys and
+values. The snapshot is memory-mapped read-only and binary-searched, so a
+new run starts warm without loading the whole mapping into Python objects.
+Saving merges the snapshot with the in-memory segments in one streaming pass.
+
+A snapshot records the 'generation' of the dimension it was taken from (any
+64-bit value that changes when the dimension's surrogate keys are
+reassigned, e.g. by a TRUNCATE and reload). A snapshot of another generation
+is discarded when the cache opens it.
+"""
+import logging
+import mmap
+import os
+import shutil
+import struct
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+_SNAPSHOT_MAGIC = b"SKC2"
+_HEADER = struct.Struct("<4sQQ")  # magic, generation, count
+
+# Entries written per block while saving a snapshot.
+_WRITE_BLOCK = 65536
+
+
+class SurrogateKeyCache:
+    """
+    Bounded int -> int cache with hit/miss statistics and an optional
+    memory-mapped snapshot of dimension generation 'generation'.
+    """
+
+    def __init__(self, name, capacity=1_000_000, snapshot_path=None, generation=0):
+        self.name = name
+        self.segment_size = max(1, capacity // 2)
+        self.snapshot_path = snapshot_path
+        self.generation = generation
+        self.recent = {}
+        self.older = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._snapshot_file = None
+        self._snapshot_map = None
+        self._snapshot_keys = ()
+        self._snapshot_values = ()
+        if snapshot_path and os.path.exists(snapshot_path):
+            self._open_snapshot(snapshot_path)
+
+    def __len__(self):
+        return len(self.recent) + len(self.older) + len(self._snapshot_keys)
+
+    def get(self, key, default=None):
+        value = self.recent.get(key)
+        if value is not None:
+            return value
+        value = self.older.pop(key, None)
+        if value is not None:
+            self._put_recent(key, value)
+            return value
+        value = self._snapshot_get(key)
+        return default if value is None else value
+
+    def put(self, key, value):
+        self.older.pop(key, None)
+        self._put_recent(key, value)
+
+    def update(self, pairs):
+        for key, value in pairs:
+            self.put(key, value)
+
+    def lookup_many(self, keys):
+        """
+        Resolves 'keys' from the cache. Returns a dict of the mappings found
+        and a list of keys that have to be looked up in the database.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self.recent) + len(self.older),
+            "snapshot_entries": len(self._snapshot_keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def save_snapshot(self, path=None):
+        """
+        Writes every known mapping (snapshot plus in-memory segments) to a new
+        snapshot file, replacing the old one atomically. The sorted snapshot
+        arrays are merged with the sorted in-memory entries block by block,
+        so only the in-memory segments are ever held as Python objects.
+        """
+        path = path or self.snapshot_path
+        if not path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        values_path = f"{path}.values.tmp"
+        count = 0
+        with open(tmp_path, "wb") as f, open(values_path, "w+b") as values_file:
+            f.write(_HEADER.pack(_SNAPSHOT_MAGIC, self.generation, 0))
+            keys, values = array("q"), array("q")
+            for key, value in self._merged_items():
+                keys.append(key)
+                values.append(value)
+                if len(keys) >= _WRITE_BLOCK:
+                    count += len(keys)
+                    keys.tofile(f)
+                    values.tofile(values_file)
+                    keys, values = array("q"), array("q")
+            count += len(keys)
+            keys.tofile(f)
+            values.tofile(values_file)
+
+            values_file.seek(0)
+            shutil.copyfileobj(values_file, f)
+            f.seek(0)
+            f.write(_HEADER.pack(_SNAPSHOT_MAGIC, self.generation, count))
+        os.remove(values_path)
+        self.close()
+        os.replace(tmp_path, path)
+        self._open_snapshot(path)
+        logger.info(f"Saved {count} {self.name} keys to {path}.")
+
+    def close(self):
+        self._snapshot_keys = ()
+        self._snapshot_values = ()
+        if self._snapshot_map is not None:
+            self._snapshot_map.close()
+            self._snapshot_map = None
+        if self._snapshot_file is not None:
+            self._snapshot_file.close()
+            self._snapshot_file = None
+
+    def _merged_items(self):
+        """
+        Yields every (key, value) in key order; in-memory entries override
+        the snapshot's.
+        """
+        memory = dict(self.older)
+        memory.update(self.recent)
+        memory_keys = sorted(memory)
+        snapshot_keys, snapshot_values = self._snapshot_keys, self._snapshot_values
+        i = 0
+        for key in memory_keys:
+            while i < len(snapshot_keys) and snapshot_keys[i] < key:
+                yield snapshot_keys[i], snapshot_values[i]
+                i += 1
+            if i < len(snapshot_keys) and snapshot_keys[i] == key:
+                i += 1
+            yield key, memory[key]
+        for j in range(i, len(snapshot_keys)):
+            yield snapshot_keys[j], snapshot_values[j]
+
+    def _put_recent(self, key, value):
+        if len(self.recent) >= self.segment_size:
+            self.evictions += len(self.older)
+            self.older = self.recent
+            self.recent = {}
+        self.recent[key] = value
+
+    def _snapshot_get(self, key):
+        keys = self._snapshot_keys
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return self._snapshot_values[i]
+        return None
+
+    def _open_snapshot(self, path):
+        f = open(path, "rb")
+        size = os.fstat(f.fileno()).st_size
+        if size < _HEADER.size:
+            f.close()
+            logger.warning(f"Ignoring truncated key cache snapshot {path}.")
+            return
+        snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, generation, count = _HEADER.unpack_from(snapshot)
+        if magic != _SNAPSHOT_MAGIC or size != _HEADER.size + 16 * count:
+            snapshot.close()
+            f.close()
+            logger.warning(f"Ignoring invalid key cache snapshot {path}.")
+            return
+        if generation != self.generation:
+            snapshot.close()
+            f.close()
+            logger.info(f"Discarding {self.name} key cache snapshot {path}: the dimension was rebuilt since.")
+            return
+        view = memoryview(snapshot)
+        keys_end = _HEADER.size + 8 * count
+        self._snapshot_file = f
+        self._snapshot_map = snapshot
+        self._snapshot_keys = view[_HEADER.size:keys_end].cast("q")
+        self._snapshot_values = view[keys_end:].cast("q")
+        logger.info(f"Opened {count} {self.name} keys from snapshot {path}.")
@@ -0,0 +1,405 @@
+"""
+In-process metrics shared by all pipeline stages.
+
+Every stage ("staging", "oltp", "olap") records into its StageMetrics: row,
+byte and batch counters, a latency histogram per phase (extract, transform,
+load, commit), the number of database round trips and hit/miss counts per
+cache. The registry is per process; worker processes return snapshot() to
+their parent, which folds it in with merge().
+
+export() writes the registry as a JSON summary and as a Prometheus textfile
+(for node_exporter's textfile collector), so throughput can be graphed and
+alerted on:
+
+    with metrics.stage("staging") as m:
+        with m.phase("extract"):
+            batch = fetch()
+        m.add_batch(len(batch))
+    metrics.export("/var/lib/node_exporter")
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the phase latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS_DIR = os.environ.get("ETL_METRICS_DIR")
+JSON_FILE = "etl_metrics.json"
+PROMETHEUS_FILE = "etl_metrics.prom"
+
+_lock = threading.Lock()
+_stages = {}
+_bound = threading.local()
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram; counts[i] holds observations <= buckets[i] and
+    above the previous bound, the last slot everything above the last bound.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile (None when empty).
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    def merge(self, data):
+        for i, count in enumerate(data["counts"]):
+            self.counts[i] += count
+        self.sum += data["sum"]
+        self.count += data["count"]
+
+
+class CacheStats:
+    """
+    Plain hit/miss counters, cheap enough to bump once per row.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class _PhaseTimer:
+    seconds = 0.0
+
+
+class StageMetrics:
+    """
+    Counters and phase histograms of one pipeline stage. Used as a context
+    manager it becomes the calling thread's current stage, which is where
+    database round trips are attributed. Worker threads of one stage record
+    into it concurrently, so every update holds the stage's lock.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.rows = 0
+        self.bytes = 0
+        self.batches = 0
+        self.round_trips = 0
+        self.phases = {}
+        self.caches = {}
+        self.started = None
+        self.updated = None
+
+    def reset(self):
+        with self._lock:
+            self.rows = self.bytes = self.batches = self.round_trips = 0
+            self.phases = {}
+            self.started = self.updated = None
+            # CacheStats objects are held by callers, so zero them in place.
+            for stats in self.caches.values():
+                stats.hits = stats.misses = 0
+
+    def __enter__(self):
+        stack = getattr(_bound, "stack", None)
+        if stack is None:
+            stack = _bound.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _bound.stack.pop()
+
+    def _touch(self):
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        self.updated = now
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the block into the 'name' phase histogram. The yielded timer's
+        'seconds' is set when the block exits.
+        """
+        timer = _PhaseTimer()
+        with self._lock:
+            self._touch()
+        start = time.perf_counter()
+        with self:
+            try:
+                yield timer
+            finally:
+                timer.seconds = time.perf_counter() - start
+                self.observe(name, timer.seconds)
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram()
+            histogram.observe(seconds)
+            self._touch()
+
+    def timed(self, iterable, phase):
+        """
+        Yields from 'iterable', timing every step into 'phase'. Used for
+        lazily fetched sources, where the fetch happens inside next().
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe(phase, time.perf_counter() - start)
+            yield item
+
+    def add_batch(self, rows, nbytes=0):
+        with self._lock:
+            self.batches += 1
+            self.rows += rows
+            self.bytes += nbytes
+            self._touch()
+
+    def add_round_trip(self, nbytes=0):
+        with self._lock:
+            self.round_trips += 1
+            self.bytes += nbytes
+
+    def cache(self, name):
+        """
+        Returns the CacheStats for 'name'; callers bump its counters directly,
+        from one thread per CacheStats.
+        """
+        stats = self.caches.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self.caches.setdefault(name, CacheStats())
+        return stats
+
+    def record_cache(self, name, hits=0, misses=0):
+        stats = self.cache(name)
+        with self._lock:
+            stats.hits += hits
+            stats.misses += misses
+
+    def rows_per_second(self):
+        if not self.rows or self.started is None or self.updated <= self.started:
+            return 0.0
+        return self.rows / (self.updated - self.started)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "rows": self.rows,
+                "bytes": self.bytes,
+                "batches": self.batches,
+                "round_trips": self.round_trips,
+                "started": self.started,
+                "updated": self.updated,
+                "phases": {name: h.to_dict() for name, h in self.phases.items()},
+                "caches": {name: {"hits": c.hits, "misses": c.misses} for name, c in self.caches.items()},
+            }
+
+    def merge(self, data):
+        with self._lock:
+            self.rows += data["rows"]
+            self.bytes += data["bytes"]
+            self.batches += data["batches"]
+            self.round_trips += data["round_trips"]
+            for bound, pick in (("started", min), ("updated", max)):
+                theirs = data[bound]
+                if theirs is not None:
+                    ours = getattr(self, bound)
+                    setattr(self, bound, theirs if ours is None else pick(ours, theirs))
+            for name, histogram in data["phases"].items():
+                self.phases.setdefault(name, Histogram(histogram["buckets"])).merge(histogram)
+            for name, counts in data["caches"].items():
+                stats = self.caches.setdefault(name, CacheStats())
+                stats.hits += counts["hits"]
+                stats.misses += counts["misses"]
+
+
+def stage(name):
+    """
+    Returns the process-wide StageMetrics for 'name', creating it on first use.
+    """
+    metrics = _stages.get(name)
+    if metrics is None:
+        with _lock:
+            metrics = _stages.setdefault(name, StageMetrics(name))
+    return metrics
+
+
+def current_stage():
+    """
+    The innermost stage entered on this thread, or the "other" stage.
+    """
+    stack = getattr(_bound, "stack", None)
+    return stack[-1] if stack else stage("other")
+
+
+def snapshot():
+    with _lock:
+        return {name: metrics.to_dict() for name, metrics in _stages.items()}
+
+
+def reset():
+    """
+    Drops everything recorded so far. Pool workers call it before each task
+    so the snapshot they return only covers that task.
+    """
+    with _lock:
+        for metrics in _stages.values():
+            metrics.reset()
+
+
+def merge(data):
+    """
+    Folds a snapshot() taken in another process into this registry.
+    """
+    for name, stage_data in data.items():
+        stage(name).merge(stage_data)
+
+
+def summary():
+    """
+    JSON-friendly view of the registry with derived rates and quantiles.
+    """
+    result = {"generated_at": time.time(), "stages": {}}
+    with _lock:
+        stages = list(_stages.values())
+    for metrics in stages:
+        with metrics._lock:
+            result["stages"][metrics.name] = {
+                "rows": metrics.rows,
+                "bytes": metrics.bytes,
+                "batches": metrics.batches,
+                "round_trips": metrics.round_trips,
+                "rows_per_second": round(metrics.rows_per_second(), 1),
+                "phases": {
+                    name: {
+                        "count": h.count,
+                        "total_seconds": round(h.sum, 3),
+                        "p50_seconds": h.quantile(0.5),
+                        "p95_seconds": h.quantile(0.95),
+                        "p99_seconds": h.quantile(0.99),
+                    }
+                    for name, h in metrics.phases.items()
+                },
+                "caches": {
+                    name: {"hits": c.hits, "misses": c.misses, "hit_rate": round(c.hit_rate(), 4)}
+                    for name, c in metrics.caches.items()
+                },
+            }
+    return result
+
+
+def _prometheus_lines():
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        if not samples:
+            return
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+    with _lock:
+        stages = list(_stages.values())
+
+    for attr, help_text in (
+        ("rows", "Rows processed by the stage."),
+        ("bytes", "Bytes sent to PostgreSQL by the stage."),
+        ("batches", "Batches completed by the stage."),
+        ("round_trips", "Database round trips made by the stage."),
+    ):
+        family(f"etl_{attr}_total", "counter", help_text,
+               [({"stage": m.name}, getattr(m, attr)) for m in stages])
+
+    family("etl_rows_per_second", "gauge", "Average rows per second since the stage started.",
+           [({"stage": m.name}, round(m.rows_per_second(), 3)) for m in stages])
+    family("etl_last_update_timestamp_seconds", "gauge", "Last time the stage recorded anything.",
+           [({"stage": m.name}, m.updated) for m in stages if m.updated is not None])
+
+    histogram_samples = []
+    for m in stages:
+        with m._lock:
+            for phase, h in m.phases.items():
+                cumulative = 0
+                for bound, count in zip(h.buckets + (float("inf"),), h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    histogram_samples.append(("bucket", {"stage": m.name, "phase": phase, "le": le}, cumulative))
+                histogram_samples.append(("sum", {"stage": m.name, "phase": phase}, h.sum))
+                histogram_samples.append(("count", {"stage": m.name, "phase": phase}, h.count))
+    if histogram_samples:
+        lines.append("# HELP etl_phase_seconds Latency of one extract/transform/load/commit step.")
+        lines.append("# TYPE etl_phase_seconds histogram")
+        for suffix, labels, value in histogram_samples:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"etl_phase_seconds_{suffix}{{{label_text}}} {value}")
+
+    for attr in ("hits", "misses"):
+        family(f"etl_cache_{attr}_total", "counter", f"Cache {attr} by cache name.",
+               [({"stage": m.name, "cache": name}, getattr(c, attr))
+                for m in stages for name, c in m.caches.items()])
+    return lines
+
+
+def _write_atomic(path, text):
+    # The textfile collector may read at any moment; never expose a partial file.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json(path):
+    _write_atomic(path, json.dumps(summary(), indent=2, sort_keys=True) + "\n")
+
+
+def write_prometheus(path):
+    _write_atomic(path, "\n".join(_prometheus_lines()) + "\n")
+
+
+def export(directory=None):
+    """
+    Writes etl_metrics.json and etl_metrics.prom into 'directory' (default:
+    $ETL_METRICS_DIR). Does nothing when neither is set.
+    """
+    directory = directory or METRICS_DIR
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    write_json(os.path.join(directory, JSON_FILE))
+    write_prometheus(os.path.join(directory, PROMETHEUS_FILE))
@@ -0,0 +1,408 @@
+"""
+Query-plan profiler and index advisor for the pipeline's SQL.
+
+When profiling is enabled (enable(), or $ETL_PLAN_PROFILE_DIR), every
+statement run through config.connections' cursors is normalized (literals
+and VALUES lists folded away) and, the first time each normalized statement
+is seen in the process, also run under EXPLAIN (ANALYZE, BUFFERS, FORMAT
+JSON) inside a savepoint that is rolled back, so the sample batch is only
+written once. Every execution's latency is recorded as well.
+
+Each captured plan is checked for:
+
+- sequential scans reading at least SEQ_SCAN_MIN_ROWS rows
+- sorts that spilled to disk and hash joins that needed several batches
+- missing indexes: a large sequential scan filtered or joined on columns
+  that no index declared in sql/ddl/*.sql starts with
+
+export() writes plans-<time>-<pid>.json (plans, findings and latencies per
+statement) and a plain-text report with index recommendations and the plan
+and latency changes against the latest earlier profile of each statement:
+
+    ETL_PLAN_PROFILE_DIR=profiles PYTHONPATH=. python scripts/oltp_load/staging_oltp.py --batch-size 5000
+    less profiles/plans-*.txt
+
+Profiling runs each sampled statement twice and normalizes every statement;
+use it on a sample run, not in production.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from scripts.common import metrics
+
+logger = logging.getLogger(__name__)
+
+PLANS_DIR = os.environ.get("ETL_PLAN_PROFILE_DIR")
+DDL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "sql", "ddl")
+
+# Sequential scans reading fewer rows than this are not worth an index.
+SEQ_SCAN_MIN_ROWS = 1000
+# Latency changes reported between runs: at least this relative and absolute.
+LATENCY_CHANGE_RATIO = 0.25
+LATENCY_CHANGE_MS = 5.0
+
+EXPLAIN_PREFIX = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+EXPLAINABLE = ("select", "insert", "update", "delete", "with", "values")
+
+_lock = threading.Lock()
+_directory = PLANS_DIR
+_statements = {}
+
+
+class StatementProfile:
+    """
+    Sampled plan and observed latencies of one normalized statement.
+    """
+
+    def __init__(self, key, sql, stage):
+        self.key = key
+        self.sql = sql
+        self.stage = stage
+        self.plan = None
+        self.error = None
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def to_dict(self):
+        plan = self.plan or {}
+        root = plan.get("Plan", {})
+        return {
+            "sql": self.sql,
+            "stage": self.stage,
+            "calls": self.calls,
+            "mean_ms": round(self.total_seconds * 1000 / self.calls, 3) if self.calls else None,
+            "max_ms": round(self.max_seconds * 1000, 3),
+            "sample_execution_ms": plan.get("Execution Time"),
+            "sample_planning_ms": plan.get("Planning Time"),
+            "shared_hit_blocks": root.get("Shared Hit Blocks"),
+            "shared_read_blocks": root.get("Shared Read Blocks"),
+            "temp_written_blocks": root.get("Temp Written Blocks"),
+            "signature": plan_signature(root) if root else None,
+            "findings": analyze(root) if root else [],
+            "plan": self.plan,
+            "error": self.error,
+        }
+
+
+# ---------------------------------------------------------------------------
+# Capture
+# ---------------------------------------------------------------------------
+
+def enable(directory):
+    """
+    Turns profiling on for this process and for worker processes it starts.
+    """
+    global _directory
+    _directory = directory
+    os.environ["ETL_PLAN_PROFILE_DIR"] = directory
+
+
+def enabled():
+    return bool(_directory)
+
+
+def normalize(query):
+    """
+    The statement text with literals, VALUES rows and arrays folded, so the
+    pages of one execute_values call or batches with different ids share a
+    key.
+    """
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    sql = re.sub(r"--[^\n]*", " ", query)
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"%\(\w+\)s|%s", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"(?i)ARRAY\[[^\]]*\]", "ARRAY[...]", sql)
+    sql = re.sub(r"\(\s*\?(?:\s*(?:::\s*\w+)?\s*,\s*\?)*\s*(?:::\s*\w+)?\s*\)", "(...)", sql)
+    sql = re.sub(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+", "(...)", sql)
+    return " ".join(sql.split())
+
+
+def _explainable(sql):
+    first = sql.lstrip("( ").split(" ", 1)[0].lower()
+    return first in EXPLAINABLE
+
+
+def capture(cur, query, vars=None):
+    """
+    Called before 'cur' executes 'query'. Samples the plan of a statement
+    seen for the first time and returns its StatementProfile for observe(),
+    or None when profiling is off or the query cannot be profiled.
+    """
+    if not _directory or not isinstance(query, (str, bytes)):
+        return None
+    sql = normalize(query)
+    key = hashlib.sha1(sql.encode()).hexdigest()[:12]
+    with _lock:
+        profile = _statements.get(key)
+        first = profile is None
+        if first:
+            profile = _statements[key] = StatementProfile(key, sql, metrics.current_stage().name)
+    if first and _explainable(sql):
+        _sample_plan(cur.connection, profile, query, vars)
+    return profile
+
+
+def _sample_plan(conn, profile, query, vars):
+    # Imported here so the plan analysis can be used without psycopg2.
+    from psycopg2.extensions import cursor as _plain_cursor
+
+    prefix = EXPLAIN_PREFIX.encode() if isinstance(query, bytes) else EXPLAIN_PREFIX
+    # A plain cursor, so the EXPLAIN is neither profiled nor counted as a
+    # round trip of the stage.
+    with conn.cursor(cursor_factory=_plain_cursor) as cur:
+        cur.execute("SAVEPOINT plan_profile")
+        try:
+            cur.execute(prefix + query, vars)
+            profile.plan = cur.fetchone()[0][0]
+        except Exception as e:
+            profile.error = str(e).strip()
+            logger.debug(f"Could not explain statement {profile.key}: {profile.error}")
+        finally:
+            cur.execute("ROLLBACK TO SAVEPOINT plan_profile")
+            cur.execute("RELEASE SAVEPOINT plan_profile")
+
+
+def observe(profile, seconds):
+    with _lock:
+        profile.calls += 1
+        profile.total_seconds += seconds
+        profile.max_seconds = max(profile.max_seconds, seconds)
+
+
+def reset():
+    with _lock:
+        _statements.clear()
+
+
+# ---------------------------------------------------------------------------
+# Plan analysis
+# ---------------------------------------------------------------------------
+
+def _walk(node, ancestors=()):
+    yield node, ancestors
+    for child in node.get("Plans", ()):
+        yield from _walk(child, ancestors + (node,))
+
+
+def plan_signature(root):
+    """
+    The plan's shape: node types with their relations and indexes.
+    """
+    label = root["Node Type"]
+    target = root.get("Index Name") or root.get("Relation Name")
+    if target:
+        label += f"[{target}]"
+    children = root.get("Plans")
+    if children:
+        label += "(" + ", ".join(plan_signature(child) for child in children) + ")"
+    return label
+
+
+def _base_table(relation):
+    # Monthly fact_sales partitions are named fact_sales_YYYY_MM.
+    return re.sub(r"_\d{4}_\d{2}$", "", relation)
+
+
+def _condition_columns(condition, alias):
+    """
+    Columns of 'alias' compared in a plan condition such as
+    "((oi.order_id = o.order_id) AND (processed = false))".
+    """
+    columns = []
+    for qualifier, column in re.findall(r"(?:\b(\w+)\.)?\b([a-z_]\w*)\b\s*(?:=|<>|<=|>=|<|>|~~|IS\b)", condition):
+        if qualifier in ("", alias) and column not in columns:
+            columns.append(column)
+    for qualifier, column in re.findall(r"(?:=|<>|<=|>=|<|>)\s*\(?(?:\b(\w+)\.)\b([a-z_]\w*)\b", condition):
+        if qualifier == alias and column not in columns:
+            columns.append(column)
+    return columns
+
+
+def analyze(root):
+    """
+    Findings of one plan: dicts with 'kind' (seq_scan, disk_sort,
+    hash_spill), a 'detail' line and, for scans, 'table' and 'columns'.
+    """
+    findings = []
+    for node, ancestors in _walk(root):
+        node_type = node["Node Type"]
+        loops = node.get("Actual Loops", 1) or 1
+        if node_type == "Seq Scan":
+            rows = (node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)) * loops
+            if rows < SEQ_SCAN_MIN_ROWS:
+                continue
+            alias = node.get("Alias", node["Relation Name"])
+            columns = _condition_columns(node.get("Filter", ""), alias)
+            for parent in reversed(ancestors):
+                condition = parent.get("Hash Cond") or parent.get("Merge Cond") or parent.get("Join Filter")
+                if condition:
+                    columns += [c for c in _condition_columns(condition, alias) if c not in columns]
+                    break
+            findings.append({
+                "kind": "seq_scan",
+                "table": _base_table(node["Relation Name"]),
+                "columns": columns,
+                "detail": f"Seq Scan on {node['Relation Name']} read {rows} rows"
+                          + (f", filter {node['Filter']}" if node.get("Filter") else ""),
+            })
+        elif node_type == "Sort" and node.get("Sort Space Type") == "Disk":
+            findings.append({
+                "kind": "disk_sort",
+                "detail": f"Sort on {', '.join(node.get('Sort Key', []))} spilled "
+                          f"{node.get('Sort Space Used')} kB to disk ({node.get('Sort Method')})",
+            })
+        elif node_type == "Hash" and node.get("Hash Batches", 1) > 1:
+            findings.append({
+                "kind": "hash_spill",
+                "detail": f"Hash needed {node['Hash Batches']} batches "
+                          f"(peak {node.get('Peak Memory Usage')} kB)",
+            })
+    return findings
+
+
+# ---------------------------------------------------------------------------
+# Index advice
+# ---------------------------------------------------------------------------
+
+def _column_list(text):
+    return [part.strip().split()[0].strip('"') for part in text.split(",") if part.strip()]
+
+
+def ddl_indexes(ddl_dir=DDL_DIR):
+    """
+    {table name: [column lists]} of the primary keys, unique constraints and
+    indexes declared in the DDL files. Tables are keyed without schema, as
+    plans name them.
+    """
+    indexes = {}
+    for path in sorted(glob.glob(os.path.join(ddl_dir, "*.sql"))):
+        with open(path) as f:
+            ddl = re.sub(r"--[^\n]*", "", f.read())
+        for table, body in re.findall(r"(?is)CREATE TABLE (?:IF NOT EXISTS )?([\w.]+)\s*\((.*?)\n\)", ddl):
+            name = table.rsplit(".", 1)[-1]
+            for columns in re.findall(r"(?i)(?:PRIMARY KEY|UNIQUE)\s*\(([^)]*)\)", body):
+                indexes.setdefault(name, []).append(_column_list(columns))
+            for column in re.findall(r"(?im)^\s*(\w+)\s+[^,\n]*\bPRIMARY KEY\b", body):
+                if column.upper() not in ("CONSTRAINT", "PRIMARY"):
+                    indexes.setdefault(name, []).append([column])
+        for table, columns, predicate in re.findall(
+            r"(?is)CREATE (?:UNIQUE )?INDEX (?:IF NOT EXISTS )?\w+\s+ON (?:ONLY )?([\w.]+)\s*"
+            r"(?:USING \w+\s*)?\(([^)]*)\)\s*(?:WHERE\s+([^;]*))?", ddl
+        ):
+            name = table.rsplit(".", 1)[-1]
+            indexes.setdefault(name, []).append(_column_list(columns))
+            # A partial index also serves filters on its predicate columns.
+            for column in re.findall(r"\b([a-z_]\w*)\s*(?:=|<>|<|>|IS\b)", predicate):
+                indexes[name].append([column])
+    return indexes
+
+
+def recommend(profiles, indexes):
+    """
+    Returns {(table, column): [statement keys]} for the large sequential
+    scans whose filter or join columns no declared index starts with.
+    """
+    advice = {}
+    for key, data in profiles.items():
+        for finding in data["findings"]:
+            # Temp tables and anything else outside the DDL are not advised on.
+            if finding["kind"] != "seq_scan" or finding["table"] not in indexes:
+                continue
+            leading = {columns[0] for columns in indexes.get(finding["table"], []) if columns}
+            for column in finding["columns"]:
+                if column not in leading:
+                    advice.setdefault((finding["table"], column), []).append(key)
+    return advice
+
+
+# ---------------------------------------------------------------------------
+# Export and run-to-run comparison
+# ---------------------------------------------------------------------------
+
+def _previous_profiles(directory, exclude):
+    """
+    {statement key: data} from the earlier profile files, the latest file
+    winning.
+    """
+    previous = {}
+    for path in sorted(glob.glob(os.path.join(directory, "plans-*.json"))):
+        if path == exclude:
+            continue
+        with open(path) as f:
+            previous.update(json.load(f)["statements"])
+    return previous
+
+
+def compare(current, previous):
+    """
+    Lines describing plan shape and latency changes of the statements
+    profiled in both runs.
+    """
+    lines = []
+    for key, data in sorted(current.items()):
+        old = previous.get(key)
+        if old is None:
+            continue
+        if old["signature"] and data["signature"] and old["signature"] != data["signature"]:
+            lines.append(f"{key} plan changed:\n    was {old['signature']}\n    now {data['signature']}")
+        before, after = old.get("mean_ms"), data.get("mean_ms")
+        if before and after is not None and abs(after - before) >= LATENCY_CHANGE_MS \
+                and abs(after - before) / before >= LATENCY_CHANGE_RATIO:
+            lines.append(f"{key} mean latency {before:.1f} ms -> {after:.1f} ms ({(after - before) / before:+.0%})")
+    return lines
+
+
+def report(current, advice, changes):
+    lines = ["Statements", "=========="]
+    for key, data in sorted(current.items(), key=lambda item: -(item[1]["mean_ms"] or 0) * item[1]["calls"]):
+        lines.append(f"{key} [{data['stage']}] {data['calls']} calls, mean {data['mean_ms']} ms, "
+                     f"max {data['max_ms']} ms: {data['sql'][:160]}")
+        for finding in data["findings"]:
+            lines.append(f"    {finding['kind']}: {finding['detail']}")
+        if data["error"]:
+            lines.append(f"    not explained: {data['error']}")
+    lines += ["", "Index recommendations (against sql/ddl)", "======================================="]
+    if not advice:
+        lines.append("None: every large sequential scan is on a column some declared index starts with.")
+    for (table, column), keys in sorted(advice.items()):
+        lines.append(f"CREATE INDEX ON {table} ({column});  -- {', '.join(sorted(set(keys)))}")
+    lines += ["", "Changes since the previous profile", "=================================="]
+    lines += changes or ["None."]
+    return "\n".join(lines) + "\n"
+
+
+def export(directory=None):
+    """
+    Writes this process's profiles and report into 'directory' (default: the
+    enabled directory). Does nothing when profiling is off or nothing ran.
+    """
+    directory = directory or _directory
+    with _lock:
+        current = {key: profile.to_dict() for key, profile in _statements.items()}
+    if not directory or not current:
+        return
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"plans-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}")
+    path = base + ".json"
+    previous = _previous_profiles(directory, path)
+    with open(path, "w") as f:
+        json.dump({"statements": current}, f, indent=2, sort_keys=True, default=str)
+
+    advice = recommend(current, ddl_indexes())
+    changes = compare(current, previous)
+    with open(base + ".txt", "w") as f:
+        f.write(report(current, advice, changes))
+    findings = sum(len(data["findings"]) for data in current.values())
+    logger.info(
+        f"Profiled {len(current)} statements: {findings} findings, {len(advice)} index recommendations, "
+        f"{len(changes)} changes since the previous profile. Report: {base}.txt"
+    )
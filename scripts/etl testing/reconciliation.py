@@ -0,0 +1,355 @@
+"""
+Incremental, bucketed reconciliation of staging, OLTP and fact_sales.
+
+Instead of COUNT(DISTINCT order_id) over whole tables, every layer is
+summarised per hour: item rows, orders, sum of price and an XOR of the order
+id hashes. Orders are bucketed by their latest event_time, the time the OLTP
+and OLAP loaders keep. Buckets are stored in
+sales_olap.reconciliation_buckets with a status:
+
+- ok        staging, OLTP and fact_sales agree
+- pending   the hour still has unprocessed staging rows or OLTP orders past
+            the fact_sales watermark
+- mismatch  the layers disagree; the stored counts show which one is off
+
+Staging and OLTP are compared on orders (count and hash): items loaded
+before order_items.source_mongo_id existed had exact duplicates collapsed
+within a batch, so item counts may legitimately differ there. OLTP and fact_sales must agree on everything.
+
+A run only recomputes the hours touched by staging rows added since the last
+run (the 'reconciliation' etl_metadata row holds the last staging id seen)
+plus the hours that were not 'ok' last time, so its cost follows new data.
+Staging ids are allocated before their batch commits, so a lower id can
+become visible after a higher one; the run therefore waits for the staging
+writers in flight before it reads the highest id (see safe_staging_upper_id).
+Rebuilding or truncating a fact partition bypasses staging: follow it with --full.
+Staging rows moved to sales_staging_archive by the OLTP workers still count
+as (processed) staging rows.
+
+    PYTHONPATH=. python "scripts/etl testing/reconciliation.py" --workers 4
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import execute_values
+
+from config.connections import PG_POOL_MAX_SIZE, close_all, pg_connection
+from scripts.common import checkpoint
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+WATERMARK_NAME = "reconciliation"
+LAYERS = ("staging", "oltp", "fact")
+HOURS_PER_QUERY = 24
+EMPTY_BUCKET = (0, 0, 0, 0)
+
+# How long to wait for the staging writers in flight when a run starts.
+STAGING_LOCK_TIMEOUT = os.environ.get("ETL_RECONCILIATION_LOCK_TIMEOUT", "60s")
+
+# Staging rows, wherever the OLTP workers left them.
+STAGING_ROWS = """(
+    SELECT id, event_time, order_id, price, processed
+    FROM sales_oltp.sales_staging
+    UNION ALL
+    SELECT id, event_time, order_id, price, true
+    FROM sales_oltp.sales_staging_archive
+)"""
+
+# ---------------------------------------------------------------------------
+# Touched hours
+# ---------------------------------------------------------------------------
+
+def get_reconciliation_watermark(cur):
+    return int(checkpoint.load(cur, WATERMARK_NAME) or 0)
+
+def set_reconciliation_watermark(cur, staging_id):
+    checkpoint.save(cur, WATERMARK_NAME, staging_id)
+
+def safe_staging_upper_id(cur):
+    """
+    Returns the highest staging id such that no row with a lower id can
+    still appear. A SHARE lock on the staging tables waits for every
+    transaction still writing to them (and holds new writers back until the
+    caller commits), so every id below MAX(id) is then committed or rolled
+    back. Commit right after to release the lock.
+    """
+    cur.execute("SELECT set_config('lock_timeout', %s, true)", (STAGING_LOCK_TIMEOUT,))
+    cur.execute("LOCK TABLE sales_oltp.sales_staging, sales_oltp.sales_staging_archive IN SHARE MODE")
+    cur.execute("""
+        SELECT COALESCE(GREATEST(
+            (SELECT MAX(id) FROM sales_oltp.sales_staging),
+            (SELECT MAX(id) FROM sales_oltp.sales_staging_archive)
+        ), 0)
+    """)
+    return cur.fetchone()[0]
+
+def touched_hours(cur, after_id, upto_id, full=False):
+    """
+    Hours whose buckets may have changed: for every order with staging rows
+    in (after_id, upto_id], the hour of its latest event before and after
+    those rows arrived, plus the hours not settled by an earlier run.
+    """
+    if full:
+        cur.execute(f"""
+            SELECT DISTINCT date_trunc('hour', MAX(COALESCE(event_time, '1970-01-01 00:00:00')))
+            FROM {STAGING_ROWS} s
+            WHERE id <= %s
+            GROUP BY order_id
+        """, (upto_id,))
+        hours = {row[0] for row in cur.fetchall()}
+        cur.execute("SELECT bucket_hour FROM sales_olap.reconciliation_buckets")
+        return sorted(hours | {row[0] for row in cur.fetchall()})
+
+    cur.execute(f"""
+        WITH new_orders AS (
+            SELECT DISTINCT order_id
+            FROM {STAGING_ROWS} s
+            WHERE id > %(after)s AND id <= %(upto)s
+        ), order_hours AS (
+            SELECT date_trunc('hour', MAX(COALESCE(s.event_time, '1970-01-01 00:00:00'))) AS latest,
+                   date_trunc('hour', MAX(COALESCE(s.event_time, '1970-01-01 00:00:00'))
+                       FILTER (WHERE s.id <= %(after)s)) AS previous
+            FROM {STAGING_ROWS} s
+            JOIN new_orders USING (order_id)
+            GROUP BY s.order_id
+        )
+        SELECT latest FROM order_hours
+        UNION
+        SELECT previous FROM order_hours WHERE previous IS NOT NULL
+        UNION
+        SELECT bucket_hour FROM sales_olap.reconciliation_buckets WHERE status <> 'ok'
+    """, {"after": after_id, "upto": upto_id})
+    return sorted(row[0] for row in cur.fetchall())
+
+# ---------------------------------------------------------------------------
+# Bucket queries, one per layer, over a list of hours
+# ---------------------------------------------------------------------------
+# Each returns (bucket_hour, items, orders, order_hash, revenue[, pending]).
+# The hour ranges are index range scans on event_time (staging, orders) or
+# date_id (fact_sales, pruned to the partition by sale_date).
+
+BUCKET_QUERIES = {
+    "staging": f"""
+        WITH candidate_orders AS (
+            SELECT s.order_id
+            FROM unnest(%(hours)s::timestamp[]) AS h(bucket)
+            JOIN {STAGING_ROWS} s
+              ON s.event_time >= h.bucket AND s.event_time < h.bucket + interval '1 hour'
+            UNION
+            -- Rows without an event_time count in the 1970 hour, like OLTP
+            -- and fact_sales count their orders.
+            SELECT s.order_id
+            FROM {STAGING_ROWS} s
+            WHERE s.event_time IS NULL
+              AND '1970-01-01 00:00:00'::timestamp = ANY(%(hours)s::timestamp[])
+        ), staged_orders AS (
+            SELECT s.order_id,
+                   date_trunc('hour', MAX(COALESCE(s.event_time, '1970-01-01 00:00:00'))) AS bucket,
+                   COUNT(*) AS items,
+                   SUM(s.price) AS revenue,
+                   COUNT(*) FILTER (WHERE s.processed IS NOT TRUE) AS pending
+            FROM {STAGING_ROWS} s
+            JOIN candidate_orders USING (order_id)
+            GROUP BY s.order_id
+        )
+        SELECT bucket, SUM(items), COUNT(*),
+               bit_xor(hashtextextended(order_id::text, 0)), COALESCE(SUM(revenue), 0), SUM(pending)
+        FROM staged_orders
+        WHERE bucket = ANY(%(hours)s::timestamp[])
+        GROUP BY bucket
+    """,
+    "oltp": """
+        SELECT h.bucket, COUNT(oi.order_item_id), COUNT(DISTINCT o.order_id),
+               bit_xor(DISTINCT hashtextextended(o.order_id::text, 0)), COALESCE(SUM(oi.price), 0),
+               COUNT(DISTINCT o.order_id) FILTER (WHERE o.order_id > %(fact_watermark)s)
+        FROM unnest(%(hours)s::timestamp[]) AS h(bucket)
+        JOIN sales_oltp.orders o
+          ON o.event_time >= h.bucket AND o.event_time < h.bucket + interval '1 hour'
+        LEFT JOIN sales_oltp.order_items oi ON oi.order_id = o.order_id
+        GROUP BY h.bucket
+    """,
+    "fact": """
+        SELECT h.bucket, COUNT(*), COUNT(DISTINCT f.order_id),
+               bit_xor(DISTINCT hashtextextended(f.order_id::text, 0)), COALESCE(SUM(f.price), 0)
+        FROM unnest(%(hours)s::timestamp[]) AS h(bucket)
+        JOIN sales_olap.dim_date d
+          ON d.date_val = h.bucket::date AND d.hour = EXTRACT(HOUR FROM h.bucket)
+        JOIN sales_olap.fact_sales f
+          ON f.date_id = d.date_id AND f.sale_date = d.date_val
+        GROUP BY h.bucket
+    """,
+}
+
+def get_fact_watermark(cur):
+    return int(checkpoint.load(cur, "fact_sales") or 0)
+
+def compute_layer_buckets(layer, hours, params):
+    """
+    Runs one layer's bucket query over 'hours' on its own pooled connection.
+    Returns (layer, {hour: row}).
+    """
+    with pg_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(BUCKET_QUERIES[layer], dict(params, hours=hours))
+            rows = cur.fetchall()
+            conn.commit()
+        finally:
+            cur.close()
+    return layer, {row[0]: tuple(row[1:]) for row in rows}
+
+def compute_buckets(hours, params, workers):
+    """
+    Computes every layer for 'hours' in parallel, HOURS_PER_QUERY hours per
+    query. Returns {layer: {hour: row}}.
+    """
+    chunks = [hours[i:i + HOURS_PER_QUERY] for i in range(0, len(hours), HOURS_PER_QUERY)]
+    # The caller keeps one pooled connection open; leave it room.
+    workers = max(1, min(workers, PG_POOL_MAX_SIZE - 1))
+    results = {layer: {} for layer in LAYERS}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(compute_layer_buckets, layer, chunk, params)
+            for chunk in chunks for layer in LAYERS
+        ]
+        for future in futures:
+            layer, buckets = future.result()
+            results[layer].update(buckets)
+    return results
+
+# ---------------------------------------------------------------------------
+# Comparison and persistence
+# ---------------------------------------------------------------------------
+
+def classify(staging, oltp, fact):
+    """
+    Status of one bucket from the (items, orders, order_hash, revenue[, pending])
+    tuples of each layer.
+    """
+    staging_pending = staging[4] if len(staging) > 4 else 0
+    oltp_pending = oltp[4] if len(oltp) > 4 else 0
+    if staging_pending or oltp_pending:
+        return "pending"
+    if staging[1:3] != oltp[1:3] or oltp[:4] != fact[:4]:
+        return "mismatch"
+    return "ok"
+
+def build_bucket_rows(hours, results):
+    rows = []
+    for hour in hours:
+        staging = results["staging"].get(hour, EMPTY_BUCKET + (0,))
+        oltp = results["oltp"].get(hour, EMPTY_BUCKET + (0,))
+        fact = results["fact"].get(hour, EMPTY_BUCKET)
+        status = classify(staging, oltp, fact)
+        rows.append((hour, *staging[:4], staging[4], *oltp[:4], oltp[4], *fact[:4], status))
+    return rows
+
+def save_buckets(cur, rows, upto_id):
+    """
+    Upserts the recomputed buckets and moves the watermark in one transaction.
+    Hours with nothing left in any layer are dropped.
+    """
+    empty = [row[0] for row in rows if not (row[2] or row[7] or row[12])]
+    stored = [row for row in rows if row[2] or row[7] or row[12]]
+    if empty:
+        cur.execute(
+            "DELETE FROM sales_olap.reconciliation_buckets WHERE bucket_hour = ANY(%s::timestamp[])",
+            (empty,)
+        )
+    if stored:
+        execute_values(cur, """
+            INSERT INTO sales_olap.reconciliation_buckets (
+                bucket_hour,
+                staging_items, staging_orders, staging_order_hash, staging_revenue, staging_pending,
+                oltp_items, oltp_orders, oltp_order_hash, oltp_revenue, oltp_pending,
+                fact_items, fact_orders, fact_order_hash, fact_revenue,
+                status, checked_at
+            )
+            VALUES %s
+            ON CONFLICT (bucket_hour) DO UPDATE SET
+                staging_items = EXCLUDED.staging_items,
+                staging_orders = EXCLUDED.staging_orders,
+                staging_order_hash = EXCLUDED.staging_order_hash,
+                staging_revenue = EXCLUDED.staging_revenue,
+                staging_pending = EXCLUDED.staging_pending,
+                oltp_items = EXCLUDED.oltp_items,
+                oltp_orders = EXCLUDED.oltp_orders,
+                oltp_order_hash = EXCLUDED.oltp_order_hash,
+                oltp_revenue = EXCLUDED.oltp_revenue,
+                oltp_pending = EXCLUDED.oltp_pending,
+                fact_items = EXCLUDED.fact_items,
+                fact_orders = EXCLUDED.fact_orders,
+                fact_order_hash = EXCLUDED.fact_order_hash,
+                fact_revenue = EXCLUDED.fact_revenue,
+                status = EXCLUDED.status,
+                checked_at = EXCLUDED.checked_at
+        """, stored, template="(" + ", ".join(["%s"] * 16) + ", now())", page_size=1000)
+    set_reconciliation_watermark(cur, upto_id)
+    cur.connection.commit()
+
+def report(rows):
+    counts = {"ok": 0, "pending": 0, "mismatch": 0}
+    for row in rows:
+        counts[row[-1]] += 1
+        if row[-1] == "mismatch":
+            hour = row[0]
+            logging.error(
+                f"Mismatch at {hour:%Y-%m-%d %H}:00 - "
+                f"staging {row[2]} orders / {row[1]} items / {row[4]}, "
+                f"oltp {row[7]} orders / {row[6]} items / {row[9]}, "
+                f"fact {row[12]} orders / {row[11]} items / {row[14]}"
+            )
+    logging.info(
+        f"Reconciled {len(rows)} hours: {counts['ok']} ok, "
+        f"{counts['pending']} pending, {counts['mismatch']} mismatched."
+    )
+    return counts["mismatch"]
+
+# ---------------------------------------------------------------------------
+# Entry point
+# ---------------------------------------------------------------------------
+
+def reconcile(conn, workers=4, full=False):
+    """
+    Recomputes the touched hours and returns the mismatched ones.
+    """
+    cur = conn.cursor()
+    try:
+        after_id = 0 if full else get_reconciliation_watermark(cur)
+        upto_id = safe_staging_upper_id(cur)
+        conn.commit()
+        hours = touched_hours(cur, after_id, upto_id, full)
+        params = {"fact_watermark": get_fact_watermark(cur)}
+        conn.commit()
+        logging.info(f"Reconciling {len(hours)} hours (staging ids {after_id} to {upto_id}).")
+
+        rows = build_bucket_rows(hours, compute_buckets(hours, params, workers)) if hours else []
+        save_buckets(cur, rows, upto_id)
+        report(rows)
+        return [row[0] for row in rows if row[-1] == "mismatch"]
+    finally:
+        cur.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reconcile staging, OLTP and fact_sales per hour.")
+    parser.add_argument("--workers", type=int, default=4, help="Bucket queries run in parallel.")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Recompute every hour, e.g. after a fact partition rebuild."
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    try:
+        with pg_connection() as conn:
+            mismatched = reconcile(conn, args.workers, args.full)
+    finally:
+        close_all()
+    if mismatched:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,17 @@
 # main_script.py
 
-import psycopg2
-from config.credentials import DB_CONFIG 
+from config.connections import close_all, pg_connection
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def validate_order_counts():
+def validate_order_counts(conn):
     """
     Validates that the distinct order_id counts match between staging and fact tables.
     """
+    cursor = conn.cursor()
     try:
-        # Connect to the database using DB_CONFIG
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-
         # Query to count distinct order_id in sales_staging
         staging_query = "SELECT COUNT(DISTINCT order_id) FROM sales_oltp.sales_staging"
         cursor.execute(staging_query)
@@ -40,9 +36,11 @@ def validate_order_counts():
         raise
     finally:
         cursor.close()
-        conn.close()
-        logging.info("Database connection closed.")
 
 # Run the validation
 if __name__ == "__main__":
-    validate_order_counts()
+    try:
+        with pg_connection() as conn:
+            validate_order_counts(conn)
+    finally:
+        close_all()
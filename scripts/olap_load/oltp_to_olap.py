@@ -1,8 +1,19 @@
+import argparse
 import logging
-import psycopg2
+import multiprocessing
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+import numpy as np
 from psycopg2.extras import execute_values
-from datetime import datetime
-from config.credentials import POSTGRES_CONFIG  # Import PostgreSQL configuration
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from config.connections import close_all, pg_connection, stream_rows
+from scripts.common import backfill, checkpoint, cursors, metrics, plans
+from scripts.common.batching import make_sizer
+from scripts.common.columnar import ColumnBatch, map_keys
+from scripts.common.keycache import SurrogateKeyCache
 
 # ------------------------------------------------------------------------------
 # Configure Logging
@@ -13,109 +24,203 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_METRICS = metrics.stage("olap")
+cursors.install()
+_DATE_CACHE_STATS = _METRICS.cache("dim_date")
+
+# Tables whose foreign keys and secondary indexes --backfill defers.
+BACKFILL_TABLES = ("sales_olap.fact_sales",)
+
 # ------------------------------------------------------------------------------
 # PostgreSQL Connection
 # ------------------------------------------------------------------------------
-conn = psycopg2.connect(**POSTGRES_CONFIG)
-cur = conn.cursor()
+# Loaders take a psycopg2 connection ('conn') from config.connections; helpers
+# that do not commit on their own take a cursor ('cur').
 
 # ------------------------------------------------------------------------------
 # Dimension Bulk Loading
 # ------------------------------------------------------------------------------
 
-def load_dim_users_bulk(chunk_size=10000):
+# Dimension rows carry an md5 of their OLTP source columns (src_hash), and the
+# OLTP users, products and categories rows carry the id of the transaction
+# that last inserted or changed them (change_xid). Each run reads only the
+# rows changed since the previous run, page by page in (change_xid, key)
+# order with one keyset query per transaction, and upserts each page in the
+# same transaction. The upsert skips rows whose src_hash did not change.
+#
+# A run covers the change_xids from its loader's watermark (the 'dim_users' /
+# 'dim_products' checkpoint) up to the oldest transaction still running when
+# it starts. Every change below that bound is committed or rolled back, so a
+# transaction that commits late is picked up by the next run instead of being
+# skipped. The watermark only moves once the whole window is loaded.
+#
+# Every loader also takes an optional AdaptiveBatchSizer ('sizer') that
+# replaces 'chunk_size' with a size tuned from each committed chunk.
+
+# Lower bound of a keyset over a bigint natural key (missing ids are -1).
+MIN_KEY = -2 ** 63
+
+def change_window(cur, name):
     """
-    Bulk upserts user data from OLTP to OLAP dimension table.
+    Returns the (after, upper) change_xid window of dimension loader 'name':
+    'after' inclusive, 'upper' exclusive.
     """
-    logger.info("Starting bulk load for dim_users...")
-    offset = 0
-    total_inserted = 0
+    after = int(checkpoint.load(cur, name) or 0)
+    cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+    return after, cur.fetchone()[0]
 
+def iter_keyset_pages(cur, query, params, key, chunk_size, sizer=None):
+    """
+    Runs 'query' once per page with 'params', a %(limit)s of 'chunk_size'
+    (the sizer's current size when given), and the keyset parameters
+    returned by 'key' for the last row of the previous page. Yields each
+    non-empty page and stops after a short one.
+    """
+    params = dict(params)
     while True:
-        cur.execute("""
-            SELECT user_id, user_name
-            FROM sales_oltp.users
-            ORDER BY user_id
-            LIMIT %s OFFSET %s
-        """, (chunk_size, offset))
+        limit = sizer.size if sizer else chunk_size
+        cur.execute(query, {**params, "limit": limit})
         rows = cur.fetchall()
-        if not rows:
-            break
+        if rows:
+            yield rows
+            params.update(key(rows[-1]))
+        if len(rows) < limit:
+            return
 
-        user_data = [(r[0], r[1]) for r in rows]
+def load_dim_users_bulk(conn, chunk_size=10000, sizer=None):
+    """
+    Bulk upserts the users added since the last run from OLTP to the OLAP
+    dimension table.
+    """
+    logger.info("Starting incremental load for dim_users...")
+    cur = conn.cursor()
+    total_inserted = 0
+    after, upper = change_window(cur, "dim_users")
+    if sizer:
+        sizer.restart_clock()
+
+    pages = iter_keyset_pages(cur, """
+        SELECT user_id, user_name, md5(ROW(user_name)::text), change_xid
+        FROM sales_oltp.users
+        WHERE (change_xid, user_id) > (%(xid)s, %(key)s)
+          AND change_xid < %(upper)s
+        ORDER BY change_xid, user_id
+        LIMIT %(limit)s
+    """, {"xid": after, "key": MIN_KEY, "upper": upper},
+        lambda row: {"xid": row[3], "key": row[0]}, chunk_size, sizer)
+    for rows in _METRICS.timed(pages, "extract"):
         upsert_sql = """
-            INSERT INTO sales_olap.dim_users (user_id, user_name)
+            INSERT INTO sales_olap.dim_users (user_id, user_name, src_hash)
             VALUES %s
             ON CONFLICT (user_id)
-            DO UPDATE SET user_name = EXCLUDED.user_name
+            DO UPDATE SET user_name = EXCLUDED.user_name,
+                          src_hash = EXCLUDED.src_hash
+            WHERE dim_users.src_hash IS DISTINCT FROM EXCLUDED.src_hash
         """
-        execute_values(cur, upsert_sql, user_data, page_size=chunk_size)
-        conn.commit()
+        with _METRICS.phase("load"):
+            execute_values(cur, upsert_sql, [row[:3] for row in rows], page_size=len(rows))
+        with _METRICS.phase("commit"):
+            conn.commit()
+        _METRICS.add_batch(len(rows))
+        if sizer:
+            sizer.record(len(rows))
 
-        offset += chunk_size
         total_inserted += len(rows)
-        logger.info(f"Upserted {len(rows)} users, offset now {offset}.")
+        logger.info(f"Upserted {len(rows)} changed users, last user_id now {rows[-1][0]}.")
 
-    logger.info(f"Bulk load for dim_users complete. Total upserted: {total_inserted}")
+    checkpoint.save(cur, "dim_users", upper)
+    conn.commit()
+    logger.info(f"Incremental load for dim_users complete. Total upserted: {total_inserted}")
 
 
-def load_dim_products_bulk(chunk_size=10000):
+# Products changed themselves, and every product of a category whose code
+# changed; a product in both lists is upserted twice, the second time as a
+# no-op. Both end with the keyset columns.
+CHANGED_PRODUCTS_QUERIES = (
+    ("""
+        SELECT p.product_id, p.brand, c.category_id, c.category_code,
+               md5(ROW(p.brand, c.category_id, c.category_code)::text), p.change_xid
+        FROM sales_oltp.products p
+        JOIN sales_oltp.categories c ON p.category_id = c.category_id
+        WHERE (p.change_xid, p.product_id) > (%(xid)s, %(key)s)
+          AND p.change_xid < %(upper)s
+        ORDER BY p.change_xid, p.product_id
+        LIMIT %(limit)s
+    """, {"key": MIN_KEY}, lambda row: {"xid": row[5], "key": row[0]}),
+    ("""
+        SELECT p.product_id, p.brand, c.category_id, c.category_code,
+               md5(ROW(p.brand, c.category_id, c.category_code)::text)
+        FROM sales_oltp.categories c
+        JOIN sales_oltp.products p ON p.category_id = c.category_id
+        WHERE c.change_xid >= %(xid)s AND c.change_xid < %(upper)s
+          AND (c.category_id, p.product_id) > (%(category)s, %(key)s)
+        ORDER BY c.category_id, p.product_id
+        LIMIT %(limit)s
+    """, {"category": MIN_KEY, "key": MIN_KEY}, lambda row: {"category": row[2], "key": row[0]}),
+)
+
+def load_dim_products_bulk(conn, chunk_size=10000, sizer=None):
     """
-    Bulk upserts product data from OLTP to OLAP dimension table.
+    Bulk upserts new or changed products from OLTP to OLAP dimension table.
     """
-    logger.info("Starting bulk load for dim_products...")
-    offset = 0
+    logger.info("Starting incremental load for dim_products...")
+    cur = conn.cursor()
     total_inserted = 0
+    after, upper = change_window(cur, "dim_products")
+    if sizer:
+        sizer.restart_clock()
 
-    while True:
-        cur.execute("""
-            SELECT p.product_id, p.brand, c.category_id, c.category_code
-            FROM sales_oltp.products p
-            JOIN sales_oltp.categories c ON p.category_id = c.category_id
-            ORDER BY p.product_id
-            LIMIT %s OFFSET %s
-        """, (chunk_size, offset))
-        rows = cur.fetchall()
-        if not rows:
-            break
-
-        product_data = []
-        for (product_id, brand, category_id, category_code) in rows:
-            parts = category_code.split(".")
-            main_category = parts[0] if len(parts) > 0 else "unknown"
-            sub_category = parts[1] if len(parts) > 1 else ""
-            sub_sub_category = parts[2] if len(parts) > 2 else ""
-            product_data.append((product_id, brand, category_id, main_category, sub_category, sub_sub_category))
+    for query, start, key in CHANGED_PRODUCTS_QUERIES:
+        pages = iter_keyset_pages(cur, query, {**start, "xid": after, "upper": upper}, key, chunk_size, sizer)
+        for rows in _METRICS.timed(pages, "extract"):
+            product_data = []
+            for (product_id, brand, category_id, category_code, src_hash) in (row[:5] for row in rows):
+                parts = category_code.split(".")
+                main_category = parts[0] if len(parts) > 0 else "unknown"
+                sub_category = parts[1] if len(parts) > 1 else ""
+                sub_sub_category = parts[2] if len(parts) > 2 else ""
+                product_data.append((
+                    product_id, brand, category_id,
+                    main_category, sub_category, sub_sub_category, src_hash
+                ))
 
-        upsert_sql = """
-            INSERT INTO sales_olap.dim_products (
-                product_id, brand, category_id,
-                main_category, sub_category, sub_sub_category
-            )
-            VALUES %s
-            ON CONFLICT (product_id)
-            DO UPDATE SET
-                brand = EXCLUDED.brand,
-                category_id = EXCLUDED.category_id,
-                main_category = EXCLUDED.main_category,
-                sub_category = EXCLUDED.sub_category,
-                sub_sub_category = EXCLUDED.sub_sub_category
-        """
-        execute_values(cur, upsert_sql, product_data, page_size=chunk_size)
-        conn.commit()
+            upsert_sql = """
+                INSERT INTO sales_olap.dim_products (
+                    product_id, brand, category_id,
+                    main_category, sub_category, sub_sub_category, src_hash
+                )
+                VALUES %s
+                ON CONFLICT (product_id)
+                DO UPDATE SET
+                    brand = EXCLUDED.brand,
+                    category_id = EXCLUDED.category_id,
+                    main_category = EXCLUDED.main_category,
+                    sub_category = EXCLUDED.sub_category,
+                    sub_sub_category = EXCLUDED.sub_sub_category,
+                    src_hash = EXCLUDED.src_hash
+                WHERE dim_products.src_hash IS DISTINCT FROM EXCLUDED.src_hash
+            """
+            with _METRICS.phase("load"):
+                execute_values(cur, upsert_sql, product_data, page_size=len(product_data))
+            with _METRICS.phase("commit"):
+                conn.commit()
+            _METRICS.add_batch(len(rows))
+            if sizer:
+                sizer.record(len(rows))
 
-        offset += chunk_size
-        total_inserted += len(rows)
-        logger.info(f"Upserted {len(rows)} products, offset now {offset}.")
+            total_inserted += len(rows)
+            logger.info(f"Upserted {len(rows)} changed products, last product_id now {rows[-1][0]}.")
 
-    logger.info(f"Bulk load for dim_products complete. Total upserted: {total_inserted}")
+    checkpoint.save(cur, "dim_products", upper)
+    conn.commit()
+    logger.info(f"Incremental load for dim_products complete. Total upserted: {total_inserted}")
 
 
 # ------------------------------------------------------------------------------
 # Dimension Caching for Fact Table
 # ------------------------------------------------------------------------------
 
-def load_dim_date(order_timestamp: datetime, date_cache: dict) -> int:
+def load_dim_date(cur, order_timestamp: datetime, date_cache: dict) -> int:
     """
     Fetch or insert a row in dim_date, returning date_id.
     """
@@ -124,8 +229,10 @@ def load_dim_date(order_timestamp: datetime, date_cache: dict) -> int:
     key = (date_val, hour)
 
     if key in date_cache:
+        _DATE_CACHE_STATS.hits += 1
         return date_cache[key]
 
+    _DATE_CACHE_STATS.misses += 1
     cur.execute("""
         INSERT INTO sales_olap.dim_date (date_val, year, month, day, hour)
         VALUES (%s, %s, %s, %s, %s)
@@ -147,113 +254,979 @@ def load_dim_date(order_timestamp: datetime, date_cache: dict) -> int:
     date_cache[key] = date_id
     return date_id
 
+
+class DateIdLookup:
+    """
+    Dense hour -> date_id mapping for a contiguous range of hours. Slot i
+    holds the date_id of 'first_hour' + i hours (0 when unknown).
+    """
+
+    def __init__(self, first_hour: datetime, date_ids: array):
+        self.first_hour = first_hour
+        self.date_ids = date_ids
+
+    def get(self, order_timestamp: datetime):
+        index = int((order_timestamp - self.first_hour).total_seconds()) // 3600
+        if 0 <= index < len(self.date_ids):
+            return self.date_ids[index] or None
+        return None
+
+
+def prepare_dim_date(cur, start: datetime, end: datetime) -> DateIdLookup:
+    """
+    Generates every (date_val, hour) row between 'start' and 'end' in one
+    statement and loads their date_ids into a DateIdLookup.
+    """
+    first_hour = start.replace(minute=0, second=0, microsecond=0)
+    last_hour = end.replace(minute=0, second=0, microsecond=0)
+
+    cur.execute("""
+        INSERT INTO sales_olap.dim_date (date_val, year, month, day, hour)
+        SELECT h::date,
+               EXTRACT(YEAR FROM h)::int,
+               EXTRACT(MONTH FROM h)::int,
+               EXTRACT(DAY FROM h)::int,
+               EXTRACT(HOUR FROM h)::int
+        FROM generate_series(%s::timestamp, %s::timestamp, interval '1 hour') AS h
+        ORDER BY h
+        ON CONFLICT (date_val, hour) DO NOTHING
+    """, (first_hour, last_hour))
+    cur.execute("""
+        SELECT date_val + make_interval(hours => hour), date_id
+        FROM sales_olap.dim_date
+        WHERE date_val BETWEEN %s AND %s
+    """, (first_hour.date(), last_hour.date()))
+
+    date_ids = array("q", bytes(8 * (int((last_hour - first_hour).total_seconds()) // 3600 + 1)))
+    lookup = DateIdLookup(first_hour, date_ids)
+    for hour_ts, date_id in cur.fetchall():
+        index = int((hour_ts - first_hour).total_seconds()) // 3600
+        if 0 <= index < len(date_ids):
+            date_ids[index] = date_id
+    cur.connection.commit()
+    logger.info(f"Prepared dim_date for {len(date_ids)} hours ({first_hour} .. {last_hour}).")
+    return lookup
+
+
+def resolve_date_id(cur, order_timestamp: datetime, date_lookup, date_cache: dict) -> int:
+    """
+    In-memory date_id lookup, falling back to load_dim_date for timestamps
+    outside the prepared range (e.g. orders that arrived mid-run).
+    """
+    if date_lookup is not None:
+        date_id = date_lookup.get(order_timestamp)
+        if date_id:
+            _DATE_CACHE_STATS.hits += 1
+            return date_id
+    return load_dim_date(cur, order_timestamp=order_timestamp, date_cache=date_cache)
+
 # ------------------------------------------------------------------------------
 # Incremental Fact Table Loading
 # ------------------------------------------------------------------------------
 
-def load_fact_sales_incremental_bulk_with_caching(chunk_size=10000):
+FACT_SOURCE_SCHEMA = (
+    ("order_id", np.int64, None),
+    ("user_id", np.int64, None),
+    ("event_time", "datetime64[us]", None),
+    ("product_id", np.int64, None),
+    ("price", np.float64, None),
+)
+
+def resolve_surrogate_keys(cur, cache, keys, table, natural_key, surrogate_key):
     """
-    Incrementally load fact_sales in chunks with caching.
+    Returns {natural key: surrogate key} for 'keys', querying the dimension
+    table only for keys the cache has never seen.
     """
-    logger.info("Starting incremental load for fact_sales...")
+    found, missing = cache.lookup_many(keys)
+    _METRICS.record_cache(table, hits=len(found), misses=len(missing))
+    if missing:
+        cur.execute(f"""
+            SELECT {natural_key}, {surrogate_key}
+            FROM sales_olap.{table}
+            WHERE {natural_key} IN %s
+        """, (tuple(missing),))
+        fetched = cur.fetchall()
+        cache.update(fetched)
+        found.update(fetched)
+    return found
+
+def build_fact_rows(cur, rows, user_map, product_map, date_cache, date_lookup=None):
+    """
+    Turns joined order rows into fact_sales rows, dropping rows whose user or
+    product is not in the dimensions yet.
+    """
+    fact_data = []
+    for (order_id, user_id, event_time, product_id, price) in rows:
+        date_id = resolve_date_id(cur, event_time, date_lookup, date_cache)
+        dim_user_id = user_map.get(user_id)
+        dim_product_id = product_map.get(product_id)
+
+        if dim_user_id and dim_product_id:
+            fact_data.append((date_id, dim_user_id, dim_product_id, order_id, price, event_time.date()))
+    return fact_data
+
+def build_fact_rows_columnar(cur, rows, user_map, product_map, date_cache, date_lookup=None):
+    """
+    Vectorized version of build_fact_rows.
+    """
+    batch = ColumnBatch.from_rows(rows, FACT_SOURCE_SCHEMA)
+    dim_user_ids = map_keys(batch["user_id"], user_map)
+    dim_product_ids = map_keys(batch["product_id"], product_map)
+
+    # One dim_date lookup per distinct hour instead of per row.
+    hours, hour_index = np.unique(batch["event_time"].astype("datetime64[h]"), return_inverse=True)
+    hour_date_ids = np.array(
+        [resolve_date_id(cur, h, date_lookup, date_cache) for h in hours.astype(object)],
+        dtype=np.int64
+    )
+
+    batch.columns["date_id"] = hour_date_ids[hour_index]
+    batch.columns["dim_user_id"] = dim_user_ids
+    batch.columns["dim_product_id"] = dim_product_ids
+    batch.columns["sale_date"] = batch["event_time"].astype("datetime64[D]")
+    loaded = batch.filter((dim_user_ids > 0) & (dim_product_ids > 0))
+    return loaded.rows("date_id", "dim_user_id", "dim_product_id", "order_id", "price", "sale_date")
+
+# Orders in the pending range of a fact read; see iter_fact_source_chunks.
+FACT_SOURCE_FILTER = """
+    o.order_id > %(after)s
+    AND (%(upper)s::bigint IS NULL OR o.order_id <= %(upper)s)
+    AND (%(event_start)s::timestamp IS NULL OR o.event_time >= %(event_start)s)
+    AND (%(event_end)s::timestamp IS NULL OR o.event_time < %(event_end)s)
+"""
+
+def _fact_source_params(after_order_id, upper_order_id, event_range):
+    return {
+        "after": after_order_id,
+        "upper": upper_order_id,
+        "event_start": event_range[0],
+        "event_end": event_range[1],
+    }
+
+def iter_fact_source_chunks(conn, after_order_id, chunk_size, upper_order_id=None,
+                            event_range=(None, None), itersize=None, sizer=None):
+    """
+    Streams the order items after 'after_order_id' (up to 'upper_order_id'
+    when given, and with event_time in the half-open 'event_range' when
+    given) from one server-side cursor and yields them as (rows, last
+    order_id in the chunk) for every 'chunk_size' complete orders (the
+    sizer's current size, when given). Chunks always end on an order
+    boundary, so no order's items are split across chunks. The cursor does
+    not survive a commit; callers that commit between chunks use
+    iter_fact_source_pages.
+    """
+    rows = stream_rows(conn, "fact_source_rows", f"""
+        SELECT o.order_id, o.user_id, o.event_time, oi.product_id, oi.price
+        FROM sales_oltp.orders o
+        JOIN sales_oltp.order_items oi ON o.order_id = oi.order_id
+        WHERE {FACT_SOURCE_FILTER}
+        ORDER BY o.order_id, oi.order_item_id
+    """, _fact_source_params(after_order_id, upper_order_id, event_range), itersize)
+
+    chunk = []
+    num_orders = 0
+    last_order_id = None
+    with closing(rows):
+        for row in rows:
+            if row[0] != last_order_id:
+                if num_orders >= (sizer.size if sizer else chunk_size):
+                    yield chunk, last_order_id
+                    chunk = []
+                    num_orders = 0
+                num_orders += 1
+                last_order_id = row[0]
+            chunk.append(row)
+    if chunk:
+        yield chunk, last_order_id
+
+def iter_fact_source_pages(cur, after_order_id, chunk_size, upper_order_id=None,
+                           event_range=(None, None), sizer=None):
+    """
+    Same chunks as iter_fact_source_chunks, but each one is read by its own
+    keyset query: the items of the next 'chunk_size' orders after the last
+    order_id of the previous chunk. Nothing is held open between chunks, so
+    the caller commits freely between them; a WITH HOLD cursor would instead
+    materialize the whole remaining range on the first commit.
+    """
+    params = _fact_source_params(after_order_id, upper_order_id, event_range)
+    while True:
+        limit = sizer.size if sizer else chunk_size
+        # LEFT JOIN: an order without items still moves the keyset forward.
+        cur.execute(f"""
+            SELECT o.order_id, o.user_id, o.event_time, oi.product_id, oi.price
+            FROM (
+                SELECT o.order_id, o.user_id, o.event_time
+                FROM sales_oltp.orders o
+                WHERE {FACT_SOURCE_FILTER}
+                ORDER BY o.order_id
+                LIMIT %(limit)s
+            ) o
+            LEFT JOIN sales_oltp.order_items oi ON o.order_id = oi.order_id
+            ORDER BY o.order_id, oi.order_item_id
+        """, {**params, "limit": limit})
+        page = cur.fetchall()
+        if not page:
+            return
+        params["after"] = page[-1][0]
+        rows = [row for row in page if row[3] is not None]
+        if rows:
+            yield rows, page[-1][0]
+        if count_orders(page) < limit:
+            return
+
+def count_orders(rows):
+    return len({row[0] for row in rows})
+
+def load_fact_chunk(cur, rows, user_cache, product_cache, date_cache, date_lookup, columnar=False,
+                    target_table=None, rollups=True):
+    """
+    Resolves surrogate keys for one chunk and inserts its fact rows, into
+    their monthly partitions (folding them into the rollups unless told not
+    to) or into 'target_table' when given. Does not commit. Returns the
+    number of fact rows inserted.
+    """
+    with _METRICS.phase("transform"):
+        user_ids = {user_id for (_, user_id, _, _, _) in rows}
+        product_ids = {product_id for (_, _, _, product_id, _) in rows}
+
+        user_map = resolve_surrogate_keys(cur, user_cache, user_ids, "dim_users", "user_id", "dim_user_id")
+        product_map = resolve_surrogate_keys(
+            cur, product_cache, product_ids, "dim_products", "product_id", "dim_product_id"
+        )
+
+        build = build_fact_rows_columnar if columnar else build_fact_rows
+        fact_data = build(cur, rows, user_map, product_map, date_cache, date_lookup)
 
+    with _METRICS.phase("load"):
+        if target_table:
+            insert_fact_rows(cur, target_table, fact_data, rollups=False)
+        else:
+            insert_fact_rows_partitioned(cur, fact_data, rollups)
+    _METRICS.add_batch(len(fact_data))
+    return len(fact_data)
+
+# ------------------------------------------------------------------------------
+# fact_sales Partitions
+# ------------------------------------------------------------------------------
+# fact_sales is range-partitioned by sale_date into monthly partitions
+# (sales_olap.fact_sales_YYYY_MM). Rows are written straight into their
+# partition, and a month can be rebuilt offline and swapped in with ATTACH.
+_known_partitions = set()
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def fact_partition_name(month):
+    return f"fact_sales_{month:%Y_%m}"
+
+def ensure_fact_partition(cur, month):
+    """
+    Creates the partition for 'month' unless it exists. Does not commit.
+    """
+    if month in _known_partitions:
+        return
+    name = fact_partition_name(month)
+    cur.execute("SELECT to_regclass(%s)", (f"sales_olap.{name}",))
+    if cur.fetchone()[0] is None:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS sales_olap.{name}
+            PARTITION OF sales_olap.fact_sales
+            FOR VALUES FROM (%s) TO (%s)
+        """, (month, next_month(month)))
+        logger.info(f"Created partition sales_olap.{name}.")
+    _known_partitions.add(month)
+
+def ensure_fact_partitions(cur, start: datetime, end: datetime):
+    month = month_start(start)
+    while month <= end.date():
+        ensure_fact_partition(cur, month)
+        month = next_month(month)
+
+def insert_fact_rows(cur, table, fact_data, rollups=True):
+    """
+    Inserts fact rows into 'table' in one statement, so the chunk size alone
+    decides the statement size. With 'rollups' the rows actually inserted are
+    folded into the rollup tables by that statement; orders are never split
+    across statements.
+    """
+    if not fact_data:
+        return
+    insert_sql = f"""
+        INSERT INTO sales_olap.{table} (
+            date_id, dim_user_id, dim_product_id, order_id, price, sale_date
+        )
+        VALUES %s
+        ON CONFLICT DO NOTHING
+    """
+    if rollups:
+        insert_sql = rollup_statement(
+            insert_sql + "RETURNING date_id, dim_user_id, dim_product_id, order_id, price, sale_date"
+        )
+    execute_values(cur, insert_sql, fact_data, page_size=len(fact_data))
+
+def insert_fact_rows_partitioned(cur, fact_data, rollups=True):
+    """
+    Groups fact rows by month and inserts each group directly into its
+    partition, skipping tuple routing through the parent table.
+    """
+    by_month = defaultdict(list)
+    for row in fact_data:
+        by_month[month_start(row[5])].append(row)
+    for month, month_rows in sorted(by_month.items()):
+        ensure_fact_partition(cur, month)
+        insert_fact_rows(cur, fact_partition_name(month), month_rows, rollups)
+
+def rebuild_fact_partition(conn, month, chunk_size=10000, columnar=False, through_order_id=None,
+                           sizer=None):
+    """
+    Rebuilds the facts of one month offline and swaps them in. Loads orders
+    of that month up to 'through_order_id' (default: the fact_sales
+    watermark) into a standalone table, adds the partition constraint so
+    ATTACH can skip its validation scan, then replaces the old partition in
+    one transaction.
+
+    Orders above the watermark are left to the incremental loads, so the
+    rebuild refuses to run while completed parallel shards lie above it:
+    their facts would be dropped with the old partition and never reloaded.
+    """
+    cur = conn.cursor()
+    name = fact_partition_name(month)
+    watermark = advance_fact_watermark(cur)
+    shards = get_completed_fact_shards(cur)
+    if shards:
+        raise RuntimeError(
+            f"Completed fact shards {shards} lie above the fact_sales watermark {watermark}; rerun the "
+            f"fact load until the watermark covers them before rebuilding {name}."
+        )
+    if through_order_id is None:
+        through_order_id = watermark
+    elif through_order_id > watermark:
+        raise ValueError(
+            f"Cannot rebuild {name} through order_id {through_order_id}: the incremental load would "
+            f"insert the orders above the fact_sales watermark {watermark} again."
+        )
+    load_table = f"{name}_load"
+    month_end = next_month(month)
+    logger.info(f"Rebuilding {name} for orders up to {through_order_id}...")
+
+    cur.execute(f"DROP TABLE IF EXISTS sales_olap.{load_table}")
+    cur.execute(f"""
+        CREATE TABLE sales_olap.{load_table}
+        (LIKE sales_olap.fact_sales INCLUDING DEFAULTS)
+    """)
+    conn.commit()
+
+    start = datetime.combine(month, datetime.min.time())
+    end = datetime.combine(month_end, datetime.min.time())
+    date_lookup = prepare_dim_date(cur, start, end - timedelta(hours=1))
+    user_cache, product_cache = open_key_caches(cur, 1_000_000)
+    date_cache = {}
+    total_inserted = 0
+    chunks = iter_fact_source_pages(cur, 0, chunk_size, through_order_id, (start, end), sizer)
+    if sizer:
+        sizer.restart_clock()
+    for rows, _ in _METRICS.timed(chunks, "extract"):
+        total_inserted += load_fact_chunk(
+            cur, rows, user_cache, product_cache, date_cache, date_lookup, columnar, target_table=load_table
+        )
+        with _METRICS.phase("commit"):
+            conn.commit()
+        if sizer:
+            sizer.record(count_orders(rows))
+    user_cache.close()
+    product_cache.close()
+
+    cur.execute(f"""
+        ALTER TABLE sales_olap.{load_table}
+            ADD CONSTRAINT {load_table}_range CHECK (sale_date >= %s AND sale_date < %s),
+            ADD PRIMARY KEY (fact_sales_id, sale_date)
+    """, (month, month_end))
+    cur.execute("SELECT to_regclass(%s)", (f"sales_olap.{name}",))
+    if cur.fetchone()[0] is not None:
+        cur.execute(f"ALTER TABLE sales_olap.fact_sales DETACH PARTITION sales_olap.{name}")
+        cur.execute(f"DROP TABLE sales_olap.{name}")
+    cur.execute(f"ALTER TABLE sales_olap.{load_table} RENAME TO {name}")
+    cur.execute(f"""
+        ALTER TABLE sales_olap.fact_sales
+        ATTACH PARTITION sales_olap.{name}
+        FOR VALUES FROM (%s) TO (%s)
+    """, (month, month_end))
+    cur.execute(f"ALTER TABLE sales_olap.{name} DROP CONSTRAINT {load_table}_range")
+    refresh_rollups(cur, month, month_end)
+    conn.commit()
+    _known_partitions.add(month)
+    logger.info(f"Rebuilt {name} with {total_inserted} rows.")
+
+def truncate_fact_partition(conn, month):
+    """
+    Empties one month's partition and re-aggregates its rollups, e.g. to
+    take a bad month out of the dashboards until --rebuild-month reloads it.
+    """
+    name = fact_partition_name(month)
+    cur = conn.cursor()
+    cur.execute(f"TRUNCATE sales_olap.{name}")
+    refresh_rollups(cur, month, next_month(month))
+    conn.commit()
+    logger.info(f"Truncated sales_olap.{name}.")
+
+# ------------------------------------------------------------------------------
+# Rollups
+# ------------------------------------------------------------------------------
+# The sales dashboard reads pre-aggregated tables instead of fact_sales:
+#   - agg_sales_hourly: revenue, items and orders per dim_date hour x
+#     main_category x sub_category x brand
+#   - agg_daily_users: distinct users, orders and revenue per day; the
+#     (day, user) pairs already counted are kept in agg_user_days
+# Every fact insert folds the rows it inserted into them in the same
+# statement, so they commit or roll back with the facts. An order's items all
+# share its hour and are never split across statements, so order counts add
+# up. Product attributes are taken at load time; a rebuilt or truncated
+# partition has its month re-aggregated in the same transaction.
+#
+# Parallel shards would contend (and could deadlock) on the same rollup rows
+# for their whole transaction, so they skip the rollups and instead commit an
+# 'agg_refresh:YYYY-MM' etl_metadata marker per month they touched. The
+# coordinator re-aggregates those months afterwards, and so does the next
+# serial run if the coordinator died first.
+ROLLUP_REFRESH_PREFIX = "agg_refresh:"
+
+def rollup_statement(new_facts_sql):
+    """
+    Wraps 'new_facts_sql' (a query, or a data-modifying statement with
+    RETURNING, producing date_id, dim_user_id, dim_product_id, order_id,
+    price and sale_date) into one statement that adds its rows to the
+    rollups.
+    """
+    return f"""
+        WITH new_facts AS (
+            {new_facts_sql}
+        ), hourly AS (
+            INSERT INTO sales_olap.agg_sales_hourly AS a (
+                date_id, sale_date, main_category, sub_category, brand, revenue, items, orders
+            )
+            SELECT f.date_id, f.sale_date,
+                   COALESCE(p.main_category, 'unknown'), COALESCE(p.sub_category, ''),
+                   COALESCE(p.brand, 'unknown'),
+                   COALESCE(SUM(f.price), 0), COUNT(*), COUNT(DISTINCT f.order_id)
+            FROM new_facts f
+            JOIN sales_olap.dim_products p ON p.dim_product_id = f.dim_product_id
+            GROUP BY 1, 2, 3, 4, 5
+            ORDER BY 1, 3, 4, 5
+            ON CONFLICT (date_id, main_category, sub_category, brand) DO UPDATE
+                SET revenue = a.revenue + EXCLUDED.revenue,
+                    items = a.items + EXCLUDED.items,
+                    orders = a.orders + EXCLUDED.orders
+        ), user_days AS (
+            INSERT INTO sales_olap.agg_user_days (sale_date, dim_user_id)
+            SELECT DISTINCT sale_date, dim_user_id
+            FROM new_facts
+            ORDER BY 1, 2
+            ON CONFLICT DO NOTHING
+            RETURNING sale_date
+        ), new_users AS (
+            SELECT sale_date, COUNT(*) AS users
+            FROM user_days
+            GROUP BY sale_date
+        )
+        INSERT INTO sales_olap.agg_daily_users AS a (sale_date, users, orders, revenue)
+        SELECT f.sale_date, COALESCE(MAX(n.users), 0), COUNT(DISTINCT f.order_id), COALESCE(SUM(f.price), 0)
+        FROM new_facts f
+        LEFT JOIN new_users n ON n.sale_date = f.sale_date
+        GROUP BY f.sale_date
+        ORDER BY f.sale_date
+        ON CONFLICT (sale_date) DO UPDATE
+            SET users = a.users + EXCLUDED.users,
+                orders = a.orders + EXCLUDED.orders,
+                revenue = a.revenue + EXCLUDED.revenue
+    """
+
+def refresh_rollups(cur, start, end):
+    """
+    Recomputes the rollups of sale dates in [start, end) from fact_sales.
+    Does not commit.
+    """
+    for table in ("agg_sales_hourly", "agg_user_days", "agg_daily_users"):
+        cur.execute(f"""
+            DELETE FROM sales_olap.{table}
+            WHERE sale_date >= %(start)s AND sale_date < %(end)s
+        """, {"start": start, "end": end})
+    cur.execute(rollup_statement("""
+        SELECT date_id, dim_user_id, dim_product_id, order_id, price, sale_date
+        FROM sales_olap.fact_sales
+        WHERE sale_date >= %(start)s AND sale_date < %(end)s
+    """), {"start": start, "end": end})
+
+def mark_rollups_stale(cur, lower, upper):
+    """
+    Records the months of the orders in (lower, upper] as needing a rollup
+    refresh. Does not commit.
+    """
+    cur.execute("""
+        INSERT INTO sales_oltp.etl_metadata (table_name)
+        SELECT DISTINCT %(prefix)s || to_char(event_time, 'YYYY-MM')
+        FROM sales_oltp.orders
+        WHERE order_id > %(lower)s AND order_id <= %(upper)s
+        ORDER BY 1
+        ON CONFLICT (table_name) DO NOTHING
+    """, {"prefix": ROLLUP_REFRESH_PREFIX, "lower": lower, "upper": upper})
+
+def refresh_stale_rollups(conn):
+    """
+    Re-aggregates every month marked by mark_rollups_stale, one month per
+    transaction together with the removal of its marker.
+    """
+    cur = conn.cursor()
+    for key in checkpoint.names(cur, ROLLUP_REFRESH_PREFIX):
+        month = datetime.strptime(key[len(ROLLUP_REFRESH_PREFIX):], "%Y-%m").date()
+        with _METRICS.phase("load"):
+            refresh_rollups(cur, month, next_month(month))
+            checkpoint.delete(cur, [key])
+        with _METRICS.phase("commit"):
+            conn.commit()
+        logger.info(f"Refreshed rollups for {month:%Y-%m}.")
+
+def rebuild_rollups(conn):
+    """
+    Recomputes the rollups from the whole of fact_sales, one month per
+    transaction. Used to backfill them, or after dimension attributes changed.
+    """
+    cur = conn.cursor()
+    # Only the months that hold facts: orders without an event_time sit on
+    # UNKNOWN_EVENT_TIME, decades before the rest.
     cur.execute("""
-        SELECT last_processed_id
-        FROM sales_oltp.etl_metadata
-        WHERE table_name = 'fact_sales'
+        SELECT DISTINCT date_trunc('month', sale_date)::date
+        FROM sales_olap.fact_sales
+        ORDER BY 1
     """)
-    result = cur.fetchone()
-    last_loaded_order_id = int(result[0]) if result and result[0] else 0
+    months = [month for (month,) in cur.fetchall()]
+    if not months:
+        logger.info("fact_sales is empty; no rollups to rebuild.")
+        return
+    for month in months:
+        with _METRICS.phase("load"):
+            refresh_rollups(cur, month, next_month(month))
+        with _METRICS.phase("commit"):
+            conn.commit()
+        logger.info(f"Rebuilt rollups for {month:%Y-%m}.")
+
+# event_time the OLTP loader gives staging rows without one. Dates derived
+# from it form a single dim_date row and fact_sales_1970_01 partition.
+UNKNOWN_EVENT_TIME = datetime(1970, 1, 1)
+
+def get_fact_watermark(cur):
+    return int(checkpoint.load(cur, "fact_sales") or 0)
+
+def set_fact_watermark(cur, order_id):
+    checkpoint.save(cur, "fact_sales", order_id)
+
+def staged_order_bound(cur, extraction_done=False):
+    """
+    Returns the highest order_id whose items have all been normalized, or
+    None when no staged order is pending. An order's items can arrive in
+    several extract batches, so the bound stops below the lowest order with
+    unconsumed staging rows and, while extraction is still running, below
+    the last order staged (Mongo may still hold more of its items). Assumes
+    order_ids increase with _id, as the fact watermark already does.
+    """
+    cur.execute("""
+        SELECT LEAST(
+                   (SELECT MIN(order_id) FROM sales_oltp.sales_staging WHERE processed = false),
+                   CASE WHEN NOT %s THEN GREATEST(
+                       (SELECT MAX(order_id) FROM sales_oltp.sales_staging),
+                       (SELECT MAX(order_id) FROM sales_oltp.sales_staging_archive)
+                   ) END
+               ) - 1
+    """, (extraction_done,))
+    return cur.fetchone()[0]
+
+def prepare_pending_dim_date(cur, after_order_id, upper_order_id=None):
+    """
+    Pre-generates dim_date for the event_time range of the pending orders so
+    per-row date resolution needs no queries. Orders on UNKNOWN_EVENT_TIME
+    are left out of the range; they resolve to a single dim_date row and
+    partition on their own.
+    """
+    cur.execute("""
+        SELECT MIN(event_time), MAX(event_time)
+        FROM sales_oltp.orders
+        WHERE order_id > %(after)s
+          AND (%(upper)s::bigint IS NULL OR order_id <= %(upper)s)
+          AND event_time <> %(unknown)s
+    """, {"after": after_order_id, "upper": upper_order_id, "unknown": UNKNOWN_EVENT_TIME})
+    min_event_time, max_event_time = cur.fetchone()
+    if min_event_time is None:
+        return None
+    ensure_fact_partitions(cur, min_event_time, max_event_time)
+    return prepare_dim_date(cur, min_event_time, max_event_time)
+
+def dimension_generation(cur, table):
+    """
+    Returns a value that changes whenever the surrogate keys of dimension
+    'table' may have been reassigned: TRUNCATE and DROP/CREATE both give the
+    table new storage (a new relfilenode, or a new oid).
+    """
+    cur.execute("SELECT oid, relfilenode FROM pg_class WHERE oid = %s::regclass", (f"sales_olap.{table}",))
+    oid, relfilenode = cur.fetchone()
+    return (oid << 32) | relfilenode
+
+def open_key_caches(cur, key_cache_size, key_cache_dir=None):
+    """
+    Opens the user and product key caches, backed by their snapshots in
+    'key_cache_dir' when given; a snapshot of an earlier generation of its
+    dimension is discarded.
+    """
+    return tuple(
+        SurrogateKeyCache(
+            table, key_cache_size, os.path.join(key_cache_dir, f"{table}.keys"),
+            dimension_generation(cur, table)
+        ) if key_cache_dir else SurrogateKeyCache(table, key_cache_size)
+        for table in ("dim_users", "dim_products")
+    )
+
+def load_fact_sales_incremental_bulk_with_caching(conn, chunk_size=10000, columnar=False,
+                                                  key_cache_size=1_000_000, key_cache_dir=None,
+                                                  sizer=None, upper_order_id=None):
+    """
+    Incrementally load fact_sales in chunks of 'chunk_size' complete orders
+    with caching, up to 'upper_order_id' (inclusive) when given. Each chunk
+    is read by its own keyset query and committed with the watermark. With
+    'columnar' the fact rows are built with
+    vectorized ColumnBatch operations. With 'key_cache_dir' the
+    user/product key caches are persisted between runs.
+    """
+    logger.info("Starting incremental load for fact_sales...")
+    cur = conn.cursor()
+
+    last_loaded_order_id = advance_fact_watermark(cur)
+    refresh_stale_rollups(conn)
     logger.info(f"Last loaded order_id = {last_loaded_order_id}")
 
-    user_cache = {}
-    product_cache = {}
+    # Shards committed by an earlier parallel run that are not contiguous with
+    # the watermark yet must not be loaded again.
+    completed_shards = get_completed_fact_shards(cur)
+    if completed_shards:
+        shard_start = completed_shards[0][0]
+        upper_order_id = shard_start if upper_order_id is None else min(upper_order_id, shard_start)
+        logger.warning(f"Completed parallel shards found; loading only up to order_id {upper_order_id}.")
+
+    date_lookup = prepare_pending_dim_date(cur, last_loaded_order_id, upper_order_id)
+    user_cache, product_cache = open_key_caches(cur, key_cache_size, key_cache_dir)
     date_cache = {}
     total_inserted = 0
     current_max_id = last_loaded_order_id
 
-    while True:
-        cur.execute("""
-            SELECT o.order_id, o.user_id, o.event_time, oi.product_id, oi.price
-            FROM sales_oltp.orders o
-            JOIN sales_oltp.order_items oi ON o.order_id = oi.order_id
-            WHERE o.order_id > %s
-            ORDER BY o.order_id
-            LIMIT %s
-        """, (current_max_id, chunk_size))
-        rows = cur.fetchall()
-        if not rows:
-            break
-
+    chunks = iter_fact_source_pages(cur, last_loaded_order_id, chunk_size, upper_order_id, sizer=sizer)
+    if sizer:
+        sizer.restart_clock()
+    for rows, chunk_end in _METRICS.timed(chunks, "extract"):
         logger.info(f"Fetched {len(rows)} order rows (order_id > {current_max_id}), processing...")
+        inserted = load_fact_chunk(cur, rows, user_cache, product_cache, date_cache, date_lookup, columnar)
+        # The watermark commits with the chunk, so a restart resumes after
+        # the last committed chunk.
+        set_fact_watermark(cur, chunk_end)
+        with _METRICS.phase("commit"):
+            conn.commit()
+        if sizer:
+            sizer.record(count_orders(rows))
+        total_inserted += inserted
+        current_max_id = chunk_end
+        logger.info(f"Inserted {inserted} rows into fact_sales.")
 
-        user_ids = {user_id for (_, user_id, _, _, _) in rows}
-        product_ids = {product_id for (_, _, _, product_id, _) in rows}
+    logger.info(f"Fact load complete. Total rows inserted: {total_inserted}. Final max_order_id: {current_max_id}")
 
-        if user_ids:
-            cur.execute("""
-                SELECT user_id, dim_user_id
-                FROM sales_olap.dim_users
-                WHERE user_id IN %s
-            """, (tuple(user_ids),))
-            user_cache.update({row[0]: row[1] for row in cur.fetchall()})
-
-        if product_ids:
-            cur.execute("""
-                SELECT product_id, dim_product_id
-                FROM sales_olap.dim_products
-                WHERE product_id IN %s
-            """, (tuple(product_ids),))
-            product_cache.update({row[0]: row[1] for row in cur.fetchall()})
-
-        fact_data = []
-        for (order_id, user_id, event_time, product_id, price) in rows:
-            date_id = load_dim_date(order_timestamp=event_time, date_cache=date_cache)
-            dim_user_id = user_cache.get(user_id)
-            dim_product_id = product_cache.get(product_id)
-
-            if dim_user_id and dim_product_id:
-                fact_data.append((date_id, dim_user_id, dim_product_id, order_id, price))
-                current_max_id = max(current_max_id, order_id)
-
-        if fact_data:
-            insert_sql = """
-                INSERT INTO sales_olap.fact_sales (
-                    date_id, dim_user_id, dim_product_id, order_id, price
-                )
-                VALUES %s
-                ON CONFLICT DO NOTHING
-            """
-            execute_values(cur, insert_sql, fact_data, page_size=1000)
+    for cache in (user_cache, product_cache):
+        logger.info(f"Key cache stats: {cache.stats()}")
+        cache.save_snapshot()
+        cache.close()
+
+# ------------------------------------------------------------------------------
+# Parallel Fact Table Loading
+# ------------------------------------------------------------------------------
+# The pending order_id range is split into shards (lower, upper]. Each shard is
+# loaded and committed as one transaction by a worker process, together with a
+# 'fact_sales:<lower>:<upper>' marker row in etl_metadata. The coordinator then
+# moves the 'fact_sales' watermark across the markers that are contiguous with
+# it, so a failed shard holds the watermark back without completed shards
+# after it being loaded twice on the next run.
+FACT_SHARD_PREFIX = "fact_sales:"
+
+def get_completed_fact_shards(cur):
+    shards = []
+    for key in checkpoint.names(cur, FACT_SHARD_PREFIX):
+        _, lower, upper = key.split(":")
+        shards.append((int(lower), int(upper)))
+    return sorted(shards)
+
+def plan_fact_shards(cur, watermark, num_shards):
+    """
+    Returns (lower, upper] order_id shards covering everything pending after
+    'watermark' that is not already covered by a completed shard. New orders
+    are split at order_id quantiles so shards hold similar numbers of orders.
+    """
+    shards = []
+    lower = watermark
+    for done_lower, done_upper in get_completed_fact_shards(cur):
+        if done_lower > lower:
+            shards.append((lower, done_lower))
+        lower = max(lower, done_upper)
+
+    cur.execute("""
+        SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY order_id),
+               MAX(order_id)
+        FROM sales_oltp.orders
+        WHERE order_id > %s
+    """, ([i / num_shards for i in range(1, num_shards)], lower))
+    quantiles, max_order_id = cur.fetchone()
+    if max_order_id is not None:
+        for upper in sorted(set(quantiles or []) | {max_order_id}):
+            if upper > lower:
+                shards.append((lower, upper))
+                lower = upper
+    return shards
+
+def _load_fact_shard(lower, upper, chunk_size, columnar, key_cache_size, key_cache_dir, itersize, adaptive):
+    # Runs in a spawned worker process with its own connection pool. Snapshots
+    # are only read here; the coordinator's serial runs are the ones that write
+    # them. Returns (rows inserted, the worker's metrics for the parent to merge).
+    metrics.reset()
+    try:
+        with pg_connection() as conn, _METRICS:
+            inserted = load_fact_shard(
+                conn, lower, upper, chunk_size, columnar, key_cache_size, key_cache_dir, itersize,
+                make_sizer(f"fact_sales ({lower}, {upper}]", chunk_size, adaptive)
+            )
+        return inserted, metrics.snapshot()
+    finally:
+        close_all()
+        plans.export()
+
+def load_fact_shard(conn, lower, upper, chunk_size=10000, columnar=False,
+                    key_cache_size=1_000_000, key_cache_dir=None, itersize=None, sizer=None):
+    """
+    Loads the orders in (lower, upper] and records the shard marker and its
+    stale rollup months, all in one transaction. Returns the number of fact
+    rows inserted.
+    """
+    cur = conn.cursor()
+    date_lookup = prepare_pending_dim_date(cur, lower, upper)
+    user_cache, product_cache = open_key_caches(cur, key_cache_size, key_cache_dir)
+    date_cache = {}
+    inserted = 0
+    try:
+        # The shard is one transaction, so the sizer only sees transform and
+        # load time per chunk.
+        chunks = iter_fact_source_chunks(conn, lower, chunk_size, upper, itersize=itersize, sizer=sizer)
+        for rows, _ in _METRICS.timed(chunks, "extract"):
+            inserted += load_fact_chunk(
+                cur, rows, user_cache, product_cache, date_cache, date_lookup, columnar, rollups=False
+            )
+            if sizer:
+                sizer.record(count_orders(rows))
+
+        mark_rollups_stale(cur, lower, upper)
+        checkpoint.mark(cur, f"{FACT_SHARD_PREFIX}{lower}:{upper}", upper)
+        with _METRICS.phase("commit"):
             conn.commit()
-            total_inserted += len(fact_data)
-            logger.info(f"Inserted {len(fact_data)} rows into fact_sales.")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        user_cache.close()
+        product_cache.close()
+    return inserted
 
-        if len(rows) < chunk_size:
+def advance_fact_watermark(cur):
+    """
+    Moves the fact_sales watermark over the completed shards contiguous with
+    it and removes their markers.
+    """
+    watermark = get_fact_watermark(cur)
+    consumed = []
+    for lower, upper in get_completed_fact_shards(cur):
+        if lower > watermark:
             break
+        watermark = max(watermark, upper)
+        consumed.append(f"{FACT_SHARD_PREFIX}{lower}:{upper}")
 
-    cur.execute("""
-        INSERT INTO sales_oltp.etl_metadata (table_name, last_processed_id)
-        VALUES ('fact_sales', %s)
-        ON CONFLICT (table_name)
-        DO UPDATE SET last_processed_id = EXCLUDED.last_processed_id
-    """, (current_max_id,))
-    conn.commit()
-    logger.info(f"Fact load complete. Total rows inserted: {total_inserted}. Final max_order_id: {current_max_id}")
+    if consumed:
+        checkpoint.delete(cur, consumed)
+        set_fact_watermark(cur, watermark)
+    cur.connection.commit()
+    return watermark
+
+def load_fact_sales_parallel(conn, workers=4, shards_per_worker=4, chunk_size=10000, columnar=False,
+                             key_cache_size=1_000_000, key_cache_dir=None, itersize=None, adaptive=False):
+    """
+    Loads the pending order range with 'workers' processes, each committing
+    one shard at a time.
+    """
+    cur = conn.cursor()
+    watermark = get_fact_watermark(cur)
+    logger.info(f"Starting parallel fact load with {workers} workers after order_id {watermark}...")
+    shards = plan_fact_shards(cur, watermark, workers * shards_per_worker)
+    if not shards:
+        logger.info("No pending orders for fact_sales.")
+        return
+
+    # Create partitions and dim_date rows up front so shards do not take DDL
+    # locks on fact_sales or race on dim_date.
+    prepare_pending_dim_date(cur, watermark)
+
+    failed = []
+    total_inserted = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {
+            pool.submit(
+                _load_fact_shard, lower, upper, chunk_size, columnar, key_cache_size, key_cache_dir, itersize,
+                adaptive
+            ): (lower, upper)
+            for lower, upper in shards
+        }
+        for future in as_completed(futures):
+            lower, upper = futures[future]
+            try:
+                inserted, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                total_inserted += inserted
+                logger.info(f"Shard ({lower}, {upper}] complete: {inserted} rows inserted.")
+            except Exception as e:
+                logger.error(f"Shard ({lower}, {upper}] failed and will be retried next run. Error={e}")
+                failed.append((lower, upper))
+
+    watermark = advance_fact_watermark(cur)
+    refresh_stale_rollups(conn)
+    logger.info(
+        f"Parallel fact load complete. Total rows inserted: {total_inserted}. "
+        f"Watermark now {watermark}."
+    )
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(shards)} fact shards failed: {failed}")
 
 # ------------------------------------------------------------------------------
 # Orchestrator
 # ------------------------------------------------------------------------------
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load OLTP data into the OLAP star schema.")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument(
+        "--itersize", type=int, default=None,
+        help="Rows fetched per round trip from the server-side cursor of each parallel fact shard "
+             "(--workers > 1); the other reads are keyset pages of --chunk-size."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Load fact_sales with this many worker processes, one shard per transaction."
+    )
+    parser.add_argument(
+        "--columnar", action="store_true",
+        help="Build fact rows with vectorized columnar batches."
+    )
+    parser.add_argument(
+        "--key-cache-size", type=int, default=1_000_000,
+        help="Maximum in-memory entries per surrogate-key cache."
+    )
+    parser.add_argument(
+        "--key-cache-dir",
+        help="Directory for memory-mapped key cache snapshots; the next run starts warm."
+    )
+    parser.add_argument(
+        "--rebuild-month", action="append", default=[], metavar="YYYY-MM",
+        help="Rebuild this month's fact_sales partition offline and swap it in (repeatable)."
+    )
+    parser.add_argument(
+        "--truncate-month", action="append", default=[], metavar="YYYY-MM",
+        help="Empty this month's fact_sales partition (repeatable); runs before any --rebuild-month, "
+             "so both together reload the month."
+    )
+    parser.add_argument(
+        "--adaptive", action="store_true",
+        help="Adapt batch sizes to measured latency, throughput and RSS (bounds: ETL_BATCH_MIN, "
+             "ETL_BATCH_MAX, ETL_BATCH_TARGET_SECONDS, ETL_MEMORY_BUDGET_MB)."
+    )
+    parser.add_argument(
+        "--rebuild-rollups", action="store_true",
+        help="Recompute the dashboard rollup tables from fact_sales and exit."
+    )
+    parser.add_argument(
+        "--backfill", action="store_true",
+        help="Drop the foreign keys and secondary indexes of fact_sales for the fact load and restore them "
+             "afterwards (see scripts/common/backfill.py)."
+    )
+    parser.add_argument(
+        "--backfill-finish", action="store_true",
+        help="Only restore what an interrupted backfill left dropped, then exit."
+    )
+    parser.add_argument(
+        "--profile-plans", metavar="DIR", default=plans.PLANS_DIR,
+        help="Capture EXPLAIN (ANALYZE, BUFFERS) of each distinct statement on its first run and write "
+             "a plan, latency and index advice report here on exit (see scripts/common/plans.py)."
+    )
+    parser.add_argument(
+        "--metrics-dir", default=metrics.METRICS_DIR,
+        help="Write etl_metrics.json and a Prometheus textfile here on exit."
+    )
+    return parser.parse_args()
+
 def main():
-    logger.info("Starting dimension load...")
-    load_dim_users_bulk()
-    load_dim_products_bulk()
-    logger.info("Dimension load complete.")
+    args = parse_args()
+    if args.profile_plans:
+        plans.enable(args.profile_plans)
+    try:
+        with pg_connection() as conn, _METRICS:
+            if args.backfill_finish:
+                backfill.finish(conn, BACKFILL_TABLES)
+                return
+            if args.truncate_month or args.rebuild_month:
+                for month in args.truncate_month:
+                    truncate_fact_partition(conn, datetime.strptime(month, "%Y-%m").date())
+                for month in args.rebuild_month:
+                    rebuild_fact_partition(
+                        conn, datetime.strptime(month, "%Y-%m").date(),
+                        chunk_size=args.chunk_size, columnar=args.columnar,
+                        sizer=make_sizer("fact_sales", args.chunk_size, args.adaptive)
+                    )
+                return
+            if args.rebuild_rollups:
+                rebuild_rollups(conn)
+                return
 
-    logger.info("Starting fact table incremental load...")
-    load_fact_sales_incremental_bulk_with_caching()
-    logger.info("Fact load complete.")
+            logger.info("Starting dimension load...")
+            load_dim_users_bulk(
+                conn, chunk_size=args.chunk_size,
+                sizer=make_sizer("dim_users", args.chunk_size, args.adaptive)
+            )
+            load_dim_products_bulk(
+                conn, chunk_size=args.chunk_size,
+                sizer=make_sizer("dim_products", args.chunk_size, args.adaptive)
+            )
+            logger.info("Dimension load complete.")
+
+            if args.backfill:
+                backfill.begin(conn, BACKFILL_TABLES)
+            logger.info("Starting fact table incremental load...")
+            if args.workers > 1:
+                load_fact_sales_parallel(
+                    conn, workers=args.workers, chunk_size=args.chunk_size, columnar=args.columnar,
+                    key_cache_size=args.key_cache_size, key_cache_dir=args.key_cache_dir,
+                    itersize=args.itersize, adaptive=args.adaptive
+                )
+            else:
+                load_fact_sales_incremental_bulk_with_caching(
+                    conn, chunk_size=args.chunk_size, columnar=args.columnar,
+                    key_cache_size=args.key_cache_size, key_cache_dir=args.key_cache_dir,
+                    sizer=make_sizer("fact_sales", args.chunk_size, args.adaptive)
+                )
+            logger.info("Fact load complete.")
+            if args.backfill:
+                backfill.finish(conn, BACKFILL_TABLES)
+    finally:
+        metrics.export(args.metrics_dir)
+        plans.export()
 
 if __name__ == "__main__":
     try:
@@ -261,6 +1234,4 @@ if __name__ == "__main__":
     except Exception as e:
         logger.exception(f"Unexpected error in main: {e}")
     finally:
-        cur.close()
-        conn.close()
-        logger.info("Closed Postgres connection.")
+        close_all()
@@ -1,39 +1,99 @@
+import argparse
 import logging
+import os
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from operator import itemgetter
+import numpy as np
 import psycopg2
 from psycopg2.extras import execute_values
-from config.credentials import POSTGRES_CONFIG  # Import the config file
+from config.connections import PG_POOL_MAX_SIZE, close_all, pg_connection, stream_rows
+from scripts.common import backfill, cursors, metrics, plans
+from scripts.common.batching import make_sizer
+from scripts.common.columnar import ColumnBatch
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# PostgreSQL Connection
-PG_CONN = psycopg2.connect(**POSTGRES_CONFIG)  # Unpack POSTGRES_CONFIG dictionary
-PG_CURSOR = PG_CONN.cursor()
+# Each engine takes a psycopg2 connection from config.connections and
+# processes one batch on it. The client-side engines stream the batch from a
+# server-side cursor, 'itersize' rows per round trip, so only the normalized
+# output is held in memory, never a client-side copy of the result set.
+#
+# A batch is claimed with FOR UPDATE SKIP LOCKED and consumed in the same
+# transaction that writes its OLTP rows, so any number of workers can drain
+# staging side by side without overlapping. 'consume' picks what happens to
+# the claimed rows:
+#   - "mark"     set processed = true (the partial index on unprocessed rows
+#                keeps claiming cheap, but every row is rewritten once)
+#   - "archive"  move them to sales_staging_archive, an append-only table
+#                that can be truncated wholesale once reconciled
+#
+# users, categories and products rows record the transaction that inserted or
+# last changed them (change_xid: the column default, or set by the upserts
+# only when a value really changes); the OLAP dimension loaders read their
+# changes by it.
 
-def process_staging_batch(batch_size=10000):
+_METRICS = metrics.stage("oltp")
+cursors.install()
+
+CONSUME_MODES = ("mark", "archive")
+
+# Concurrent workers can still deadlock or hit serialization failures on the
+# shared user/product/category rows; such a batch is rolled back, which also
+# releases its claim, and is retried from the claim up to ETL_BATCH_RETRIES
+# times.
+RETRYABLE_SQLSTATES = ("40P01", "40001")  # deadlock_detected, serialization_failure
+BATCH_RETRIES = int(os.environ.get("ETL_BATCH_RETRIES", "5"))
+
+# Tables whose foreign keys and secondary indexes --backfill defers.
+BACKFILL_TABLES = ("sales_oltp.order_items",)
+
+STAGING_FETCH_QUERY = """
+    SELECT id, mongo_id, event_time, order_id, product_id, category_id,
+           category_code, brand, price, user_id
+    FROM sales_oltp.sales_staging
+    WHERE processed = false
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+
+CONSUME_QUERIES = {
+    "mark": """
+        UPDATE sales_oltp.sales_staging
+           SET processed = true
+         WHERE id = ANY(%s)
+    """,
+    "archive": """
+        WITH consumed AS (
+            DELETE FROM sales_oltp.sales_staging
+             WHERE id = ANY(%s)
+            RETURNING id, mongo_id, event_time, order_id, product_id, category_id,
+                      category_code, brand, price, user_id
+        )
+        INSERT INTO sales_oltp.sales_staging_archive (
+            id, mongo_id, event_time, order_id, product_id, category_id,
+            category_code, brand, price, user_id
+        )
+        SELECT * FROM consumed
+    """,
+}
+
+def process_staging_batch(conn, batch_size=10000, itersize=None, consume="mark"):
     """
     Processes up to 'batch_size' rows from sales_staging where processed = false,
     but with internal deduplication to avoid inserting the same key multiple times
     in a single ON CONFLICT statement.
     """
-    # 1) Fetch unprocessed rows
-    fetch_query = """
-        SELECT id, mongo_id, event_time, order_id, product_id, category_id,
-               category_code, brand, price, user_id
-        FROM sales_oltp.sales_staging
-        WHERE processed = false
-        ORDER BY id
-        LIMIT %s
-    """
-    PG_CURSOR.execute(fetch_query, (batch_size,))
-    rows = PG_CURSOR.fetchall()
-
-    if not rows:
-        logging.info("No unprocessed rows in staging.")
-        return 0
+    # 1) Stream and claim unprocessed rows. Reading and deduplicating are interleaved, so
+    # both are timed as the extract phase.
+    read_start = time.perf_counter()
+    rows = stream_rows(conn, "staging_batch_rows", STAGING_FETCH_QUERY, (batch_size,), itersize)
 
     # Keep track of staging IDs for marking processed
     processed_ids = []
@@ -52,141 +112,503 @@ def process_staging_batch(batch_size=10000):
     # Orders: key = order_id, value = (user_id, event_time)
     order_data = {}
     
-    # Order Items are often row-by-row, but if you want to deduplicate exact duplicates
-    # you could use a set. For example:
-    order_items_data = set()  # each item is (order_id, product_id, price)
+    # Order Items: one item per staging row, keyed by the row's own mongo_id so a
+    # re-staged row (e.g. an archive replay) cannot insert it twice. Collapsing
+    # duplicates here would make the key depend on where the batch boundaries fall.
+    order_items_data = []  # (order_id, product_id, price, mongo_id)
 
     # 2) Loop through staging rows, build in-memory deduplicated sets/dicts
-    for row in rows:
-        staging_id = row[0]
-        event_time = row[2] or '1970-01-01 00:00:00'
-        order_id = row[3] or -1
-        p_id = row[4] or -1
-        c_id = row[5] or -1
-        c_code = row[6] or 'unknown'
-        brand = row[7] or 'unknown'
-        price = row[8] or 0.0
-        u_id = row[9] or -1
-
-        processed_ids.append(staging_id)
-
-        # a) Users: just store user_id in a dict
-        user_data[u_id] = True
-
-        # b) Categories: deduplicate by category_id
-        if c_id in category_data:
-            existing_code = category_data[c_id]
-            if existing_code == 'unknown' and c_code != 'unknown':
+    # A failed claim or fetch leaves the transaction aborted; roll it back so the
+    # retry (or the next batch) starts clean.
+    try:
+        for row in rows:
+            staging_id = row[0]
+            event_time = row[2] or '1970-01-01 00:00:00'
+            order_id = row[3] or -1
+            p_id = row[4] or -1
+            c_id = row[5] or -1
+            c_code = row[6] or 'unknown'
+            brand = row[7] or 'unknown'
+            price = row[8] or 0.0
+            u_id = row[9] or -1
+
+            processed_ids.append(staging_id)
+
+            # a) Users: just store user_id in a dict
+            user_data[u_id] = True
+
+            # b) Categories: deduplicate by category_id
+            if c_id in category_data:
+                existing_code = category_data[c_id]
+                if existing_code == 'unknown' and c_code != 'unknown':
+                    category_data[c_id] = c_code
+            else:
                 category_data[c_id] = c_code
-        else:
-            category_data[c_id] = c_code
 
-        # c) Products: deduplicate by product_id
-        if p_id in product_data:
-            (existing_brand, existing_cat) = product_data[p_id]
-            if existing_brand == 'unknown' and brand != 'unknown':
+            # c) Products: deduplicate by product_id
+            if p_id in product_data:
+                (existing_brand, existing_cat) = product_data[p_id]
+                if existing_brand == 'unknown' and brand != 'unknown':
+                    product_data[p_id] = (brand, c_id)
+            else:
                 product_data[p_id] = (brand, c_id)
-        else:
-            product_data[p_id] = (brand, c_id)
 
-        # d) Orders: deduplicate by order_id
-        if order_id in order_data:
-            (existing_u, existing_time) = order_data[order_id]
-            if existing_time < event_time:
+            # d) Orders: deduplicate by order_id
+            if order_id in order_data:
+                (existing_u, existing_time) = order_data[order_id]
+                if existing_time < event_time:
+                    order_data[order_id] = (u_id, event_time)
+            else:
                 order_data[order_id] = (u_id, event_time)
-        else:
-            order_data[order_id] = (u_id, event_time)
 
-        # e) Order_Items: we might want every row or deduplicate
-        order_items_data.add((order_id, p_id, price))
+            # e) Order_Items: one per staging row
+            order_items_data.append((order_id, p_id, price, row[1]))
+    except Exception as e:
+        logging.error(f"Error reading batch, rolling back. Error={e}")
+        conn.rollback()
+        raise
+    _METRICS.observe("extract", time.perf_counter() - read_start)
+
+    if not processed_ids:
+        logging.info("No unprocessed rows in staging.")
+        return 0
 
     # 3) Bulk inserts with ON CONFLICT
+    return write_normalized_batch(
+        conn,
+        user_list=[(uid,) for uid in user_data.keys()],
+        cat_list=[(cid, ccode) for cid, ccode in category_data.items()],
+        prod_list=[(pid, b, catid) for pid, (b, catid) in product_data.items()],
+        order_list=[(oid, u, t) for oid, (u, t) in order_data.items()],
+        order_items=order_items_data,
+        processed_ids=processed_ids,
+        consume=consume,
+    )
+
+
+def write_normalized_batch(conn, user_list, cat_list, prod_list, order_list, order_items, processed_ids,
+                           consume="mark"):
+    """
+    Upserts one deduplicated batch into the OLTP tables and consumes the
+    claimed staging rows in the same transaction. Returns the number of
+    staging rows handled; rolls back and raises on error.
+    """
+    # Every worker takes its row locks in key order, so two batches touching
+    # the same users or products wait for each other instead of deadlocking.
+    user_list = sorted(user_list)
+    cat_list = sorted(cat_list, key=itemgetter(0))
+    prod_list = sorted(prod_list, key=itemgetter(0))
+    order_list = sorted(order_list, key=itemgetter(0))
+    order_items = sorted(order_items, key=lambda item: item[3] or "")
+
+    cur = conn.cursor()
     try:
+        load_start = time.perf_counter()
+
         # Bulk Insert Users
-        if user_data:
-            user_list = [(uid,) for uid in user_data.keys()]
+        if user_list:
             insert_users_sql = """
                 INSERT INTO sales_oltp.users (user_id)
                 VALUES %s
                 ON CONFLICT (user_id) DO NOTHING
             """
-            execute_values(PG_CURSOR, insert_users_sql, user_list)
+            execute_values(cur, insert_users_sql, user_list)
 
         # Bulk Insert Categories
-        if category_data:
-            cat_list = [(cid, ccode) for cid, ccode in category_data.items()]
+        if cat_list:
             insert_cats_sql = """
                 INSERT INTO sales_oltp.categories (category_id, category_code)
                 VALUES %s
                 ON CONFLICT (category_id) DO UPDATE
-                    SET category_code = EXCLUDED.category_code
+                    SET category_code = EXCLUDED.category_code,
+                        change_xid = txid_current()
+                    WHERE categories.category_code IS DISTINCT FROM EXCLUDED.category_code
             """
-            execute_values(PG_CURSOR, insert_cats_sql, cat_list)
+            execute_values(cur, insert_cats_sql, cat_list)
 
         # Bulk Insert Products
-        if product_data:
-            prod_list = [(pid, b, catid) for pid, (b, catid) in product_data.items()]
+        if prod_list:
             insert_prods_sql = """
                 INSERT INTO sales_oltp.products (product_id, brand, category_id)
                 VALUES %s
                 ON CONFLICT (product_id) DO UPDATE
                     SET brand = EXCLUDED.brand,
-                        category_id = EXCLUDED.category_id
+                        category_id = EXCLUDED.category_id,
+                        change_xid = txid_current()
+                    WHERE (products.brand, products.category_id)
+                          IS DISTINCT FROM (EXCLUDED.brand, EXCLUDED.category_id)
             """
-            execute_values(PG_CURSOR, insert_prods_sql, prod_list)
+            execute_values(cur, insert_prods_sql, prod_list)
 
-        # Bulk Insert Orders
-        if order_data:
-            order_list = [(oid, u, t) for oid, (u, t) in order_data.items()]
+        # Bulk Insert Orders (an order split across batches keeps its latest event_time)
+        if order_list:
             insert_orders_sql = """
                 INSERT INTO sales_oltp.orders (order_id, user_id, event_time)
                 VALUES %s
-                ON CONFLICT (order_id) DO NOTHING
+                ON CONFLICT (order_id) DO UPDATE
+                    SET user_id = EXCLUDED.user_id,
+                        event_time = EXCLUDED.event_time
+                    WHERE orders.event_time < EXCLUDED.event_time
             """
-            execute_values(PG_CURSOR, insert_orders_sql, order_list)
+            execute_values(cur, insert_orders_sql, order_list)
 
         # Bulk Insert Order_Items
-        if order_items_data:
+        if order_items:
             insert_oit_sql = """
-                INSERT INTO sales_oltp.order_items (order_id, product_id, price)
+                INSERT INTO sales_oltp.order_items (order_id, product_id, price, source_mongo_id)
                 VALUES %s
+                ON CONFLICT (source_mongo_id) DO NOTHING
             """
-            execute_values(PG_CURSOR, insert_oit_sql, list(order_items_data))
+            execute_values(cur, insert_oit_sql, order_items)
 
-        # Commit after successful bulk inserts
-        PG_CONN.commit()
+        # Consume the claimed staging rows; committing together with the
+        # inserts releases the claim only once the batch is durable.
+        cur.execute(CONSUME_QUERIES[consume], (processed_ids,))
+        _METRICS.observe("load", time.perf_counter() - load_start)
 
-        # Mark these staging rows as processed
-        update_query = """
-            UPDATE sales_oltp.sales_staging
-               SET processed = true
-             WHERE id = ANY(%s)
-        """
-        PG_CURSOR.execute(update_query, (processed_ids,))
-        PG_CONN.commit()
-        logging.info(f"Marked {len(processed_ids)} rows as processed.")
+        with _METRICS.phase("commit"):
+            conn.commit()
+        _METRICS.add_batch(len(processed_ids))
+        logging.info(f"Consumed ({consume}) {len(processed_ids)} staging rows.")
 
     except Exception as e:
         logging.error(f"Error processing batch, rolling back. Error={e}")
-        PG_CONN.rollback()
-        return 0
+        conn.rollback()
+        raise
 
     return len(processed_ids)
 
 
-def main():
+# ------------------------------------------------------------------------------
+# Columnar engine
+# ------------------------------------------------------------------------------
+STAGING_SCHEMA = (
+    ("id", np.int64, None),
+    ("mongo_id", object, None),
+    ("event_time", "datetime64[us]", datetime(1970, 1, 1)),
+    ("order_id", np.int64, -1),
+    ("product_id", np.int64, -1),
+    ("category_id", np.int64, -1),
+    ("category_code", object, "unknown"),
+    ("brand", object, "unknown"),
+    ("price", np.float64, 0.0),
+    ("user_id", np.int64, -1),
+)
+
+def process_staging_batch_columnar(conn, batch_size=10000, itersize=None, consume="mark"):
+    """
+    Same as process_staging_batch, but dedups the batch with vectorized
+    operations on a ColumnBatch instead of per-row dicts and sets.
+    """
     try:
+        with _METRICS.phase("extract"):
+            rows = stream_rows(conn, "staging_batch_rows", STAGING_FETCH_QUERY, (batch_size,), itersize)
+            batch = ColumnBatch.from_rows(rows, STAGING_SCHEMA)
+    except Exception as e:
+        logging.error(f"Error reading batch, rolling back. Error={e}")
+        conn.rollback()
+        raise
+
+    if not len(batch):
+        logging.info("No unprocessed rows in staging.")
+        return 0
+
+    with _METRICS.phase("transform"):
+        categories = batch.unique_by("category_id", prefer=batch["category_code"] != "unknown")
+        products = batch.unique_by("product_id", prefer=batch["brand"] != "unknown")
+        orders = batch.latest_by("order_id", "event_time")
+
+    return write_normalized_batch(
+        conn,
+        user_list=[(uid,) for uid in np.unique(batch["user_id"]).tolist()],
+        cat_list=categories.rows("category_id", "category_code"),
+        prod_list=products.rows("product_id", "brand", "category_id"),
+        order_list=orders.rows("order_id", "user_id", "event_time"),
+        order_items=batch.rows("order_id", "product_id", "price", "mongo_id"),
+        processed_ids=batch["id"].tolist(),
+        consume=consume,
+    )
+
+
+# ------------------------------------------------------------------------------
+# Set-based engine
+# ------------------------------------------------------------------------------
+# Same normalization as process_staging_batch, expressed as INSERT ... SELECT
+# over a temp copy of the batch so the rows never leave the server. The
+# COALESCE(NULLIF(...)) defaults mirror the Python "value or default" checks,
+# and the DISTINCT ON orderings reproduce its dedup rules:
+#   - categories/products prefer the first row with a non-'unknown' code/brand
+#   - orders keep the first row carrying the latest event_time, also across
+#     batches when an order's items are split between them
+#   - order items are not deduplicated: each row is one item, keyed by its mongo_id
+# The batch is claimed and consumed by one statement (SQL_ENGINE_CLAIMS) whose
+# RETURNING rows fill the temp table.
+SQL_ENGINE_BATCH_COLUMNS = """
+    id,
+    mongo_id,
+    COALESCE(event_time, '1970-01-01 00:00:00') AS event_time,
+    COALESCE(NULLIF(order_id, 0), -1) AS order_id,
+    COALESCE(NULLIF(product_id, 0), -1) AS product_id,
+    COALESCE(NULLIF(category_id, 0), -1) AS category_id,
+    COALESCE(NULLIF(category_code, ''), 'unknown') AS category_code,
+    COALESCE(NULLIF(brand, ''), 'unknown') AS brand,
+    COALESCE(NULLIF(price, 0), 0.0) AS price,
+    COALESCE(NULLIF(user_id, 0), -1) AS user_id
+"""
+
+SQL_ENGINE_SETUP = f"""
+    CREATE TEMP TABLE staging_batch ON COMMIT DROP AS
+    SELECT {SQL_ENGINE_BATCH_COLUMNS}
+    FROM sales_oltp.sales_staging
+    WITH NO DATA
+"""
+
+SQL_ENGINE_CLAIMED_IDS = """
+    SELECT id
+    FROM sales_oltp.sales_staging
+    WHERE processed = false
+    ORDER BY id
+    LIMIT %(batch_size)s
+    FOR UPDATE SKIP LOCKED
+"""
+
+SQL_ENGINE_CLAIMS = {
+    "mark": f"""
+    WITH claimed AS (
+        UPDATE sales_oltp.sales_staging
+           SET processed = true
+         WHERE id IN ({SQL_ENGINE_CLAIMED_IDS})
+        RETURNING *
+    )
+    INSERT INTO staging_batch
+    SELECT {SQL_ENGINE_BATCH_COLUMNS}
+    FROM claimed
+    """,
+    "archive": f"""
+    WITH claimed AS (
+        DELETE FROM sales_oltp.sales_staging
+         WHERE id IN ({SQL_ENGINE_CLAIMED_IDS})
+        RETURNING id, mongo_id, event_time, order_id, product_id, category_id,
+                  category_code, brand, price, user_id
+    ), archived AS (
+        INSERT INTO sales_oltp.sales_staging_archive (
+            id, mongo_id, event_time, order_id, product_id, category_id,
+            category_code, brand, price, user_id
+        )
+        SELECT * FROM claimed
+    )
+    INSERT INTO staging_batch
+    SELECT {SQL_ENGINE_BATCH_COLUMNS}
+    FROM claimed
+    """,
+}
+
+SQL_ENGINE_STATEMENTS = (
+    """
+    INSERT INTO sales_oltp.users (user_id)
+    SELECT DISTINCT user_id
+    FROM staging_batch
+    ORDER BY user_id
+    ON CONFLICT (user_id) DO NOTHING
+    """,
+    """
+    INSERT INTO sales_oltp.categories (category_id, category_code)
+    SELECT DISTINCT ON (category_id) category_id, category_code
+    FROM staging_batch
+    ORDER BY category_id, category_code = 'unknown', id
+    ON CONFLICT (category_id) DO UPDATE
+        SET category_code = EXCLUDED.category_code,
+            change_xid = txid_current()
+        WHERE categories.category_code IS DISTINCT FROM EXCLUDED.category_code
+    """,
+    """
+    INSERT INTO sales_oltp.products (product_id, brand, category_id)
+    SELECT DISTINCT ON (product_id) product_id, brand, category_id
+    FROM staging_batch
+    ORDER BY product_id, brand = 'unknown', id
+    ON CONFLICT (product_id) DO UPDATE
+        SET brand = EXCLUDED.brand,
+            category_id = EXCLUDED.category_id,
+            change_xid = txid_current()
+        WHERE (products.brand, products.category_id)
+              IS DISTINCT FROM (EXCLUDED.brand, EXCLUDED.category_id)
+    """,
+    """
+    INSERT INTO sales_oltp.orders (order_id, user_id, event_time)
+    SELECT DISTINCT ON (order_id) order_id, user_id, event_time
+    FROM staging_batch
+    ORDER BY order_id, event_time DESC, id
+    ON CONFLICT (order_id) DO UPDATE
+        SET user_id = EXCLUDED.user_id,
+            event_time = EXCLUDED.event_time
+        WHERE orders.event_time < EXCLUDED.event_time
+    """,
+    """
+    INSERT INTO sales_oltp.order_items (order_id, product_id, price, source_mongo_id)
+    SELECT order_id, product_id, price, mongo_id
+    FROM staging_batch
+    ORDER BY mongo_id
+    ON CONFLICT (source_mongo_id) DO NOTHING
+    """,
+)
+
+def process_staging_batch_sql(conn, batch_size=10000, itersize=None, consume="mark"):
+    """
+    Processes up to 'batch_size' unprocessed staging rows entirely on the
+    server, in one transaction per batch. No rows are fetched, so 'itersize'
+    is unused.
+    """
+    cur = conn.cursor()
+    try:
+        with _METRICS.phase("load"):
+            cur.execute(SQL_ENGINE_SETUP)
+            cur.execute(SQL_ENGINE_CLAIMS[consume], {"batch_size": batch_size})
+            num_processed = cur.rowcount
+            if num_processed:
+                for statement in SQL_ENGINE_STATEMENTS:
+                    cur.execute(statement)
+        with _METRICS.phase("commit"):
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Error processing batch, rolling back. Error={e}")
+        conn.rollback()
+        raise
+
+    if num_processed == 0:
+        logging.info("No unprocessed rows in staging.")
+    else:
+        _METRICS.add_batch(num_processed)
+        logging.info(f"Consumed ({consume}) {num_processed} staging rows.")
+    return num_processed
+
+
+ENGINES = {
+    "python": process_staging_batch,
+    "sql": process_staging_batch_sql,
+    "columnar": process_staging_batch_columnar,
+}
+
+
+def process_with_retry(process_batch, conn, **kwargs):
+    """
+    Runs one batch of engine 'process_batch', retrying it with jittered
+    backoff when it was rolled back on a deadlock or serialization failure.
+    Any other error, or the last failed retry, is raised.
+    """
+    for attempt in range(1, BATCH_RETRIES + 1):
+        try:
+            return process_batch(conn, **kwargs)
+        except psycopg2.Error as e:
+            if e.pgcode not in RETRYABLE_SQLSTATES or attempt == BATCH_RETRIES:
+                raise
+            delay = random.uniform(0, 0.05 * 2 ** attempt)
+            logging.warning(f"Batch rolled back ({e.pgcode}); retry {attempt} in {delay:.2f} seconds.")
+            time.sleep(delay)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Normalize sales_staging rows into the OLTP tables.")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--itersize", type=int, default=None,
+        help="Rows fetched per round trip from the server-side staging cursor."
+    )
+    parser.add_argument(
+        "--engine", choices=sorted(ENGINES), default="python",
+        help="'python' dedups batches client-side, 'sql' runs set-based INSERT ... SELECT on the server."
+    )
+    parser.add_argument(
+        "--consume", choices=CONSUME_MODES, default="mark",
+        help="Mark consumed staging rows as processed, or move them to sales_staging_archive."
+    )
+    parser.add_argument(
+        "--adaptive", action="store_true",
+        help="Adapt batch sizes to measured latency, throughput and RSS (bounds: ETL_BATCH_MIN, "
+             "ETL_BATCH_MAX, ETL_BATCH_TARGET_SECONDS, ETL_MEMORY_BUDGET_MB)."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Concurrent workers draining staging, each on its own pooled connection "
+             "(capped at ETL_PG_POOL_SIZE)."
+    )
+    parser.add_argument(
+        "--backfill", action="store_true",
+        help="Drop the foreign keys and secondary indexes of order_items for the load and restore them "
+             "afterwards (see scripts/common/backfill.py)."
+    )
+    parser.add_argument(
+        "--unlogged", action="store_true",
+        help="With --backfill, load into an empty table as UNLOGGED; after a crash the staging rows it "
+             "lost are re-staged by the next --backfill or --backfill-finish."
+    )
+    parser.add_argument(
+        "--backfill-finish", action="store_true",
+        help="Only restore what an interrupted backfill left dropped, then exit."
+    )
+    parser.add_argument(
+        "--profile-plans", metavar="DIR", default=plans.PLANS_DIR,
+        help="Capture EXPLAIN (ANALYZE, BUFFERS) of each distinct statement on its first run and write "
+             "a plan, latency and index advice report here on exit (see scripts/common/plans.py)."
+    )
+    parser.add_argument(
+        "--metrics-dir", default=metrics.METRICS_DIR,
+        help="Write etl_metrics.json and a Prometheus textfile here on exit."
+    )
+    return parser.parse_args()
+
+
+def drain_staging(args):
+    """
+    Processes batches until no unclaimed rows are left. Returns the number
+    of staging rows this worker consumed.
+    """
+    process_batch = ENGINES[args.engine]
+    sizer = make_sizer("oltp", args.batch_size, args.adaptive)
+    total = 0
+    with pg_connection() as conn, _METRICS:
         while True:
-            num_processed = process_staging_batch(batch_size=10000)
+            num_processed = process_with_retry(
+                process_batch, conn, batch_size=sizer.size if sizer else args.batch_size,
+                itersize=args.itersize, consume=args.consume
+            )
             if num_processed == 0:
                 logging.info("No more rows to process. Exiting.")
                 break
             else:
+                if sizer:
+                    sizer.record(num_processed)
+                total += num_processed
                 logging.info(f"Processed {num_processed} rows this iteration.\n")
+    return total
+
+
+def main():
+    args = parse_args()
+    workers = max(1, min(args.workers, PG_POOL_MAX_SIZE))
+    if args.profile_plans:
+        plans.enable(args.profile_plans)
+    try:
+        if args.backfill_finish:
+            with pg_connection() as conn:
+                backfill.finish(conn, BACKFILL_TABLES)
+            return
+        if args.backfill:
+            with pg_connection() as conn:
+                backfill.begin(conn, BACKFILL_TABLES, unlogged=args.unlogged)
+        if workers == 1:
+            drain_staging(args)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(drain_staging, args) for _ in range(workers)]
+                total = sum(future.result() for future in futures)
+            logging.info(f"{workers} workers processed {total} staging rows.")
+        if args.backfill:
+            with pg_connection() as conn:
+                backfill.finish(conn, BACKFILL_TABLES)
     finally:
-        PG_CURSOR.close()
-        PG_CONN.close()
-        logging.info("Closed database connection.")
+        close_all()
+        metrics.export(args.metrics_dir)
+        plans.export()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,295 @@
+"""
+Streaming micro-batch orchestrator for the whole pipeline.
+
+Runs the three stages as concurrent threads instead of three scripts run one
+after another:
+
+    extract    Mongo -> sales_staging, one micro-batch at a time
+    normalize  sales_staging -> OLTP tables
+    publish    OLTP -> OLAP dimensions and fact_sales
+
+Each stage hands a token downstream for every batch it completes, over a
+bounded queue. A slow stage fills its input queue and stalls the stage
+before it (backpressure) instead of letting work pile up. On SIGINT/SIGTERM
+extraction stops after its current batch and the downstream stages drain
+what was already extracted before exiting.
+
+    PYTHONPATH=. python scripts/orchestrator.py --loader copy --engine sql
+"""
+import argparse
+import logging
+import queue
+import signal
+import sys
+import threading
+import time
+
+from config.connections import close_all, get_mongo_collection, pg_connection
+from scripts.common import metrics, plans
+from scripts.common.batching import make_sizer
+from scripts.olap_load import oltp_to_olap
+from scripts.oltp_load import staging_oltp
+from scripts.staging_load import mongo_to_staging
+
+logger = logging.getLogger(__name__)
+
+_STAGE_DONE = object()
+
+# Pipeline stage -> metrics stage its database round trips are counted under.
+STAGE_METRICS = {"extract": "staging", "normalize": "oltp", "publish": "olap"}
+
+
+def _put(q, item, stop):
+    # Blocks while the downstream stage is behind; gives up only if the
+    # pipeline is failing, so a dead consumer cannot hang its producer.
+    while True:
+        try:
+            q.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            if stop.failed:
+                return
+
+
+def _drain(q):
+    """
+    Blocks for the next token, then takes every token already queued so a
+    stage that fell behind catches up in one pass.
+    """
+    items = [q.get()]
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            return items
+
+
+class PipelineStop:
+    """
+    Shutdown flags shared by the stages. 'requested' asks extraction to stop
+    cleanly; 'failed' is set when any stage raised; 'drained' is set while
+    Mongo has nothing left to extract.
+    """
+
+    def __init__(self):
+        self.requested = threading.Event()
+        self.drained = threading.Event()
+        self.failed = False
+        self.errors = []
+
+    def fail(self, error):
+        self.errors.append(error)
+        self.failed = True
+        self.requested.set()
+
+
+def extract_stage(conn, args, out_q, stop):
+    collection = get_mongo_collection()
+    sizer = make_sizer("staging", args.batch_size, args.adaptive)
+    try:
+        while not stop.requested.is_set():
+            loaded = mongo_to_staging.load_staging_batch(
+                conn, collection, batch_size=sizer.size if sizer else args.batch_size,
+                loader=args.loader, extract=args.extract
+            )
+            if sizer:
+                sizer.record(loaded)
+            if loaded:
+                stop.drained.clear()
+                _put(out_q, loaded, stop)
+            elif args.once:
+                stop.drained.set()
+                break
+            else:
+                stop.drained.set()
+                stop.requested.wait(args.poll_interval)
+            if sizer:
+                # Time spent blocked on backpressure or polling is not batch cost.
+                sizer.restart_clock()
+    finally:
+        _put(out_q, _STAGE_DONE, stop)
+
+
+def normalize_stage(conn, args, in_q, out_q, stop):
+    process_batch = staging_oltp.ENGINES[args.engine]
+    sizer = make_sizer("oltp", args.batch_size, args.adaptive)
+    try:
+        while True:
+            tokens = _drain(in_q)
+            # Drain staging completely: it may hold rows from earlier runs too.
+            processed = 0
+            if sizer:
+                sizer.restart_clock()
+            while not stop.failed:
+                num_processed = staging_oltp.process_with_retry(
+                    process_batch, conn, batch_size=sizer.size if sizer else args.batch_size,
+                    itersize=args.itersize, consume=args.consume
+                )
+                if num_processed == 0:
+                    break
+                if sizer:
+                    sizer.record(num_processed)
+                processed += num_processed
+            if processed:
+                _put(out_q, processed, stop)
+            if _STAGE_DONE in tokens or stop.failed:
+                return
+    finally:
+        _put(out_q, _STAGE_DONE, stop)
+
+
+def publish(conn, args, sizers, extraction_done=False):
+    """
+    Publishes the orders whose items have all been normalized, dimensions
+    first. Does nothing while no new order is complete. Returns True when
+    staged orders were held back for a later pass.
+    """
+    cur = conn.cursor()
+    bound = oltp_to_olap.staged_order_bound(cur, extraction_done)
+    watermark = oltp_to_olap.get_fact_watermark(cur)
+    conn.commit()
+    if bound is not None and bound <= watermark:
+        logger.info(f"No complete orders after order_id {watermark} yet; nothing to publish.")
+        return True
+
+    start = time.time()
+    oltp_to_olap.load_dim_users_bulk(
+        conn, chunk_size=args.chunk_size, sizer=sizers["dim_users"]
+    )
+    oltp_to_olap.load_dim_products_bulk(
+        conn, chunk_size=args.chunk_size, sizer=sizers["dim_products"]
+    )
+    oltp_to_olap.load_fact_sales_incremental_bulk_with_caching(
+        conn, chunk_size=args.chunk_size, columnar=args.columnar, key_cache_dir=args.key_cache_dir,
+        sizer=sizers["fact_sales"], upper_order_id=bound
+    )
+    logger.info(f"Published micro-batch to OLAP in {time.time() - start:.2f} seconds.")
+    metrics.export(args.metrics_dir)
+    return bound is not None
+
+
+def publish_stage(conn, args, in_q, stop):
+    # One sizer per loader, kept across micro-batches.
+    sizers = {
+        name: make_sizer(name, args.chunk_size, args.adaptive)
+        for name in ("dim_users", "dim_products", "fact_sales")
+    }
+    held_back = False
+    while True:
+        tokens = _drain(in_q)
+        if stop.failed:
+            return
+        done = _STAGE_DONE in tokens
+        # Orders held back while extraction ran are complete once Mongo ran
+        # dry; an interrupted extraction keeps them for the next run.
+        if any(token is not _STAGE_DONE for token in tokens) or (done and held_back):
+            held_back = publish(conn, args, sizers, extraction_done=done and stop.drained.is_set())
+        if done:
+            return
+
+
+def _run_stage(name, target, stop, *args):
+    # Every stage borrows its own pooled connection for its whole lifetime and
+    # counts its round trips under its own metrics stage.
+    try:
+        with pg_connection() as conn, metrics.stage(STAGE_METRICS[name]):
+            target(conn, *args)
+        logger.info(f"Stage {name} stopped.")
+    except Exception as e:
+        logger.exception(f"Stage {name} failed: {e}")
+        stop.fail(e)
+
+
+def run_pipeline(args):
+    """
+    Starts the three stages and waits for them to finish. Returns the list of
+    stage errors (empty on a clean shutdown).
+    """
+    stop = PipelineStop()
+    staged = queue.Queue(maxsize=args.queue_size)
+    normalized = queue.Queue(maxsize=args.queue_size)
+
+    def request_stop(signum, frame):
+        logger.info(f"Received signal {signum}; finishing in-flight batches before exiting.")
+        stop.requested.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    threads = [
+        threading.Thread(target=_run_stage, name="extract",
+                         args=("extract", extract_stage, stop, args, staged, stop)),
+        threading.Thread(target=_run_stage, name="normalize",
+                         args=("normalize", normalize_stage, stop, args, staged, normalized, stop)),
+        threading.Thread(target=_run_stage, name="publish",
+                         args=("publish", publish_stage, stop, args, normalized, stop)),
+    ]
+    for thread in threads:
+        thread.start()
+    # join with a timeout so the main thread keeps handling signals
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(timeout=0.5)
+    return stop.errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run all pipeline stages as concurrent micro-batch stages.")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument(
+        "--itersize", type=int, default=None,
+        help="Rows fetched per round trip from the server-side cursors of the OLTP stage; the OLAP "
+             "stage reads keyset pages of --chunk-size."
+    )
+    parser.add_argument("--loader", choices=sorted(mongo_to_staging.LOADERS), default="values")
+    parser.add_argument("--extract", choices=("full", "projected"), default="full")
+    parser.add_argument("--engine", choices=sorted(staging_oltp.ENGINES), default="python")
+    parser.add_argument("--consume", choices=staging_oltp.CONSUME_MODES, default="mark")
+    parser.add_argument("--columnar", action="store_true")
+    parser.add_argument("--key-cache-dir")
+    parser.add_argument(
+        "--adaptive", action="store_true",
+        help="Adapt batch sizes to measured latency, throughput and RSS (bounds: ETL_BATCH_MIN, "
+             "ETL_BATCH_MAX, ETL_BATCH_TARGET_SECONDS, ETL_MEMORY_BUDGET_MB)."
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=2,
+        help="Completed batches a stage may run ahead of the next one."
+    )
+    parser.add_argument(
+        "--poll-interval", type=float, default=5.0,
+        help="Seconds to wait before polling Mongo again when it has no new documents."
+    )
+    parser.add_argument(
+        "--once", action="store_true",
+        help="Exit once Mongo has no new documents instead of polling."
+    )
+    parser.add_argument(
+        "--profile-plans", metavar="DIR", default=plans.PLANS_DIR,
+        help="Capture EXPLAIN (ANALYZE, BUFFERS) of each distinct statement on its first run and write "
+             "a plan, latency and index advice report here on exit (see scripts/common/plans.py)."
+    )
+    parser.add_argument(
+        "--metrics-dir", default=metrics.METRICS_DIR,
+        help="Write etl_metrics.json and a Prometheus textfile here after every published micro-batch."
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.profile_plans:
+        plans.enable(args.profile_plans)
+    try:
+        errors = run_pipeline(args)
+    finally:
+        close_all()
+        metrics.export(args.metrics_dir)
+        plans.export()
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
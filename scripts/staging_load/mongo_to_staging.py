@@ -1,10 +1,19 @@
+import argparse
+import io
 import logging
+import multiprocessing
+import queue
+import signal
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from bson import decode_all, json_util
 from bson.objectid import ObjectId
-from pymongo import MongoClient
-import psycopg2
 from psycopg2.extras import execute_values
-from config.credentials import MONGO_CONFIG, POSTGRES_CONFIG
+from pymongo.errors import OperationFailure
+from config.connections import close_all, get_mongo_collection, pg_connection
+from scripts.common import archive, checkpoint, cursors, metrics, plans
+from scripts.common.batching import make_sizer
 
 # ------------------------------------------------------------------------------
 # Configure logging
@@ -14,126 +23,766 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# ------------------------------------------------------------------------------
-# MongoDB Connection
-# ------------------------------------------------------------------------------
-mongo_client = MongoClient(MONGO_CONFIG["uri"])
-mongo_db = mongo_client[MONGO_CONFIG["database"]]
-mongo_collection = mongo_db[MONGO_CONFIG["collection"]]
+# Connections come from config.connections: functions take a psycopg2 cursor
+# ('cur') or connection ('conn') and a Mongo 'collection' as arguments.
 
-# ------------------------------------------------------------------------------
-# PostgreSQL Connection
-# ------------------------------------------------------------------------------
-PG_CONN = psycopg2.connect(
-    dbname=POSTGRES_CONFIG["dbname"],
-    user=POSTGRES_CONFIG["user"],
-    password=POSTGRES_CONFIG["password"],
-    host=POSTGRES_CONFIG["host"],
-    port=POSTGRES_CONFIG["port"]
-)
-PG_CURSOR = PG_CONN.cursor()
+_METRICS = metrics.stage("staging")
+cursors.install()
 
 # ------------------------------------------------------------------------------
 # Helper functions
 # ------------------------------------------------------------------------------
-def get_last_processed_id():
-    query = """
-        SELECT last_processed_id
-        FROM sales_oltp.etl_metadata
-        WHERE table_name = 'sales_staging'
-    """
-    PG_CURSOR.execute(query)
-    result = PG_CURSOR.fetchone()
-    if result and result[0]:
-        logging.info(f"Current stored last_processed_id in metadata: {result[0]}")
-        return ObjectId(result[0])
+def get_last_processed_id(cur, table_name="sales_staging"):
+    last_id = checkpoint.load(cur, table_name)
+    if last_id:
+        logging.info(f"Current stored last_processed_id in metadata for {table_name}: {last_id}")
+        return ObjectId(last_id)
     else:
         logging.info("No last_processed_id found in metadata (first run?).")
         return None
 
-def update_last_processed_id(last_id):
-    query = """
-        INSERT INTO sales_oltp.etl_metadata (table_name, last_processed_id)
-        VALUES ('sales_staging', %s)
-        ON CONFLICT (table_name)
-        DO UPDATE SET last_processed_id = EXCLUDED.last_processed_id
+def build_id_filter(last_processed_id, upper_id=None):
+    id_range = {}
+    if last_processed_id:
+        id_range["$gt"] = last_processed_id
+    if upper_id:
+        id_range["$lte"] = upper_id
+    return {"_id": id_range} if id_range else {}
+
+# ------------------------------------------------------------------------------
+# Extraction
+# ------------------------------------------------------------------------------
+# Only the fields the staging table needs; _id is included by Mongo by default.
+STAGING_PROJECTION = {
+    "event_time": 1,
+    "order_id": 1,
+    "product_id": 1,
+    "category_id": 1,
+    "category_code": 1,
+    "brand": 1,
+    "price": 1,
+    "user_id": 1,
+}
+
+def iter_documents(collection, query_filter, extract="full", batch_size=10000, limit=0, **find_kwargs):
+    """
+    Yields documents in _id order. 'full' decodes whole documents through the
+    regular cursor; 'projected' asks Mongo for the staging fields only and
+    decodes each raw BSON batch in one decode_all() call. Decoding the raw
+    batches column-wise in Python instead, without a dict per document, is
+    slower than bson's C decoder (see benchmarks/staging_extract_bench.py).
     """
-    PG_CURSOR.execute(query, (str(last_id),))
-    PG_CONN.commit()
-    logging.info(f"Updated metadata table with last_processed_id: {last_id}")
+    if extract == "projected":
+        cursor = collection.find_raw_batches(query_filter, STAGING_PROJECTION, **find_kwargs)
+    else:
+        cursor = collection.find(query_filter, **find_kwargs)
+    cursor = cursor.sort("_id", 1).limit(limit).batch_size(batch_size)
+    try:
+        if extract == "projected":
+            for raw_batch in cursor:
+                yield from decode_all(raw_batch)
+        else:
+            yield from cursor
+    finally:
+        cursor.close()
 
-def load_to_staging(batch_size=10000):
-    while True:
-        start_time = time.time()
-        last_processed_id = get_last_processed_id()
-        query_filter = {"_id": {"$gt": last_processed_id}} if last_processed_id else {}
+# ------------------------------------------------------------------------------
+# COPY loader
+# ------------------------------------------------------------------------------
+STAGING_COLUMNS = (
+    "mongo_id, event_time, order_id, product_id, category_id, "
+    "category_code, brand, price, user_id"
+)
+
+# One buffer per thread, reused across batches so the COPY payload does not
+# reallocate every time.
+_copy_buffers = threading.local()
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def _copy_text(value):
+    if value is None:
+        return "\\N"
+    return str(value).translate(_COPY_ESCAPES)
+
+def serialize_copy_rows(batch, buf):
+    """
+    Writes the staging row of every document straight into 'buf' in COPY text
+    format, applying the same defaults as the execute_values path.
+    """
+    write = buf.write
+    for doc in batch:
+        write("\t".join((
+            str(doc["_id"]),
+            _copy_text(doc.get("event_time", "1970-01-01 00:00:00")),
+            _copy_text(doc.get("order_id", -1)),
+            _copy_text(doc.get("product_id", -1)),
+            _copy_text(doc.get("category_id", -1)),
+            _copy_text(doc.get("category_code", "unknown")),
+            _copy_text(doc.get("brand", "unknown")),
+            repr(float(doc.get("price", 0.0))),
+            _copy_text(doc.get("user_id", -1)),
+        )))
+        write("\n")
+
+def serialize_copy_batch(batch, buf=None):
+    """
+    Resets 'buf' (the calling thread's reusable buffer by default), fills it
+    with the COPY payload for 'batch' and rewinds it.
+    """
+    if buf is None:
+        if not hasattr(_copy_buffers, "buf"):
+            _copy_buffers.buf = io.StringIO()
+        buf = _copy_buffers.buf
+    buf.seek(0)
+    buf.truncate(0)
+    serialize_copy_rows(batch, buf)
+    buf.seek(0)
+    return buf
+
+def copy_to_staging(cur, buf, copy_options=""):
+    """
+    Streams a serialized batch into sales_staging with COPY FROM STDIN (text
+    format unless 'copy_options' says otherwise). Rows are copied into a
+    session temp table first and merged so conflicts on mongo_id are still
+    skipped.
+    """
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS sales_staging_load
+        ON COMMIT DELETE ROWS
+        AS SELECT {STAGING_COLUMNS}
+        FROM sales_oltp.sales_staging
+        WITH NO DATA
+    """)
+    cur.copy_expert(
+        f"COPY sales_staging_load ({STAGING_COLUMNS}) FROM STDIN {copy_options}",
+        buf
+    )
+    cur.execute(f"""
+        INSERT INTO sales_oltp.sales_staging ({STAGING_COLUMNS})
+        SELECT {STAGING_COLUMNS}
+        FROM sales_staging_load
+        ON CONFLICT (mongo_id) DO NOTHING
+    """)
+
+def transform_batch(batch):
+    return [
+        (
+            str(doc["_id"]),
+            doc.get("event_time", "1970-01-01 00:00:00"),
+            doc.get("order_id", -1),
+            doc.get("product_id", -1),
+            doc.get("category_id", -1),
+            doc.get("category_code", "unknown"),
+            doc.get("brand", "unknown"),
+            float(doc.get("price", 0.0)),
+            doc.get("user_id", -1)
+        )
+        for doc in batch
+    ]
+
+def values_to_staging(cur, staging_data):
+    insert_query = """
+        INSERT INTO sales_oltp.sales_staging (
+            mongo_id,
+            event_time,
+            order_id,
+            product_id,
+            category_id,
+            category_code,
+            brand,
+            price,
+            user_id
+        )
+        VALUES %s
+        ON CONFLICT DO NOTHING
+    """
+    execute_values(cur, insert_query, staging_data)
+
+# loader name -> (transform documents into a payload, write payload to staging)
+LOADERS = {
+    "values": (transform_batch, values_to_staging),
+    "copy": (serialize_copy_batch, copy_to_staging),
+}
+
+def load_staging_batch(conn, collection, batch_size=10000, loader="values",
+                       table_name="sales_staging", upper_id=None, extract="full", archive_dir=None):
+    """
+    Loads the next batch of documents after the checkpoint stored under
+    'table_name' (up to 'upper_id' inclusive, when given) and advances the
+    checkpoint. With 'archive_dir' the batch is also written to the local
+    archive before it is committed. Returns the number of documents loaded,
+    0 when none are left.
+    """
+    transform, write = LOADERS[loader]
+    cur = conn.cursor()
+    start_time = time.time()
+    with _METRICS.phase("extract"):
+        last_processed_id = get_last_processed_id(cur, table_name)
+        query_filter = build_id_filter(last_processed_id, upper_id)
 
         logging.info(f"Fetching a batch of up to {batch_size} records from Mongo...")
-        batch = list(
-            mongo_collection.find(query_filter)
-                            .sort("_id", 1)
-                            .limit(batch_size)
+        batch = list(iter_documents(collection, query_filter, extract, batch_size, limit=batch_size))
+    if not batch:
+        return 0
+
+    logging.info(f"Batch size: {len(batch)}")
+    logging.info(f"First ID in batch: {batch[0]['_id']} | Last ID in batch: {batch[-1]['_id']}")
+
+    with _METRICS.phase("transform") as timer:
+        payload = transform(batch)
+    logging.info(f"Transformed data in {timer.seconds:.2f} seconds.")
+
+    with _METRICS.phase("load") as timer:
+        write(cur, payload)
+    logging.info(f"Loaded data into staging table ({loader}) in {timer.seconds:.2f} seconds.")
+
+    if archive_dir:
+        with _METRICS.phase("archive"):
+            archive.write_batch(archive_dir, batch)
+
+    # The checkpoint commits with the batch: a restart resumes right after it.
+    checkpoint.save(cur, table_name, batch[-1]["_id"])
+    with _METRICS.phase("commit"):
+        conn.commit()
+    _METRICS.add_batch(len(batch))
+
+    total_time = time.time() - start_time
+    logging.info(f"Processed batch of {len(batch)} records in {total_time:.2f} seconds.\n")
+    return len(batch)
+
+def load_to_staging(conn, collection, batch_size=10000, loader="values",
+                    table_name="sales_staging", upper_id=None, extract="full", archive_dir=None,
+                    sizer=None, stop=None):
+    """
+    Loads batches of documents after the checkpoint stored under 'table_name'
+    until Mongo runs dry, or until 'upper_id' (inclusive) when one is given.
+    With an AdaptiveBatchSizer ('sizer') each batch takes its current size.
+    Returns False when 'stop' (a threading.Event) was set between batches.
+    """
+    while stop is None or not stop.is_set():
+        loaded = load_staging_batch(
+            conn, collection, sizer.size if sizer else batch_size, loader,
+            table_name, upper_id, extract, archive_dir
         )
-        if not batch:
+        if not loaded:
             logging.info("No more records to process. Exiting loop.")
-            break
-
-        logging.info(f"Batch size: {len(batch)}")
-        logging.info(f"First ID in batch: {batch[0]['_id']} | Last ID in batch: {batch[-1]['_id']}")
-
-        transform_start = time.time()
-        staging_data = [
-            (
-                str(doc["_id"]),
-                doc.get("event_time", "1970-01-01 00:00:00"),
-                doc.get("order_id", -1),
-                doc.get("product_id", -1),
-                doc.get("category_id", -1),
-                doc.get("category_code", "unknown"),
-                doc.get("brand", "unknown"),
-                float(doc.get("price", 0.0)),
-                doc.get("user_id", -1)
+            return True
+        if sizer:
+            sizer.record(loaded)
+    logging.info("Stop requested; the next run resumes after the last committed batch.")
+    return False
+
+# ------------------------------------------------------------------------------
+# Pipelined loader
+# ------------------------------------------------------------------------------
+_PIPELINE_DONE = object()
+
+def _put(q, item, stop):
+    # Blocks while the queue is full (backpressure) but gives up once another
+    # stage has failed, so no thread is left waiting on a dead consumer.
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(q, stop):
+    while True:
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            if stop.is_set():
+                return _PIPELINE_DONE
+
+def _run_stage(target, errors, stop, *args):
+    try:
+        target(*args)
+    except Exception as e:
+        logging.exception(f"Pipeline stage {target.__name__} failed: {e}")
+        errors.append(e)
+        stop.set()
+
+def _fetch_stage(collection, query_filter, batch_size, extract, out_q, stop, sizer=None):
+    """
+    Walks a single sorted Mongo cursor and hands off (batch, size) pairs of
+    'batch_size' documents, or the sizer's size when the batch was started.
+    """
+    cursor = iter_documents(collection, query_filter, extract, batch_size, no_cursor_timeout=True)
+    try:
+        batch = []
+        size = sizer.size if sizer else batch_size
+        batch_start = time.perf_counter()
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= size:
+                _METRICS.observe("extract", time.perf_counter() - batch_start)
+                if not _put(out_q, (batch, size), stop):
+                    return
+                batch = []
+                size = sizer.size if sizer else batch_size
+                batch_start = time.perf_counter()
+        if batch:
+            _put(out_q, (batch, size), stop)
+    finally:
+        cursor.close()
+        _put(out_q, _PIPELINE_DONE, stop)
+
+def _transform_stage(transform, archive_batches, in_q, out_q, stop):
+    while True:
+        item = _get(in_q, stop)
+        if item is _PIPELINE_DONE:
+            _put(out_q, _PIPELINE_DONE, stop)
+            return
+        batch, size = item
+        with _METRICS.phase("transform"):
+            payload = transform(batch)
+            table = archive.batch_table(batch) if archive_batches else None
+        if not _put(out_q, (payload, table, len(batch), batch[0]["_id"], batch[-1]["_id"], size), stop):
+            return
+
+def load_to_staging_pipelined(conn, collection, batch_size=10000, loader="values",
+                              queue_size=4, extract="full", archive_dir=None, sizer=None):
+    """
+    Runs fetch, transform and load concurrently over one long-lived Mongo
+    cursor. Stages are connected by bounded queues of 'queue_size' batches;
+    the watermark is kept in memory and only persisted after each batch
+    has been committed to staging (and archived, with 'archive_dir').
+    """
+    transform, write = LOADERS[loader]
+    if loader == "copy":
+        # Batches are in flight on several threads at once, so each one
+        # needs its own buffer rather than the thread's reusable one.
+        transform = lambda batch: serialize_copy_batch(batch, io.StringIO())
+
+    cur = conn.cursor()
+    last_processed_id = get_last_processed_id(cur)
+    query_filter = build_id_filter(last_processed_id)
+
+    fetched = queue.Queue(maxsize=queue_size)
+    transformed = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    threads = [
+        threading.Thread(
+            target=_run_stage, name="staging-fetch",
+            args=(_fetch_stage, errors, stop, collection, query_filter, batch_size, extract, fetched, stop, sizer)
+        ),
+        threading.Thread(
+            target=_run_stage, name="staging-transform",
+            args=(_transform_stage, errors, stop, transform, bool(archive_dir), fetched, transformed, stop)
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+
+    total_rows = 0
+    run_start = time.time()
+    try:
+        while True:
+            item = _get(transformed, stop)
+            if item is _PIPELINE_DONE:
+                break
+            payload, table, num_rows, first_id, last_id, size = item
+
+            with _METRICS.phase("load") as timer:
+                write(cur, payload)
+            if table is not None:
+                with _METRICS.phase("archive"):
+                    archive.write_table(archive_dir, table)
+            checkpoint.save(cur, "sales_staging", last_id)
+            with _METRICS.phase("commit"):
+                conn.commit()
+            _METRICS.add_batch(num_rows)
+            if sizer:
+                # Up to 2 * queue_size batches were fetched ahead at the size
+                # of their time; only the current size's batches resize.
+                sizer.record(num_rows, size=size)
+            last_processed_id = last_id
+            total_rows += num_rows
+            logging.info(
+                f"Loaded {num_rows} records ({first_id} .. {last_id}) "
+                f"in {timer.seconds:.2f} seconds."
             )
-            for doc in batch
-        ]
-        transform_end = time.time()
-        logging.info(f"Transformed data in {transform_end - transform_start:.2f} seconds.")
-
-        load_start = time.time()
-        insert_query = """
-            INSERT INTO sales_oltp.sales_staging (
-                mongo_id,
-                event_time,
-                order_id,
-                product_id,
-                category_id,
-                category_code,
-                brand,
-                price,
-                user_id
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    elapsed = time.time() - run_start
+    logging.info(
+        f"Pipelined load complete: {total_rows} records in {elapsed:.2f} seconds. "
+        f"Last processed id: {last_processed_id}"
+    )
+
+# ------------------------------------------------------------------------------
+# Range-partitioned parallel loader
+# ------------------------------------------------------------------------------
+# Each partition covers the _id range (lower, upper] and checkpoints under its
+# own etl_metadata row named 'sales_staging:<lower>:<upper>'. The rows double
+# as the partition plan, so a crashed run resumes with the same ranges.
+PARTITION_PREFIX = "sales_staging:"
+
+def _partition_key(lower_id, upper_id):
+    return f"{PARTITION_PREFIX}{lower_id or 'min'}:{upper_id}"
+
+def get_partition_plan(cur):
+    """
+    Returns the [(key, upper_id)] list of an unfinished partitioned run, if any.
+    """
+    plan = [(key, ObjectId(key.rsplit(":", 1)[1])) for key in checkpoint.names(cur, PARTITION_PREFIX)]
+    return sorted(plan, key=lambda item: item[1])
+
+def plan_partitions(cur, collection, num_partitions):
+    """
+    Splits the pending _id space into 'num_partitions' ranges of equal ObjectId
+    timestamp span and registers a checkpoint row for each.
+    """
+    last_processed_id = get_last_processed_id(cur)
+    query_filter = build_id_filter(last_processed_id)
+    first = collection.find_one(query_filter, {"_id": 1}, sort=[("_id", 1)])
+    if first is None:
+        return []
+    newest = collection.find_one(query_filter, {"_id": 1}, sort=[("_id", -1)])
+
+    start = first["_id"].generation_time
+    step = (newest["_id"].generation_time - start) / num_partitions
+    bounds = sorted({
+        ObjectId.from_datetime(start + step * i) for i in range(1, num_partitions)
+    } | {newest["_id"]})
+    bounds = [b for b in bounds if not last_processed_id or b > last_processed_id]
+
+    plan = []
+    lower_id = last_processed_id
+    for upper_id in bounds:
+        key = _partition_key(lower_id, upper_id)
+        checkpoint.mark(cur, key, lower_id)
+        plan.append((key, upper_id))
+        lower_id = upper_id
+    cur.connection.commit()
+    logging.info(f"Planned {len(plan)} partitions up to _id {newest['_id']}.")
+    return plan
+
+def _load_partition(key, upper_id, batch_size, loader, extract, archive_dir, adaptive):
+    # Runs in a spawned worker process, which lazily opens its own connections.
+    # Returns the worker's metrics for the parent to merge.
+    metrics.reset()
+    try:
+        with pg_connection() as conn:
+            load_to_staging(
+                conn, get_mongo_collection(), batch_size=batch_size, loader=loader,
+                table_name=key, upper_id=ObjectId(upper_id), extract=extract, archive_dir=archive_dir,
+                sizer=make_sizer(f"staging {key}", batch_size, adaptive)
             )
-            VALUES %s
-            ON CONFLICT DO NOTHING
-        """
-        execute_values(PG_CURSOR, insert_query, staging_data)
-        PG_CONN.commit()
-        load_end = time.time()
-        logging.info(f"Loaded data into staging table in {load_end - load_start:.2f} seconds.")
+    finally:
+        close_all()
+        plans.export()
+    return metrics.snapshot()
+
+def load_to_staging_partitioned(conn, collection, num_partitions, batch_size=10000,
+                                loader="values", extract="full", archive_dir=None, adaptive=False):
+    """
+    Loads disjoint _id ranges concurrently with a process pool. Once every
+    partition has finished, the global 'sales_staging' checkpoint is moved to
+    the end of the plan and the partition rows are removed.
+    """
+    cur = conn.cursor()
+    plan = get_partition_plan(cur)
+    if plan:
+        logging.info(f"Resuming {len(plan)} unfinished partitions.")
+    else:
+        plan = plan_partitions(cur, collection, num_partitions)
+    if not plan:
+        logging.info("No more records to process.")
+        return
+
+    failed = []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_partitions, mp_context=context) as pool:
+        futures = {
+            pool.submit(
+                _load_partition, key, str(upper_id), batch_size, loader, extract, archive_dir, adaptive
+            ): key
+            for key, upper_id in plan
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                metrics.merge(future.result())
+                logging.info(f"Partition {key} complete.")
+            except Exception as e:
+                logging.error(f"Partition {key} failed, it will resume on the next run. Error={e}")
+                failed.append(key)
 
-        new_last_id = batch[-1]["_id"]
-        update_last_processed_id(new_last_id)
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(plan)} partitions failed: {failed}")
 
-        total_time = time.time() - start_time
-        logging.info(f"Processed batch of {len(batch)} records in {total_time:.2f} seconds.\n")
+    checkpoint.delete(cur, checkpoint.names(cur, PARTITION_PREFIX))
+    checkpoint.save(cur, "sales_staging", plan[-1][1])
+    conn.commit()
+    logging.info(f"Moved the sales_staging checkpoint to {plan[-1][1]}.")
+
+# ------------------------------------------------------------------------------
+# Change stream tail
+# ------------------------------------------------------------------------------
+# A long-running mode that reads inserts from a change stream (which needs a
+# replica set; a single-node one is enough) and loads them in micro-batches
+# of up to 'batch_size' documents or 'max_latency' seconds. The resume token
+# of the last loaded change and the highest _id it loaded are stored in their
+# own checkpoint, TAIL_CHECKPOINT, in the same transaction as the batch.
+#
+# Change events come in commit order, not _id order, so the stream does not
+# move the 'sales_staging' _id watermark of the catch-up scan: a document
+# with a lower _id can still commit after one with a higher _id. On startup
+# the stream is opened first and the catch-up scan runs before tailing:
+#   - resuming from the stored token, the stream replays everything after
+#     it, so the scan first skips ahead to the highest _id streamed
+#   - with no token, or one no longer in the oplog, the scan starts from its
+#     own watermark, so inserts missed while the stream was down are loaded
+# Documents seen by both are skipped by the mongo_id unique key.
+TAIL_CHECKPOINT = "sales_staging_tail"
+TAIL_PIPELINE = [{"$match": {"operationType": "insert"}}]
+
+# ChangeStreamFatalError, ChangeStreamHistoryLost: the token cannot be resumed.
+_RESUME_LOST_CODES = (280, 286)
+
+def get_resume_token(cur):
+    # Tokens stored before TAIL_CHECKPOINT existed sit on the scan's row.
+    resume_token = checkpoint.load_resume_token(cur, TAIL_CHECKPOINT) \
+        or checkpoint.load_resume_token(cur, "sales_staging")
+    return json_util.loads(resume_token) if resume_token else None
+
+def save_tail_checkpoint(cur, last_id, resume_token):
+    """
+    Stores the resume token and the highest _id streamed so far (never
+    moving back). Does not commit.
+    """
+    checkpoint.save(cur, TAIL_CHECKPOINT, last_id, resume_token=json_util.dumps(resume_token), monotonic=True)
+
+def open_change_stream(collection, resume_token, max_latency):
+    """
+    Returns (stream, resumed): the stream after 'resume_token' and True, or,
+    without a token or when it fell out of the oplog, a new stream and False.
+    """
+    options = {"max_await_time_ms": max(1, int(max_latency * 1000))}
+    try:
+        return collection.watch(TAIL_PIPELINE, resume_after=resume_token, **options), resume_token is not None
+    except OperationFailure as e:
+        if resume_token is None or e.code not in _RESUME_LOST_CODES:
+            raise
+        logging.warning(
+            f"Stored resume token is no longer valid ({e}); catching up by _id from the scan watermark."
+        )
+        return collection.watch(TAIL_PIPELINE, **options), False
+
+def load_change_batch(conn, changes, loader="values", archive_dir=None):
+    """
+    Loads (and archives, with 'archive_dir') the inserted documents of
+    'changes' and checkpoints the last change, committing both together.
+    """
+    transform, write = LOADERS[loader]
+    cur = conn.cursor()
+    batch = [change["fullDocument"] for change in changes]
+
+    with _METRICS.phase("transform"):
+        payload = transform(batch)
+    with _METRICS.phase("load") as timer:
+        write(cur, payload)
+        save_tail_checkpoint(cur, max(doc["_id"] for doc in batch), changes[-1]["_id"])
+    if archive_dir:
+        # Change events come in commit order; archive files are keyed by _id.
+        with _METRICS.phase("archive"):
+            archive.write_batch(archive_dir, sorted(batch, key=lambda doc: doc["_id"]))
+    with _METRICS.phase("commit"):
+        conn.commit()
+    _METRICS.add_batch(len(batch))
+    logging.info(f"Loaded {len(batch)} streamed records in {timer.seconds:.2f} seconds.")
+    return len(batch)
+
+def tail_to_staging(conn, collection, batch_size=10000, loader="values", max_latency=1.0, stop=None,
+                    archive_dir=None, sizer=None):
+    """
+    Catches up by _id, then loads change stream inserts until 'stop' (a
+    threading.Event) is set; the catch-up also stops between batches once
+    'stop' is set. 'sizer' only sizes the catch-up batches; the stream's
+    micro-batches are bounded by 'max_latency'.
+    """
+    cur = conn.cursor()
+    stream, resumed = open_change_stream(collection, get_resume_token(cur), max_latency)
+    if resumed:
+        streamed_id = checkpoint.load(cur, TAIL_CHECKPOINT)
+        if streamed_id:
+            checkpoint.save(cur, "sales_staging", streamed_id, monotonic=True)
+    conn.commit()
+    try:
+        if not load_to_staging(conn, collection, batch_size, loader, archive_dir=archive_dir,
+                               sizer=sizer, stop=stop):
+            return
+        logging.info("Caught up with the collection; tailing the change stream.")
+
+        changes = []
+        batch_start = None
+        while stop is None or not stop.is_set():
+            change = stream.try_next()
+            if change is not None:
+                if not changes:
+                    batch_start = time.perf_counter()
+                changes.append(change)
+            if changes and (
+                change is None or len(changes) >= batch_size
+                or time.perf_counter() - batch_start >= max_latency
+            ):
+                _METRICS.observe("extract", time.perf_counter() - batch_start)
+                load_change_batch(conn, changes, loader, archive_dir)
+                changes = []
+        if changes:
+            load_change_batch(conn, changes, loader, archive_dir)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        stream.close()
+    logging.info("Stopped tailing the change stream.")
+
+# ------------------------------------------------------------------------------
+# Archive replay
+# ------------------------------------------------------------------------------
+def replay_from_archive(conn, archive_dir, lower_id=None, upper_id=None):
+    """
+    Reloads sales_staging from the local archive for the _id range
+    (lower_id, upper_id], without touching Mongo or the checkpoints. Each
+    archive file is memory-mapped, copied in as CSV and committed on its own;
+    rows already in staging are skipped.
+    """
+    cur = conn.cursor()
+    total_rows = 0
+    run_start = time.time()
+    buf = io.BytesIO()
+    for table in _METRICS.timed(archive.read_range(archive_dir, lower_id, upper_id), "extract"):
+        with _METRICS.phase("transform"):
+            buf.seek(0)
+            buf.truncate(0)
+            archive.write_csv(table, buf)
+            buf.seek(0)
+        with _METRICS.phase("load"):
+            copy_to_staging(cur, buf, "WITH (FORMAT csv)")
+        with _METRICS.phase("commit"):
+            conn.commit()
+        _METRICS.add_batch(table.num_rows, buf.tell())
+        total_rows += table.num_rows
+    logging.info(f"Replayed {total_rows} archived records in {time.time() - run_start:.2f} seconds.")
+    return total_rows
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load MongoDB sales documents into sales_staging.")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--loader", choices=sorted(LOADERS), default="values",
+        help="'values' uses execute_values, 'copy' streams rows with COPY FROM STDIN."
+    )
+    parser.add_argument(
+        "--extract", choices=("full", "projected"), default="full",
+        help="'projected' fetches only the staging fields as raw BSON batches."
+    )
+    parser.add_argument(
+        "--pipelined", action="store_true",
+        help="Overlap Mongo fetch, transform and Postgres load on separate threads."
+    )
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument(
+        "--partitions", type=int, default=1,
+        help="Split the pending _id range and load it with this many worker processes."
+    )
+    parser.add_argument(
+        "--tail", action="store_true",
+        help="Catch up, then keep loading new inserts from a change stream until stopped."
+    )
+    parser.add_argument(
+        "--max-latency", type=float, default=1.0,
+        help="With --tail, seconds a streamed document may wait before its micro-batch is loaded."
+    )
+    parser.add_argument(
+        "--adaptive", action="store_true",
+        help="Adapt batch sizes to measured latency, throughput and RSS (bounds: ETL_BATCH_MIN, "
+             "ETL_BATCH_MAX, ETL_BATCH_TARGET_SECONDS, ETL_MEMORY_BUDGET_MB)."
+    )
+    parser.add_argument(
+        "--archive-dir",
+        help="Also write every loaded batch to a local Arrow archive here (the source for --replay)."
+    )
+    parser.add_argument(
+        "--replay", action="store_true",
+        help="Reload sales_staging from --archive-dir instead of reading Mongo."
+    )
+    parser.add_argument("--replay-after", metavar="ID", help="With --replay, only _ids above this one.")
+    parser.add_argument("--replay-through", metavar="ID", help="With --replay, only _ids up to this one.")
+    parser.add_argument(
+        "--profile-plans", metavar="DIR", default=plans.PLANS_DIR,
+        help="Capture EXPLAIN (ANALYZE, BUFFERS) of each distinct statement on its first run and write "
+             "a plan, latency and index advice report here on exit (see scripts/common/plans.py)."
+    )
+    parser.add_argument(
+        "--metrics-dir", default=metrics.METRICS_DIR,
+        help="Write etl_metrics.json and a Prometheus textfile here on exit."
+    )
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    if args.replay and not args.archive_dir:
+        raise SystemExit("--replay needs --archive-dir.")
+    if args.profile_plans:
+        plans.enable(args.profile_plans)
+    sizer = make_sizer("staging", args.batch_size, args.adaptive)
     try:
-        load_to_staging(batch_size=10000)
+        with pg_connection() as conn, _METRICS:
+            if args.replay:
+                replay_from_archive(conn, args.archive_dir, args.replay_after, args.replay_through)
+                return
+            collection = get_mongo_collection()
+            if args.tail:
+                stop = threading.Event()
+
+                def request_stop(signum, frame):
+                    logging.info(f"Received signal {signum}; finishing the current batch before exiting.")
+                    stop.set()
+
+                signal.signal(signal.SIGINT, request_stop)
+                signal.signal(signal.SIGTERM, request_stop)
+                tail_to_staging(
+                    conn, collection, batch_size=args.batch_size, loader=args.loader,
+                    max_latency=args.max_latency, stop=stop, archive_dir=args.archive_dir, sizer=sizer
+                )
+            elif args.partitions > 1:
+                load_to_staging_partitioned(
+                    conn, collection, args.partitions, batch_size=args.batch_size,
+                    loader=args.loader, extract=args.extract, archive_dir=args.archive_dir,
+                    adaptive=args.adaptive
+                )
+            elif args.pipelined:
+                load_to_staging_pipelined(
+                    conn, collection, batch_size=args.batch_size, loader=args.loader,
+                    queue_size=args.queue_size, extract=args.extract, archive_dir=args.archive_dir,
+                    sizer=sizer
+                )
+            else:
+                load_to_staging(
+                    conn, collection, batch_size=args.batch_size,
+                    loader=args.loader, extract=args.extract, archive_dir=args.archive_dir,
+                    sizer=sizer
+                )
     finally:
-        PG_CURSOR.close()
-        PG_CONN.close()
-        mongo_client.close()
-        logging.info("Closed all database connections.")
+        close_all()
+        metrics.export(args.metrics_dir)
+        plans.export()
 
 if __name__ == "__main__":
     main()
@@ -18,6 +18,9 @@ CREATE TABLE IF NOT EXISTS sales_olap.dim_date
 
 -- Table: sales_olap.dim_products
 
+-- src_hash (also on dim_users) is added to older databases by
+-- sql/migrations/002_dimension_change_tracking.sql.
+
 
 CREATE TABLE IF NOT EXISTS sales_olap.dim_products
 (
@@ -28,6 +31,7 @@ CREATE TABLE IF NOT EXISTS sales_olap.dim_products
     main_category character varying(255) COLLATE pg_catalog."default",
     sub_category character varying(255) COLLATE pg_catalog."default",
     sub_sub_category character varying(255) COLLATE pg_catalog."default",
+    src_hash character(32) COLLATE pg_catalog."default",
     CONSTRAINT dim_products_pkey PRIMARY KEY (dim_product_id),
     CONSTRAINT dim_products_product_id_uk UNIQUE (product_id)
 )
@@ -40,29 +44,123 @@ CREATE TABLE IF NOT EXISTS sales_olap.dim_users
     dim_user_id integer NOT NULL DEFAULT nextval('sales_olap.dim_users_dim_user_id_seq'::regclass),
     user_id bigint,
     user_name character varying(255) COLLATE pg_catalog."default",
+    src_hash character(32) COLLATE pg_catalog."default",
     CONSTRAINT dim_users_pkey PRIMARY KEY (dim_user_id),
     CONSTRAINT dim_users_user_id_key UNIQUE (user_id)
 )
 
 -- Table: sales_olap.fact_sales
 
+-- Range-partitioned by sale_date (the date part of the order's event_time),
+-- one partition per month named fact_sales_YYYY_MM. The OLAP loader creates
+-- partitions on demand, e.g.:
+--
+--   CREATE TABLE sales_olap.fact_sales_2020_04 PARTITION OF sales_olap.fact_sales
+--       FOR VALUES FROM ('2020-04-01') TO ('2020-05-01');
+--
+-- A fact_sales created before partitioning is converted by
+-- sql/migrations/001_partition_fact_sales.sql.
 
 CREATE TABLE IF NOT EXISTS sales_olap.fact_sales
 (
     fact_sales_id integer NOT NULL DEFAULT nextval('sales_olap.fact_sales_fact_sales_id_seq'::regclass),
     date_id integer NOT NULL,
+    sale_date date NOT NULL,
     dim_user_id integer NOT NULL,
     dim_product_id integer NOT NULL,
     order_id bigint NOT NULL,
     price numeric(10,2),
-    CONSTRAINT fact_sales_pkey PRIMARY KEY (fact_sales_id),
+    CONSTRAINT fact_sales_pkey PRIMARY KEY (fact_sales_id, sale_date),
     CONSTRAINT fact_sales_date_id_fkey FOREIGN KEY (date_id)
-        REFERENCES sales_olap.dim_date (date_id) 
+        REFERENCES sales_olap.dim_date (date_id),
     CONSTRAINT fact_sales_dim_product_id_fkey FOREIGN KEY (dim_product_id)
-        REFERENCES sales_olap.dim_products (dim_product_id) 
+        REFERENCES sales_olap.dim_products (dim_product_id),
     CONSTRAINT fact_sales_dim_user_id_fkey FOREIGN KEY (dim_user_id)
-        REFERENCES sales_olap.dim_users (dim_user_id) 
-)
+        REFERENCES sales_olap.dim_users (dim_user_id)
+) PARTITION BY RANGE (sale_date);
+
+-- Hour lookups of the reconciliation bucket queries.
+CREATE INDEX IF NOT EXISTS fact_sales_date_id_idx
+    ON sales_olap.fact_sales (date_id);
+
+-- Dashboard rollups, maintained by the fact loader in the same transaction as
+-- the fact rows (see "Rollups" in scripts/olap_load/oltp_to_olap.py). An
+-- order's items share its hour, so 'orders' counts the orders with at least
+-- one item in the row's category and brand.
+
+-- Table: sales_olap.agg_sales_hourly
+
+CREATE TABLE IF NOT EXISTS sales_olap.agg_sales_hourly
+(
+    date_id integer NOT NULL,
+    sale_date date NOT NULL,
+    main_category character varying(255) COLLATE pg_catalog."default" NOT NULL,
+    sub_category character varying(255) COLLATE pg_catalog."default" NOT NULL,
+    brand character varying(255) COLLATE pg_catalog."default" NOT NULL,
+    revenue numeric(14,2) NOT NULL,
+    items bigint NOT NULL,
+    orders bigint NOT NULL,
+    CONSTRAINT agg_sales_hourly_pkey PRIMARY KEY (date_id, main_category, sub_category, brand),
+    CONSTRAINT agg_sales_hourly_date_id_fkey FOREIGN KEY (date_id)
+        REFERENCES sales_olap.dim_date (date_id)
+);
+
+CREATE INDEX IF NOT EXISTS agg_sales_hourly_sale_date_idx
+    ON sales_olap.agg_sales_hourly (sale_date);
+
+-- Table: sales_olap.agg_daily_users
+
+CREATE TABLE IF NOT EXISTS sales_olap.agg_daily_users
+(
+    sale_date date NOT NULL,
+    users bigint NOT NULL,
+    orders bigint NOT NULL,
+    revenue numeric(14,2) NOT NULL,
+    CONSTRAINT agg_daily_users_pkey PRIMARY KEY (sale_date)
+);
+
+-- Table: sales_olap.agg_user_days
+
+-- The (day, user) pairs already counted in agg_daily_users.users.
+
+CREATE TABLE IF NOT EXISTS sales_olap.agg_user_days
+(
+    sale_date date NOT NULL,
+    dim_user_id integer NOT NULL,
+    CONSTRAINT agg_user_days_pkey PRIMARY KEY (sale_date, dim_user_id)
+);
+
+-- Table: sales_olap.reconciliation_buckets
+
+-- Per-hour summary of each layer kept by scripts/etl testing/reconciliation.py.
+-- Orders are bucketed by their latest event_time; order hashes are the XOR of
+-- hashtextextended(order_id::text, 0) over the bucket's orders.
+
+CREATE TABLE IF NOT EXISTS sales_olap.reconciliation_buckets
+(
+    bucket_hour timestamp without time zone NOT NULL,
+    staging_items bigint NOT NULL,
+    staging_orders bigint NOT NULL,
+    staging_order_hash bigint NOT NULL,
+    staging_revenue numeric NOT NULL,
+    staging_pending bigint NOT NULL,
+    oltp_items bigint NOT NULL,
+    oltp_orders bigint NOT NULL,
+    oltp_order_hash bigint NOT NULL,
+    oltp_revenue numeric NOT NULL,
+    oltp_pending bigint NOT NULL,
+    fact_items bigint NOT NULL,
+    fact_orders bigint NOT NULL,
+    fact_order_hash bigint NOT NULL,
+    fact_revenue numeric NOT NULL,
+    status character varying(16) NOT NULL,   -- ok | pending | mismatch
+    checked_at timestamp with time zone NOT NULL,
+    CONSTRAINT reconciliation_buckets_pkey PRIMARY KEY (bucket_hour)
+);
+
+CREATE INDEX IF NOT EXISTS reconciliation_buckets_unsettled_idx
+    ON sales_olap.reconciliation_buckets (bucket_hour)
+    WHERE status <> 'ok';
 
 
 
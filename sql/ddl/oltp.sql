@@ -1,7 +1,8 @@
 -- Users Table
 CREATE TABLE sales_oltp.users (
     user_id BIGINT PRIMARY KEY,
-    user_name VARCHAR(255) -- Optional if you want to store user details later
+    user_name VARCHAR(255), -- Optional if you want to store user details later
+    change_xid BIGINT NOT NULL DEFAULT txid_current() -- Transaction that inserted or last changed the row
 );
 
 -- Orders Table
@@ -15,7 +16,8 @@ CREATE TABLE sales_oltp.orders (
 -- Categories Table
 CREATE TABLE sales_oltp.categories (
     category_id BIGINT PRIMARY KEY,
-    category_code VARCHAR(255)
+    category_code VARCHAR(255),
+    change_xid BIGINT NOT NULL DEFAULT txid_current()
 );
 
 -- Products Table
@@ -23,9 +25,17 @@ CREATE TABLE sales_oltp.products (
     product_id BIGINT PRIMARY KEY,
     brand VARCHAR(255),
     category_id BIGINT NOT NULL,
+    change_xid BIGINT NOT NULL DEFAULT txid_current(),
     FOREIGN KEY (category_id) REFERENCES sales_oltp.categories(category_id)
 );
 
+-- Change scans of the OLAP dimension loaders (keyset over change_xid, key),
+-- and the products of a changed category.
+CREATE INDEX users_change_xid_idx ON sales_oltp.users (change_xid, user_id);
+CREATE INDEX categories_change_xid_idx ON sales_oltp.categories (change_xid);
+CREATE INDEX products_change_xid_idx ON sales_oltp.products (change_xid, product_id);
+CREATE INDEX products_category_id_idx ON sales_oltp.products (category_id, product_id);
+
 
 
 -- Order_Items Table
@@ -34,11 +44,34 @@ CREATE TABLE sales_oltp.order_items (
     order_id BIGINT NOT NULL,
     product_id BIGINT NOT NULL,
     price NUMERIC(10, 2) NOT NULL,
+    source_mongo_id VARCHAR(24),      -- mongo_id of the item's staging row; makes reloads idempotent
     FOREIGN KEY (order_id) REFERENCES sales_oltp.orders(order_id),
-    FOREIGN KEY (product_id) REFERENCES sales_oltp.products(product_id)
+    FOREIGN KEY (product_id) REFERENCES sales_oltp.products(product_id),
+    CONSTRAINT order_items_source_mongo_id_key UNIQUE (source_mongo_id)
 );
 
+-- Hour ranges of the reconciliation bucket queries, and item lookups per order.
+CREATE INDEX orders_event_time_idx ON sales_oltp.orders (event_time);
+CREATE INDEX order_items_order_id_idx ON sales_oltp.order_items (order_id);
+
 CREATE TABLE sales_oltp.etl_metadata (
     table_name VARCHAR(255) PRIMARY KEY,   -- Name of the source collection/table
-    last_processed_id VARCHAR(24)         -- MongoDB _id (stored as string)
+    last_processed_id VARCHAR(24),        -- MongoDB _id (stored as string)
+    resume_token TEXT                     -- Change stream resume token (extended JSON), --tail only
+);
+
+-- Older databases get resume_token and order_items.source_mongo_id from
+-- sql/migrations/003_checkpoint_resume_token_and_item_source.sql.
+
+-- Foreign keys, secondary indexes and UNLOGGED switches dropped by a loader's
+-- --backfill mode (scripts/common/backfill.py), kept until they are restored
+-- so an interrupted rebuild can be resumed with --backfill-finish.
+CREATE TABLE sales_oltp.backfill_objects (
+    table_name VARCHAR(255) NOT NULL,     -- Schema-qualified target table
+    object_name VARCHAR(255) NOT NULL,    -- Constraint or index name (the table itself for 'logged')
+    kind VARCHAR(16) NOT NULL,            -- foreign_key | index | logged
+    definition TEXT,                      -- pg_get_constraintdef / pg_get_indexdef output
+    status VARCHAR(16) NOT NULL,          -- dropped | added (NOT VALID) | restored
+    recorded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_name, object_name)
 );
\ No newline at end of file
@@ -17,4 +17,50 @@ CREATE TABLE IF NOT EXISTS sales_oltp.sales_staging
     processed boolean DEFAULT false,
     CONSTRAINT sales_staging_pkey PRIMARY KEY (id),
     CONSTRAINT sales_staging_mongo_id_key UNIQUE (mongo_id)
-)
+);
+
+-- Hour ranges and order lookups of the reconciliation bucket queries.
+CREATE INDEX IF NOT EXISTS sales_staging_event_time_idx
+    ON sales_oltp.sales_staging (event_time);
+
+CREATE INDEX IF NOT EXISTS sales_staging_order_id_idx
+    ON sales_oltp.sales_staging (order_id);
+
+-- Work queue of the OLTP workers: they claim the lowest unprocessed ids with
+-- FOR UPDATE SKIP LOCKED, so only the unprocessed rows need indexing.
+CREATE INDEX IF NOT EXISTS sales_staging_unprocessed_idx
+    ON sales_oltp.sales_staging (id)
+    WHERE processed = false;
+
+-- Lowest unprocessed order of the OLAP loader's staged_order_bound.
+CREATE INDEX IF NOT EXISTS sales_staging_unprocessed_order_id_idx
+    ON sales_oltp.sales_staging (order_id)
+    WHERE processed = false;
+
+-- Table: sales_oltp.sales_staging_archive
+
+-- Staging rows consumed by 'staging_oltp.py --consume archive'. Append-only;
+-- reconciliation reads it together with sales_staging, and it can be
+-- truncated once the hours it covers are reconciled.
+
+CREATE TABLE IF NOT EXISTS sales_oltp.sales_staging_archive
+(
+    id integer NOT NULL,
+    mongo_id character varying(24) COLLATE pg_catalog."default",
+    event_time timestamp without time zone,
+    order_id bigint,
+    product_id bigint,
+    category_id bigint,
+    category_code character varying(255) COLLATE pg_catalog."default",
+    brand character varying(255) COLLATE pg_catalog."default",
+    price numeric(10,2),
+    user_id bigint,
+    archived_at timestamp with time zone NOT NULL DEFAULT now(),
+    CONSTRAINT sales_staging_archive_pkey PRIMARY KEY (id)
+);
+
+CREATE INDEX IF NOT EXISTS sales_staging_archive_event_time_idx
+    ON sales_oltp.sales_staging_archive (event_time);
+
+CREATE INDEX IF NOT EXISTS sales_staging_archive_order_id_idx
+    ON sales_oltp.sales_staging_archive (order_id);
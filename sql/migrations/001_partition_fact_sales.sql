@@ -0,0 +1,91 @@
+-- Migration: partition an existing, unpartitioned sales_olap.fact_sales by month.
+--
+-- sql/ddl/olap.sql only creates the partitioned table on a fresh database.
+-- This converts a fact_sales created before partitioning, in one transaction:
+--
+--   1. the old heap is renamed to fact_sales_unpartitioned (with its primary
+--      key and date_id index)
+--   2. the partitioned fact_sales is created with the current definition,
+--      taking over the fact_sales_id sequence
+--   3. one fact_sales_YYYY_MM partition is created per month present, and
+--      every row is copied into it with sale_date backfilled from dim_date
+--
+-- fact_sales_ids are kept, so the rows stay identifiable. The old table is
+-- left in place for verification; drop it afterwards with
+--
+--   DROP TABLE sales_olap.fact_sales_unpartitioned;
+--
+-- Running it again on an already partitioned fact_sales does nothing. It
+-- takes an ACCESS EXCLUSIVE lock on fact_sales for the copy, so stop the
+-- OLAP loader first.
+--
+--   psql -v ON_ERROR_STOP=1 -f sql/migrations/001_partition_fact_sales.sql
+
+BEGIN;
+
+DO $$
+DECLARE
+    part_month date;
+    last_month date;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'sales_olap.fact_sales'::regclass) = 'p' THEN
+        RAISE NOTICE 'sales_olap.fact_sales is already partitioned; nothing to do.';
+        RETURN;
+    END IF;
+
+    ALTER TABLE sales_olap.fact_sales RENAME TO fact_sales_unpartitioned;
+    ALTER TABLE sales_olap.fact_sales_unpartitioned
+        RENAME CONSTRAINT fact_sales_pkey TO fact_sales_unpartitioned_pkey;
+    ALTER INDEX IF EXISTS sales_olap.fact_sales_date_id_idx RENAME TO fact_sales_unpartitioned_date_id_idx;
+
+    CREATE TABLE sales_olap.fact_sales
+    (
+        fact_sales_id integer NOT NULL DEFAULT nextval('sales_olap.fact_sales_fact_sales_id_seq'::regclass),
+        date_id integer NOT NULL,
+        sale_date date NOT NULL,
+        dim_user_id integer NOT NULL,
+        dim_product_id integer NOT NULL,
+        order_id bigint NOT NULL,
+        price numeric(10,2),
+        CONSTRAINT fact_sales_pkey PRIMARY KEY (fact_sales_id, sale_date),
+        CONSTRAINT fact_sales_date_id_fkey FOREIGN KEY (date_id)
+            REFERENCES sales_olap.dim_date (date_id),
+        CONSTRAINT fact_sales_dim_product_id_fkey FOREIGN KEY (dim_product_id)
+            REFERENCES sales_olap.dim_products (dim_product_id),
+        CONSTRAINT fact_sales_dim_user_id_fkey FOREIGN KEY (dim_user_id)
+            REFERENCES sales_olap.dim_users (dim_user_id)
+    ) PARTITION BY RANGE (sale_date);
+
+    -- The sequence would otherwise be dropped together with the old table.
+    ALTER SEQUENCE sales_olap.fact_sales_fact_sales_id_seq OWNED BY sales_olap.fact_sales.fact_sales_id;
+
+    -- Only the months that hold facts get a partition.
+    FOR part_month IN
+        SELECT DISTINCT date_trunc('month', d.date_val)::date
+        FROM sales_olap.fact_sales_unpartitioned f
+        JOIN sales_olap.dim_date d ON d.date_id = f.date_id
+        ORDER BY 1
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE sales_olap.%I PARTITION OF sales_olap.fact_sales FOR VALUES FROM (%L) TO (%L)',
+            'fact_sales_' || to_char(part_month, 'YYYY_MM'), part_month, (part_month + interval '1 month')::date
+        );
+        last_month := part_month;
+    END LOOP;
+
+    INSERT INTO sales_olap.fact_sales (
+        fact_sales_id, date_id, sale_date, dim_user_id, dim_product_id, order_id, price
+    )
+    SELECT f.fact_sales_id, f.date_id, d.date_val, f.dim_user_id, f.dim_product_id, f.order_id, f.price
+    FROM sales_olap.fact_sales_unpartitioned f
+    JOIN sales_olap.dim_date d ON d.date_id = f.date_id;
+
+    CREATE INDEX fact_sales_date_id_idx ON sales_olap.fact_sales (date_id);
+
+    RAISE NOTICE 'Copied sales_olap.fact_sales into monthly partitions through %.', last_month;
+END
+$$;
+
+COMMIT;
+
+ANALYZE sales_olap.fact_sales;
@@ -0,0 +1,31 @@
+-- Migration: change stream resume tokens and idempotent order_items loads.
+--
+-- Adds etl_metadata.resume_token (the checkpoint of mongo_to_staging.py
+-- --tail) and order_items.source_mongo_id with its unique constraint, which
+-- the OLTP loaders' ON CONFLICT (source_mongo_id) needs. Existing order_items
+-- keep a NULL source_mongo_id; NULLs never conflict, so they stay as they are.
+-- Building the constraint locks order_items exclusively while its index is
+-- built, so stop the OLTP loader first.
+--
+--   psql -v ON_ERROR_STOP=1 -f sql/migrations/003_checkpoint_resume_token_and_item_source.sql
+
+BEGIN;
+
+ALTER TABLE sales_oltp.etl_metadata ADD COLUMN IF NOT EXISTS resume_token TEXT;
+
+ALTER TABLE sales_oltp.order_items ADD COLUMN IF NOT EXISTS source_mongo_id VARCHAR(24);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'sales_oltp.order_items'::regclass
+          AND conname = 'order_items_source_mongo_id_key'
+    ) THEN
+        ALTER TABLE sales_oltp.order_items
+            ADD CONSTRAINT order_items_source_mongo_id_key UNIQUE (source_mongo_id);
+    END IF;
+END
+$$;
+
+COMMIT;
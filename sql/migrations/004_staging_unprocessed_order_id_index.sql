@@ -0,0 +1,16 @@
+-- Migration: index for the OLAP loader's staged order bound.
+--
+-- staged_order_bound (oltp_to_olap.py) reads the lowest order_id among the
+-- unprocessed staging rows before every fact load; without this partial
+-- index that is a full scan of sales_staging. Building it blocks writes to
+-- sales_staging, so stop the staging and OLTP loaders first.
+--
+--   psql -v ON_ERROR_STOP=1 -f sql/migrations/004_staging_unprocessed_order_id_index.sql
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS sales_staging_unprocessed_order_id_idx
+    ON sales_oltp.sales_staging (order_id)
+    WHERE processed = false;
+
+COMMIT;
@@ -0,0 +1,96 @@
+from datetime import datetime
+
+import pytest
+
+from scripts.common import archive
+
+
+def oid(n):
+    """
+    ObjectId-shaped hex string; these sort like the ids they stand for.
+    """
+    return f"{n:024x}"
+
+
+def doc(n, **fields):
+    return {"_id": oid(n), "event_time": datetime(2020, 1, 1), "order_id": n, **fields}
+
+
+@pytest.fixture
+def directory(tmp_path):
+    # Three archived batches: ids 1-3, 4-6 and 7-9.
+    for first in (1, 4, 7):
+        archive.write_batch(str(tmp_path), [doc(n) for n in range(first, first + 3)])
+    return str(tmp_path)
+
+
+def ids(tables):
+    return [n for table in tables for n in table.column("order_id").to_pylist()]
+
+
+def test_read_range_without_bounds_reads_everything(directory):
+    assert ids(archive.read_range(directory)) == list(range(1, 10))
+
+
+def test_read_range_lower_bound_is_exclusive(directory):
+    assert ids(archive.read_range(directory, lower_id=oid(5))) == [6, 7, 8, 9]
+
+
+def test_read_range_upper_bound_is_inclusive(directory):
+    assert ids(archive.read_range(directory, upper_id=oid(5))) == [1, 2, 3, 4, 5]
+
+
+def test_read_range_trims_both_ends(directory):
+    tables = list(archive.read_range(directory, lower_id=oid(2), upper_id=oid(8)))
+    assert ids(tables) == [3, 4, 5, 6, 7, 8]
+    # The middle file lies inside the range and is not filtered.
+    assert [table.num_rows for table in tables] == [1, 3, 2]
+
+
+def test_read_range_skips_files_outside_the_range(directory):
+    assert ids(archive.read_range(directory, lower_id=oid(3), upper_id=oid(6))) == [4, 5, 6]
+    assert [path for _, _, path in archive.list_files(directory, oid(3), oid(6))] == [
+        f"{directory}/{oid(4)}_{oid(6)}.arrow"
+    ]
+
+
+def test_read_range_drops_emptied_tables(tmp_path):
+    archive.write_batch(str(tmp_path), [doc(10), doc(20)])
+    # Inside the file's id span, but between its rows.
+    assert list(archive.read_range(str(tmp_path), lower_id=oid(10), upper_id=oid(15))) == []
+
+
+def test_read_range_yields_overlapping_batches_twice(tmp_path):
+    # A retried load archives the same batch again, under the same name...
+    archive.write_batch(str(tmp_path), [doc(n) for n in (1, 2)])
+    archive.write_batch(str(tmp_path), [doc(n) for n in (1, 2)])
+    assert ids(archive.read_range(str(tmp_path))) == [1, 2]
+    # ... or, resized, as an overlapping one; both are read.
+    archive.write_batch(str(tmp_path), [doc(n) for n in (1, 2, 3)])
+    assert ids(archive.read_range(str(tmp_path), upper_id=oid(2))) == [1, 2, 1, 2]
+
+
+def test_read_range_of_a_missing_directory(tmp_path):
+    assert list(archive.read_range(str(tmp_path / "missing"))) == []
+
+
+def test_batch_table_applies_the_staging_defaults():
+    table = archive.batch_table([{"_id": oid(1)}])
+    row = table.to_pylist()[0]
+    assert row == {
+        "mongo_id": oid(1), "event_time": archive.EPOCH, "order_id": -1, "product_id": -1,
+        "category_id": -1, "category_code": "unknown", "brand": "unknown", "price": 0.0, "user_id": -1,
+    }
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    (datetime(2019, 10, 1, 8), datetime(2019, 10, 1, 8)),
+    ("2019-10-01 08:00:00 UTC", datetime(2019, 10, 1, 8)),
+    ("2019-10-01T08:00:00", datetime(2019, 10, 1, 8)),
+    ("2019/10/01 08:00:00", datetime(2019, 10, 1, 8)),
+    ("01.10.2019 08:00:00", datetime(2019, 10, 1, 8)),
+    ("yesterday", None),
+])
+def test_event_time(value, expected):
+    assert archive._event_time(value) == expected
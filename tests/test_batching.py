@@ -0,0 +1,107 @@
+import pytest
+
+from scripts.common import batching
+from scripts.common.batching import GROWTH_COOLDOWN, AdaptiveBatchSizer, make_sizer
+
+
+@pytest.fixture
+def rss(monkeypatch):
+    """
+    Replaces the process RSS the sizer sees; set values[0] to change it.
+    """
+    values = [None]
+    monkeypatch.setattr(batching, "current_rss_mb", lambda: values[0])
+    return values
+
+
+def sizer(**kwargs):
+    options = dict(initial=10000, minimum=1000, maximum=100000, target_seconds=2.0)
+    options.update(kwargs)
+    return AdaptiveBatchSizer("test", **options)
+
+
+def test_initial_size_is_clamped():
+    assert sizer(initial=10).size == 1000
+    assert sizer(initial=10 ** 9).size == 100000
+
+
+def test_slow_batch_shrinks_in_proportion(rss):
+    s = sizer()
+    assert s.record(10000, seconds=3.5) == int(10000 * 2.0 / 3.5)
+
+
+def test_very_slow_batch_shrinks_by_half_at_most(rss):
+    s = sizer()
+    assert s.record(10000, seconds=60.0) == 5000
+
+
+def test_size_on_target_is_kept(rss):
+    s = sizer()
+    assert s.record(10000, seconds=2.0) == 10000
+
+
+def test_fast_full_batch_grows(rss):
+    s = sizer()
+    assert s.record(10000, seconds=0.5) == 15000
+    assert s.previous == (10000, 20000.0)
+
+
+def test_short_batch_does_not_grow(rss):
+    s = sizer()
+    assert s.record(100, seconds=0.01) == 10000
+
+
+def test_growth_is_kept_when_throughput_improves(rss):
+    s = sizer()
+    s.record(10000, seconds=0.5)
+    assert s.record(15000, seconds=0.6) == 15000
+    assert s.previous is None
+    assert s.cooldown == 0
+
+
+def test_slower_growth_steps_back_and_cools_down(rss):
+    s = sizer()
+    s.record(10000, seconds=0.5)
+    # 15000 rows/s after growing, 20000 before.
+    assert s.record(15000, seconds=1.0) == 10000
+    assert s.cooldown == GROWTH_COOLDOWN
+    # Still fast, but no new growth attempt until the cooldown has run out.
+    for _ in range(GROWTH_COOLDOWN - 1):
+        assert s.record(10000, seconds=0.5) == 10000
+    assert s.record(10000, seconds=0.5) == 15000
+
+
+def test_rising_rss_over_budget_halves(rss):
+    s = sizer(memory_budget_mb=100)
+    rss[0] = 150
+    assert s.record(10000, seconds=0.5) == 10000
+    rss[0] = 160
+    assert s.record(10000, seconds=0.5) == 5000
+    # Over budget but no longer rising: kept, and never grown.
+    assert s.record(5000, seconds=0.1) == 5000
+
+
+def test_batch_of_an_older_size_is_only_timed(rss):
+    s = sizer()
+    s.record(10000, seconds=0.5, size=10000)
+    assert s.size == 15000
+    # Fetched ahead at the old size: ignored, even though it is slow.
+    assert s.record(10000, seconds=10.0, size=10000) == 15000
+    assert s.previous == (10000, 20000.0)
+    assert s.record(15000, seconds=10.0, size=15000) < 15000
+
+
+def test_record_without_seconds_times_since_the_last_batch(rss, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(batching.time, "perf_counter", lambda: clock[0])
+    s = sizer()
+    clock[0] += 4.0
+    assert s.record(10000) == 5000
+    s.restart_clock()
+    clock[0] += 0.1
+    assert s.record(5000) == 7500
+
+
+def test_make_sizer():
+    assert make_sizer("oltp", 5000, adaptive=False) is None
+    assert make_sizer("oltp", 5000, adaptive=True).size == 5000
@@ -0,0 +1,89 @@
+import re
+
+from scripts.common import checkpoint
+
+
+def like(value, pattern):
+    """
+    PostgreSQL's LIKE with its default escape character, the backslash.
+    """
+    regex = ""
+    chars = iter(pattern)
+    for char in chars:
+        if char == "\\":
+            regex += re.escape(next(chars))
+        elif char == "%":
+            regex += ".*"
+        elif char == "_":
+            regex += "."
+        else:
+            regex += re.escape(char)
+    return re.fullmatch(regex, value, re.DOTALL) is not None
+
+
+class FakeCursor:
+    """
+    Records every statement; answers the LIKE query of checkpoint.names()
+    from 'table_names'.
+    """
+
+    def __init__(self, table_names=()):
+        self.table_names = table_names
+        self.executed = []
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.executed.append((" ".join(query.split()), params))
+        if "LIKE" in query:
+            self.rows = [(name,) for name in sorted(self.table_names) if like(name, params[0])]
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_like_helper_follows_postgres():
+    assert like("fact_sales:1", "fact\\_sales:%")
+    assert not like("factXsales:1", "fact\\_sales:%")
+    assert like("factXsales:1", "fact_sales:%")
+
+
+def test_names_matches_the_prefix_only():
+    cur = FakeCursor(["sales_staging:min:10", "sales_staging:10:20", "sales_staging", "fact_sales:1"])
+    assert checkpoint.names(cur, "sales_staging:") == ["sales_staging:10:20", "sales_staging:min:10"]
+
+
+def test_names_escapes_underscore():
+    # Unescaped, '_' would match any character.
+    cur = FakeCursor(["fact_sales:1", "factXsales:2"])
+    assert checkpoint.names(cur, "fact_sales:") == ["fact_sales:1"]
+
+
+def test_names_escapes_percent():
+    cur = FakeCursor(["rollup%:2020-01", "rollup:2020-01", "rollupX%:2020-01"])
+    assert checkpoint.names(cur, "rollup%:") == ["rollup%:2020-01"]
+
+
+def test_names_escapes_backslash():
+    cur = FakeCursor(["shard\\_1", "shard\\x1", "shard_1"])
+    assert checkpoint.names(cur, "shard\\_") == ["shard\\_1"]
+    assert checkpoint.names(cur, "shard\\") == ["shard\\_1", "shard\\x1"]
+
+
+def test_save_names_resume_token_only_when_given():
+    cur = FakeCursor()
+    checkpoint.save(cur, "sales_staging", 42)
+    query, params = cur.executed[-1]
+    assert "resume_token" not in query
+    assert params == ("sales_staging", "42")
+
+    checkpoint.save(cur, "sales_staging", "abc", resume_token='{"_data": "82"}')
+    query, params = cur.executed[-1]
+    assert "resume_token = EXCLUDED.resume_token" in query
+    assert params == ("sales_staging", "abc", '{"_data": "82"}')
+
+
+def test_save_monotonic_never_moves_back():
+    cur = FakeCursor()
+    checkpoint.save(cur, "sales_staging", "ff", monotonic=True)
+    query, _ = cur.executed[-1]
+    assert "GREATEST(etl_metadata.last_processed_id, EXCLUDED.last_processed_id)" in query
@@ -0,0 +1,89 @@
+from scripts.common.keycache import SurrogateKeyCache
+
+
+def test_full_recent_segment_evicts_older():
+    cache = SurrogateKeyCache("users", capacity=4)
+    cache.update([(1, 10), (2, 20)])
+    # 'recent' is full; the next put moves it to 'older'.
+    cache.put(3, 30)
+    cache.put(4, 40)
+    assert cache.evictions == 0
+    # ... and this one drops 1 and 2.
+    cache.put(5, 50)
+    assert cache.evictions == 2
+    assert cache.get(1) is None
+    assert cache.get(2) is None
+    assert [cache.get(key) for key in (3, 4, 5)] == [30, 40, 50]
+
+
+def test_lookup_promotes_older_entries():
+    cache = SurrogateKeyCache("users", capacity=4)
+    cache.update([(1, 10), (2, 20), (3, 30)])
+    # 1 and 2 are in 'older' now; the lookup moves 1 back to 'recent'.
+    assert cache.get(1) == 10
+    cache.put(4, 40)
+    assert cache.get(1) == 10
+    assert cache.get(2) is None
+
+
+def test_lookup_many_counts_hits_and_misses():
+    cache = SurrogateKeyCache("products", capacity=10)
+    cache.update([(1, 10), (2, 20)])
+    found, missing = cache.lookup_many([1, 2, 3])
+    assert found == {1: 10, 2: 20}
+    assert missing == [3]
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert cache.stats()["hit_rate"] == 2 / 3
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "users.skc")
+    cache = SurrogateKeyCache("users", capacity=10, snapshot_path=path, generation=7)
+    cache.update([(3, 30), (1, 10), (2, 20)])
+    cache.save_snapshot()
+    cache.close()
+
+    reopened = SurrogateKeyCache("users", capacity=10, snapshot_path=path, generation=7)
+    assert [reopened.get(key) for key in (1, 2, 3)] == [10, 20, 30]
+    assert reopened.get(4) is None
+    assert reopened.stats()["snapshot_entries"] == 3
+    reopened.close()
+
+
+def test_saving_merges_memory_over_snapshot(tmp_path, monkeypatch):
+    # Small write blocks, so the merge spans several of them.
+    monkeypatch.setattr("scripts.common.keycache._WRITE_BLOCK", 2)
+    path = str(tmp_path / "products.skc")
+    cache = SurrogateKeyCache("products", capacity=100, snapshot_path=path)
+    cache.update([(1, 10), (3, 30), (5, 50)])
+    cache.save_snapshot()
+
+    cache = SurrogateKeyCache("products", capacity=100, snapshot_path=path)
+    cache.update([(0, 1), (3, 31), (4, 40), (9, 90)])
+    cache.save_snapshot()
+    cache.close()
+
+    reopened = SurrogateKeyCache("products", capacity=100, snapshot_path=path)
+    assert list(reopened._merged_items()) == [(0, 1), (1, 10), (3, 31), (4, 40), (5, 50), (9, 90)]
+    reopened.close()
+
+
+def test_snapshot_of_another_generation_is_discarded(tmp_path):
+    path = str(tmp_path / "users.skc")
+    cache = SurrogateKeyCache("users", capacity=10, snapshot_path=path, generation=1)
+    cache.put(1, 10)
+    cache.save_snapshot()
+    cache.close()
+
+    rebuilt = SurrogateKeyCache("users", capacity=10, snapshot_path=path, generation=2)
+    assert rebuilt.get(1) is None
+    assert len(rebuilt) == 0
+
+
+def test_invalid_snapshot_is_ignored(tmp_path):
+    path = tmp_path / "users.skc"
+    path.write_bytes(b"not a snapshot at all")
+    cache = SurrogateKeyCache("users", capacity=10, snapshot_path=str(path))
+    assert len(cache) == 0
+    cache.put(1, 10)
+    assert cache.get(1) == 10
@@ -0,0 +1,99 @@
+import pytest
+
+from scripts.common import plans
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT * FROM t WHERE id = %s AND name = 'it''s'", "SELECT * FROM t WHERE id = ? AND name = ?"),
+    ("SELECT %(first)s, 1.5, x1 FROM t", "SELECT ?, ?, x1 FROM t"),
+    ("SELECT a -- the key\nFROM t", "SELECT a FROM t"),
+    ("SELECT * FROM t WHERE a = ANY(ARRAY[1, 2, 3])", "SELECT * FROM t WHERE a = ANY(ARRAY[...])"),
+    (b"SELECT * FROM t WHERE id = 7", "SELECT * FROM t WHERE id = ?"),
+])
+def test_normalize_folds_literals(query, expected):
+    assert plans.normalize(query) == expected
+
+
+def test_normalize_folds_values_lists():
+    # Pages of one execute_values call, with different row counts and casts.
+    first = "INSERT INTO t (a, b) VALUES (1, 'x'), (2, 'y')"
+    second = "INSERT INTO t (a, b) VALUES (%s::bigint, %s), (%s::bigint, %s), (%s::bigint, %s)"
+    assert plans.normalize(first) == plans.normalize(second) == "INSERT INTO t (a, b) VALUES (...)"
+
+
+def test_normalize_keeps_column_lists():
+    assert plans.normalize("INSERT INTO t (a, b) SELECT a, b FROM s") == "INSERT INTO t (a, b) SELECT a, b FROM s"
+
+
+def seq_scan(relation, rows, removed=0, loops=1, alias=None, **extra):
+    return {
+        "Node Type": "Seq Scan", "Relation Name": relation, "Alias": alias or relation,
+        "Actual Rows": rows, "Rows Removed by Filter": removed, "Actual Loops": loops, **extra,
+    }
+
+
+def test_analyze_reports_large_seq_scans_with_filter_columns():
+    root = seq_scan("sales_staging", 10, removed=5000, Filter="(processed = false)")
+    [finding] = plans.analyze(root)
+    assert finding["kind"] == "seq_scan"
+    assert finding["table"] == "sales_staging"
+    assert finding["columns"] == ["processed"]
+    assert finding["detail"] == "Seq Scan on sales_staging read 5010 rows, filter (processed = false)"
+
+
+def test_analyze_ignores_small_seq_scans():
+    assert plans.analyze(seq_scan("users", plans.SEQ_SCAN_MIN_ROWS - 1)) == []
+
+
+def test_analyze_counts_every_loop():
+    [finding] = plans.analyze(seq_scan("users", 100, loops=10))
+    assert finding["detail"] == "Seq Scan on users read 1000 rows"
+
+
+def test_analyze_takes_join_columns_from_the_nearest_join():
+    root = {
+        "Node Type": "Hash Join",
+        "Hash Cond": "(oi.order_id = o.order_id)",
+        "Plans": [
+            seq_scan("order_items", 50000, alias="oi"),
+            {"Node Type": "Hash", "Hash Batches": 1, "Plans": [seq_scan("orders", 20000, alias="o")]},
+        ],
+    }
+    findings = plans.analyze(root)
+    assert [(f["table"], f["columns"]) for f in findings] == [("order_items", ["order_id"]), ("orders", ["order_id"])]
+
+
+def test_analyze_names_partitions_by_their_table():
+    [finding] = plans.analyze(seq_scan("fact_sales_2020_04", 5000))
+    assert finding["table"] == "fact_sales"
+
+
+def test_analyze_reports_spills():
+    root = {
+        "Node Type": "Sort", "Sort Space Type": "Disk", "Sort Key": ["o.order_id"],
+        "Sort Space Used": 2048, "Sort Method": "external merge",
+        "Plans": [{"Node Type": "Hash", "Hash Batches": 4, "Peak Memory Usage": 4096}],
+    }
+    assert plans.analyze(root) == [
+        {"kind": "disk_sort", "detail": "Sort on o.order_id spilled 2048 kB to disk (external merge)"},
+        {"kind": "hash_spill", "detail": "Hash needed 4 batches (peak 4096 kB)"},
+    ]
+
+
+def test_plan_signature():
+    root = {
+        "Node Type": "Nested Loop",
+        "Plans": [
+            seq_scan("orders", 1),
+            {"Node Type": "Index Scan", "Index Name": "users_pkey", "Relation Name": "users"},
+        ],
+    }
+    assert plans.plan_signature(root) == "Nested Loop(Seq Scan[orders], Index Scan[users_pkey])"
+
+
+def test_recommend_skips_indexed_and_unknown_tables():
+    staging = seq_scan("sales_staging", 5000, Filter="((processed = false) AND (brand = 'x'::text))")
+    temp = seq_scan("pg_temp_load", 5000, Filter="(id = 1)")
+    profiles = {"k1": {"findings": plans.analyze(staging)}, "k2": {"findings": plans.analyze(temp)}}
+    indexes = {"sales_staging": [["id"], ["processed"]]}
+    assert plans.recommend(profiles, indexes) == {("sales_staging", "brand"): ["k1"]}
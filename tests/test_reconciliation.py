@@ -0,0 +1,93 @@
+"""
+Runs the reconciliation bucket queries against a scratch PostgreSQL
+database, named by $ETL_TEST_POSTGRES_DSN (skipped when unset). Everything
+is created inside one transaction that is rolled back, so the database must
+not hold the pipeline schemas already.
+"""
+import importlib.util
+import os
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+DSN = os.environ.get("ETL_TEST_POSTGRES_DSN")
+if not DSN:
+    pytest.skip("ETL_TEST_POSTGRES_DSN is not set", allow_module_level=True)
+
+_spec = importlib.util.spec_from_file_location(
+    "reconciliation", Path(__file__).resolve().parent.parent / "scripts" / "etl testing" / "reconciliation.py"
+)
+reconciliation = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(reconciliation)
+
+UNKNOWN_HOUR = datetime(1970, 1, 1)
+HOUR = datetime(2020, 4, 1, 10)
+
+SCHEMA = """
+    CREATE SCHEMA sales_oltp;
+    CREATE SCHEMA sales_olap;
+    CREATE TABLE sales_oltp.sales_staging (
+        id bigint, event_time timestamp, order_id bigint, price numeric(10,2), processed boolean
+    );
+    CREATE TABLE sales_oltp.sales_staging_archive (
+        id bigint, event_time timestamp, order_id bigint, price numeric(10,2)
+    );
+    CREATE TABLE sales_oltp.orders (order_id bigint, event_time timestamp);
+    CREATE TABLE sales_oltp.order_items (order_item_id bigint, order_id bigint, price numeric(10,2));
+    CREATE TABLE sales_olap.dim_date (date_id integer, date_val date, hour integer);
+    CREATE TABLE sales_olap.fact_sales (date_id integer, sale_date date, order_id bigint, price numeric(10,2));
+"""
+
+
+@pytest.fixture
+def cur():
+    conn = psycopg2.connect(DSN)
+    try:
+        cur = conn.cursor()
+        cur.execute(SCHEMA)
+        yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def load_order(cur, staging_id, order_id, staged_time, hour, date_id, price=5):
+    """
+    One fully loaded order: a staging row with 'staged_time' (None for a
+    document without one), and its OLTP order and fact in 'hour'.
+    """
+    cur.execute("INSERT INTO sales_oltp.sales_staging VALUES (%s, %s, %s, %s, true)",
+                (staging_id, staged_time, order_id, price))
+    cur.execute("INSERT INTO sales_oltp.orders VALUES (%s, %s)", (order_id, hour))
+    cur.execute("INSERT INTO sales_oltp.order_items VALUES (%s, %s, %s)", (staging_id, order_id, price))
+    cur.execute("INSERT INTO sales_olap.dim_date VALUES (%s, %s, %s)", (date_id, hour.date(), hour.hour))
+    cur.execute("INSERT INTO sales_olap.fact_sales VALUES (%s, %s, %s, %s)", (date_id, hour.date(), order_id, price))
+
+
+def reconcile_hours(cur, hours):
+    results = {}
+    for layer in reconciliation.LAYERS:
+        cur.execute(reconciliation.BUCKET_QUERIES[layer], {"hours": hours, "fact_watermark": 100})
+        results[layer] = {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+    return {row[0]: row for row in reconciliation.build_bucket_rows(hours, results)}
+
+
+def test_null_event_time_is_reconciled_in_the_1970_hour(cur):
+    load_order(cur, 1, 10, None, UNKNOWN_HOUR, 1)
+    load_order(cur, 2, 20, HOUR, HOUR, 2)
+
+    rows = reconcile_hours(cur, [UNKNOWN_HOUR, HOUR])
+    unknown = rows[UNKNOWN_HOUR]
+    # staging items and orders, then the status.
+    assert unknown[1:3] == (1, 1)
+    assert unknown[-1] == "ok"
+    assert rows[HOUR][-1] == "ok"
+
+
+def test_null_event_time_rows_stay_out_of_other_hours(cur):
+    load_order(cur, 1, 10, None, UNKNOWN_HOUR, 1)
+
+    rows = reconcile_hours(cur, [HOUR])
+    assert rows[HOUR][1:3] == (0, 0)
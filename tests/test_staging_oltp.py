@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("psycopg2")
+staging_oltp = pytest.importorskip("scripts.oltp_load.staging_oltp")
+
+ENGINES = (staging_oltp.process_staging_batch, staging_oltp.process_staging_batch_columnar)
+
+
+class FakeConn:
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def staging_row(staging_id, order_id=7, product_id=3, price=9.5):
+    return (staging_id, f"{staging_id:024x}", datetime(2020, 1, 1), order_id, product_id, 1, "c", "b", price, 5)
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """
+    Replaces write_normalized_batch; collects the order items of every batch.
+    """
+    batches = []
+
+    def write(conn, order_items, processed_ids, **kwargs):
+        batches.append(sorted(order_items, key=lambda item: item[3]))
+        return len(processed_ids)
+
+    monkeypatch.setattr(staging_oltp, "write_normalized_batch", write)
+    return batches
+
+
+def feed(monkeypatch, *batches):
+    batches = list(batches)
+    monkeypatch.setattr(staging_oltp, "stream_rows", lambda *args: iter(batches.pop(0)))
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_duplicate_items_are_keyed_per_staging_row(engine, monkeypatch, written):
+    rows = [staging_row(1), staging_row(2), staging_row(3, product_id=4)]
+    feed(monkeypatch, rows, rows[:1], rows[1:])
+    # The same rows in one batch or split across two give the same items.
+    engine(FakeConn())
+    engine(FakeConn())
+    engine(FakeConn())
+    assert [item[3] for item in written[0]] == [f"{n:024x}" for n in (1, 2, 3)]
+    assert written[0] == written[1] + written[2]
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_failed_read_rolls_back(engine, monkeypatch, written):
+    def rows(*args):
+        yield staging_row(1)
+        raise staging_oltp.psycopg2.OperationalError("lost")
+
+    monkeypatch.setattr(staging_oltp, "stream_rows", rows)
+    conn = FakeConn()
+    with pytest.raises(staging_oltp.psycopg2.OperationalError):
+        engine(conn)
+    assert conn.rollbacks == 1
+    assert written == []